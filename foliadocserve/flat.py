@@ -18,11 +18,19 @@
 
 import json
 import random
+import re
 import sys
+import threading
+import time
 import unicodedata
+from collections import OrderedDict
 from folia import fql
 import folia.main as folia
 from foliatools.foliatextcontent import linkstrings
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 ELEMENTLIMIT = 5000 #structure elements only
@@ -94,18 +102,372 @@ def getslices(doc, Class, size=100):
 
 
 
+def changeactions(query):
+    """Yields all actions of an FQL query (including subactions and subsequent actions) that change the document"""
+    actions = [query.action] if isinstance(query, fql.Query) and query.action else []
+    while actions:
+        action = actions.pop()
+        if action.action != "SELECT":
+            yield action
+        actions += action.subactions
+        if action.nextaction:
+            actions.append(action.nextaction)
+
+def flattenresults(results):
+    """Returns the results of a query (possibly grouped in lists or spansets) as a flat list"""
+    if isinstance(results, (list, tuple, fql.SpanSet)):
+        elements = []
+        for result in results:
+            if isinstance(result, (list, tuple, fql.SpanSet)):
+                elements += list(result)
+            else:
+                elements.append(result)
+        return elements
+    else:
+        return [results]
+
+
+class Neighbours:
+    """Resolves the neighbours of elements exactly like next() and previous() in folia without a scope (scope=None) do, but scans the
+    children of each parent only once for all its children (rather than once per lookup), so neighbouring words are found in constant time.
+    The scans are only valid as long as the document does not change."""
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.scans = {} #(id(parent), Class, reverse) => (parent, {id(child): first eligible sibling after (before if reverse) the child})
+
+    def scan(self, parent, Class, reverse):
+        key = (id(parent), Class, reverse)
+        scan = self.scans.get(key)
+        if scan is None:
+            structural = Class is not None and (any(issubclass(C, folia.AbstractStructureElement) for C in Class) if isinstance(Class, tuple) else issubclass(Class, folia.AbstractStructureElement))
+            siblings = {}
+            eligible = None
+            for e in (parent.data if reverse else reversed(parent.data)):
+                if eligible is not None:
+                    siblings[id(e)] = eligible
+                if isinstance(e, folia.AbstractElement) and e.auth and not isinstance(e, folia.AbstractAnnotationLayer) and (not structural or not isinstance(e, (folia.AbstractInlineAnnotation, folia.TextContent))):
+                    if not (structural and isinstance(e, folia.Correction) and next(e.select(folia.AbstractStructureElement), None) is None): #skip-over non-structural correction
+                        eligible = e
+            scan = self.scans[key] = (parent, siblings) #holding on to the parent keeps its id() unique
+        return scan[1]
+
+    def next(self, element, Class=None, reverse=False):
+        """Equivalent to element.next(Class, None, reverse)"""
+        child = element
+        parent = element.parent
+        while parent:
+            siblings = self.scan(parent, Class, reverse)
+            if id(child) in siblings:
+                e = siblings[id(child)]
+                if Class is None or isinstance(e, Class):
+                    return e
+                #descend in the very leftmost (rightmost if reversed) branch only
+                while e.data:
+                    e = e.data[-1 if reverse else 0]
+                    if not isinstance(e, folia.AbstractElement):
+                        return None
+                    if e.auth and not isinstance(e, folia.AbstractAnnotationLayer) and isinstance(e, Class):
+                        return e
+                return None
+            child = parent
+            parent = parent.parent
+        return None
+
+    def previous(self, element, Class=None):
+        """Equivalent to element.previous(Class, None)"""
+        return self.next(element, Class, True)
+
+    def clear(self):
+        self.scans = {}
+
+
+class SpanIndex:
+    """Keeps, for span annotations (and span roles), the elements they target and cover and their layer parent and parent span, and for
+    structure elements whether they hold annotation layers. Elements rather than IDs are kept, IDs may still be assigned during rendering"""
+
+    SPANCLASSES = (folia.AbstractSpanAnnotation, folia.AbstractAnnotationLayer, folia.AbstractSpanRole)
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.wrefcache = {} #id(span) => (span, targets, scope)
+        self.ancestorcache = {} #id(span) => (span, structure element holding the layer, parent span or None)
+        self.layercache = {} #id(structure element) => (structure element, has annotation layers?)
+
+    def wrefs(self, span):
+        """Returns the elements the span annotation targets directly and all elements in its scope (i.e. including those of nested spans)"""
+        entry = self.wrefcache.get(id(span))
+        if entry is None:
+            entry = self.wrefcache[id(span)] = (span, list(span.wrefs(recurse=False)), list(span.wrefs(recurse=True)))
+        return entry[1], entry[2]
+
+    def ancestors(self, span):
+        """Returns the structure element holding the layer of the span annotation, and its parent span (or None)"""
+        entry = self.ancestorcache.get(id(span))
+        if entry is None:
+            layerparent = span.ancestor(folia.AbstractAnnotationLayer).ancestor(folia.AbstractStructureElement)
+            try:
+                parentspan = span.ancestor(folia.AbstractSpanAnnotation)
+            except folia.NoSuchAnnotation:
+                parentspan = None
+            entry = self.ancestorcache[id(span)] = (span, layerparent, parentspan)
+        return entry[1], entry[2]
+
+    def hasannotationlayer(self, element):
+        entry = self.layercache.get(id(element))
+        if entry is None:
+            entry = self.layercache[id(element)] = (element, element.hasannotationlayer())
+        return entry[1]
+
+    def discard(self, span):
+        """Discards everything kept for the span annotation, for the spans it is nested in, and for its span roles and nested spans"""
+        for e in [span] + [ a for a in span.ancestors() if isinstance(a, folia.AbstractSpanAnnotation) ] + list(span.select(folia.AbstractSpanAnnotation, ignore=folia.wrefables)):
+            self.wrefcache.pop(id(e), None)
+            self.ancestorcache.pop(id(e), None)
+        try:
+            self.layercache.pop(id(span.ancestor(folia.AbstractAnnotationLayer).ancestor(folia.AbstractStructureElement)), None) #the layer may be new
+        except folia.NoSuchAnnotation:
+            pass
+
+    def invalidate(self, results, query):
+        """Invalidates what the changes made by the query (with the given results) may affect. If the changed spans are returned, only those are
+        discarded; changes to the structure, or to spans that are not returned, invalidate everything"""
+        classes = [ (action.action, action.focus.Class if action.focus else None) for action in changeactions(query) ]
+        if all( isinstance(Class, type) and not issubclass(Class, self.SPANCLASSES) and not (issubclass(Class, folia.AbstractStructureElement) and action != 'EDIT') for action, Class in classes ):
+            return #no spans or structure changed
+        elements = flattenresults(results) if results is not None else []
+        if elements and all( isinstance(e, folia.AbstractSpanAnnotation) for e in elements ) and all( isinstance(Class, type) and issubclass(Class, self.SPANCLASSES) for _, Class in classes ):
+            for e in elements:
+                root = e
+                while root.parent is not None:
+                    root = root.parent
+                if not any(root is x for x in self.doc.data):
+                    break #detached from the document (deleted)
+                self.discard(e)
+            else:
+                return
+        self.clear()
+
+    def clear(self):
+        self.wrefcache = {}
+        self.ancestorcache = {}
+        self.layercache = {}
+
+
+class DocumentInfo:
+    """Holds information derived from a whole document (table of contents, slices, declarations, provenance, set definitions
+    and text direction), computed once and kept until a change to the document may affect it."""
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.cache = {} #name (or ('ids', Class) for the IDs of all elements of a class) => derived information
+        self.neighbours = Neighbours(doc) #filled as elements are rendered
+        self.spans = SpanIndex(doc) #filled as elements are rendered
+        self.lock = threading.Lock()
+
+    def get(self, name, compute):
+        with self.lock:
+            if name not in self.cache:
+                self.cache[name] = compute()
+            return self.cache[name]
+
+    def toc(self):
+        return self.get('toc', lambda: gettoc(self.doc))
+
+    def slices(self, Class, size=100):
+        return self.get(('ids', Class), lambda: [ element.id for element in self.doc.select(Class) ])[::size]
+
+    def declarations(self):
+        return self.get('declarations', lambda: tuple(getdeclarations(self.doc)))
+
+    def provenance(self):
+        return self.get('provenance', lambda: getprovenance(self.doc))
+
+    def setdefinitions(self):
+        return self.get('setdefinitions', lambda: getsetdefinitions(self.doc))
+
+    def rtl(self):
+        return self.get('rtl', lambda: isrtl(self.doc))
+
+    def precompute(self):
+        """Computes all information that does not depend on request parameters"""
+        self.rtl()
+        self.declarations()
+        self.provenance()
+        self.setdefinitions()
+        self.toc()
+
+    def invalidate(self, results=None, query=None):
+        """Invalidates the information that may be affected by a change the query made (with the given results), or by a metadata change if no query is given.
+        Declarations, provenance and neighbours are always invalidated; the table of contents and slices only if the structure or the text of a head changed,
+        span information only if spans or the structure changed"""
+        self.neighbours.clear()
+        if query is not None:
+            self.spans.invalidate(results, query)
+        with self.lock:
+            for name in ('declarations', 'provenance', 'setdefinitions', 'rtl'):
+                self.cache.pop(name, None)
+            if query is None:
+                return
+            if any( isinstance(action.focus.Class, type) and issubclass(action.focus.Class, folia.AbstractStructureElement) and action.action != 'EDIT' for action in changeactions(query) if action.focus ):
+                #structure elements were added or removed
+                for name in [ name for name in self.cache if name == 'toc' or isinstance(name, tuple) ]:
+                    del self.cache[name]
+            elif 'toc' in self.cache:
+                elements = flattenresults(results) if results is not None else []
+                if not elements or any( not isinstance(e, folia.AbstractElement) or isinstance(e, folia.Head) or any( isinstance(a, folia.Head) for a in e.ancestors() ) or next(e.select(folia.Head), None) is not None for e in elements ):
+                    del self.cache['toc']
+
+
+class RenderCache:
+    """Memoizes the rendering (html, structure and annotations) of the structure elements of a document, keyed by element ID.
+
+    Entries are only invalidated for the elements affected by a change: the changed structure elements themselves, all their
+    ancestors and descendants, and their siblings and neighbouring words (as these refer to each other). Changes to span
+    annotations, which are rendered along with every structure element in their scope, invalidate all entries."""
+
+    WORDS = (folia.Word, folia.Hiddenword)
+
+    def __init__(self, doc, maxsize=10000):
+        self.doc = doc
+        self.maxsize = maxsize
+        self.entries = OrderedDict() #element ID => (rendered element, element count, ancestor IDs), least recently used first
+        self.lock = threading.Lock()
+        #telemetry
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, element, bookkeeper):
+        """Returns the rendered element if cached (and accounts for it in the bookkeeper), None otherwise"""
+        with self.lock:
+            entry = self.entries.get(element.id)
+            if entry is None or bookkeeper.elementcount + entry[1] > ELEMENTLIMIT:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(element.id)
+            self.hits += 1
+        bookkeeper.elementcount += entry[1]
+        return entry[0]
+
+    def put(self, element, rendered, count):
+        ancestors = frozenset( ancestor.id for ancestor in element.ancestors() if ancestor.id )
+        with self.lock:
+            self.entries[element.id] = (rendered, count, ancestors)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def affected(self, element):
+        """Returns the structure elements whose rendering may be affected by a change to the element, or None if that can not be determined"""
+        if not isinstance(element, folia.AbstractElement) or element.doc is not self.doc:
+            return None
+        root = element
+        while root.parent is not None:
+            root = root.parent
+        if not any(root is e for e in self.doc.data):
+            return None #detached from the document (deleted)
+        if isinstance(element, (folia.AbstractStructureElement, folia.Correction)):
+            structure = [element]
+        else:
+            try:
+                structure = [element.ancestor(folia.AbstractStructureElement)]
+            except folia.NoSuchAnnotation:
+                return None
+        if isinstance(element, folia.AbstractSpanAnnotation):
+            structure += list(element.wrefs())
+        affected = []
+        for e in structure:
+            affected.append(e)
+            #siblings (corrections) and neighbouring words (previousword/nextword) refer to this element
+            affected.append(e.previous(None, None))
+            affected.append(e.next(None, None))
+            if isinstance(e, self.WORDS):
+                first = last = e
+            else:
+                words = list(e.select(self.WORDS))
+                first, last = (words[0], words[-1]) if words else (None, None)
+            if first is not None:
+                affected.append(first.previous(self.WORDS, None))
+            if last is not None:
+                affected.append(last.next(self.WORDS, None))
+        return [ e for e in affected if e is not None ]
+
+    @staticmethod
+    def affectsall(query):
+        """Can the (changing) query affect the rendering of elements beyond those it returns? This is the case for changes to span
+        annotations (rendered along with all structure elements in the scope of their layer) and insertions, deletions and substitutions
+        of structure elements (changing the neighbours of elements that need not be returned)"""
+        for action in changeactions(query):
+            Class = action.focus.Class if action.focus else None
+            if not isinstance(Class, type) or issubclass(Class, (folia.AbstractSpanAnnotation, folia.AbstractAnnotationLayer, folia.AbstractSpanRole)):
+                return True
+            elif issubclass(Class, folia.AbstractStructureElement) and action.action != 'EDIT':
+                return True
+        return False
+
+    def invalidate(self, results, query=None):
+        """Invalidates the entries affected by a change, results is the (list of) changed elements as returned by the query"""
+        if query is not None and self.affectsall(query):
+            self.clear()
+            return
+        elements = flattenresults(results)
+        affectedids = set() #IDs of the affected elements, the entries of their descendants are invalidated too
+        ids = set() #IDs of the affected elements and all their ancestors
+        for element in elements:
+            affected = self.affected(element)
+            if affected is None:
+                self.clear()
+                return
+            for e in affected:
+                if e.id:
+                    affectedids.add(e.id)
+                ids.update( ancestor.id for ancestor in e.ancestors() if ancestor.id )
+        ids |= affectedids
+        with self.lock:
+            for elementid in [ elementid for elementid, entry in self.entries.items() if elementid in ids or not affectedids.isdisjoint(entry[2]) ]:
+                del self.entries[elementid]
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+def jsondumps(data):
+    """Serializes to JSON (as UTF-8 encoded bytes), using the much faster orjson library if it is installed"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass #not supported by orjson (e.g. integers beyond 64 bits), fall back to the standard library
+    return json.dumps(data).encode('utf-8')
+
 def parseresults(results, doc, **kwargs):
+    """Returns the JSON response for FLAT (as bytes)"""
+    return b"".join(iterresults(results, doc, **kwargs))
+
+def iterresults(results, doc, **kwargs):
+    """Generator yielding the JSON response for FLAT (as bytes) in parts, every element is encoded as soon as it has been rendered.
+    Any extra keys (dict) are added to the end of the response.
+
+    Rendering starts at the given start position ((query index, result index), for continuing from a cursor) and stops when the
+    bookkeeper says so; its resume attribute then holds the position to continue from, and the response refers to the given cursor"""
     response = {'version': kwargs['version']} #foliadocserve version
+    docinfo = kwargs.get('docinfo')
+    if docinfo is None or docinfo.doc is not doc:
+        docinfo = DocumentInfo(doc) #nothing precomputed, compute for this request only
     if 'declarations' in kwargs and kwargs['declarations']:
-        response['declarations'] = tuple(getdeclarations(doc))
-        response['provenance'] = getprovenance(doc)
+        response['declarations'] = docinfo.declarations()
+        response['provenance'] = docinfo.provenance()
     if 'setdefinitions' in kwargs and kwargs['setdefinitions']:
-        response['setdefinitions'] =  getsetdefinitions(doc)
+        response['setdefinitions'] =  docinfo.setdefinitions()
         response['failedsetdefinitions'] = doc.failedsetdefinitions
     if 'metadata' in kwargs and kwargs['metadata']:
         response['metadata'] =  getmetadata(doc)
     if 'toc' in kwargs and kwargs['toc']:
-        response['toc'] =  gettoc(doc)
+        response['toc'] =  docinfo.toc()
     if 'textclasses' in kwargs:
         response['textclasses'] = list(doc.textclasses)
     if 'slices' in kwargs and kwargs['slices']:
@@ -113,7 +475,7 @@ def parseresults(results, doc, **kwargs):
         response['slicesize'] = {}
         for tag, size in kwargs['slices']:
             Class = folia.XML2CLASS[tag]
-            response['slices'][tag] = list(getslices(doc, Class, size))
+            response['slices'][tag] = docinfo.slices(Class, size)
             response['slicesize'][tag] = size
     if 'debug' in kwargs and kwargs['debug']:
         debug = True
@@ -125,7 +487,9 @@ def parseresults(results, doc, **kwargs):
         log = lambda s: print(s,file=sys.stderr)
     if debug: log("[Debugging for FLAT result parse enabled]")
 
-    response['rtl'] = isrtl(doc)
+    response['rtl'] = docinfo.rtl()
+
+    rendercache = kwargs.get('rendercache') #RenderCache for the document, if any
 
     if 'customslicesize' in kwargs and kwargs['customslicesize']:
         customslicesize = int(kwargs['customslicesize'])
@@ -133,16 +497,27 @@ def parseresults(results, doc, **kwargs):
         customslicesize = 50
 
 
+    yield jsondumps(response)[:-1] #leave the object open, the elements follow
+    response = {}
+    elementcount = 0
     if results:
-        response['elements'] = []
+        yield b',"elements":['
         if customslicesize:
             response['customslices'] = []
             postponecustomslice = False
 
-    bookkeeper = Bookkeeper() #will abort with partial result if too much data is returned
-    for queryresults in results: #results are grouped per query, we don't care about the origin now
+    bookkeeper = kwargs.get('bookkeeper') or Bookkeeper() #will abort with partial result if too much data is returned
+    startquery, startresult = kwargs.get('start') or (0, 0)
+    resultcount = 0 #results rendered in this response
+    for q, queryresults in enumerate(results): #results are grouped per query, we don't care about the origin now
+        if q < startquery:
+            continue #rendered in an earlier response
         for i, element in enumerate(queryresults):
-            if debug: log("[Processing result from query]")
+            skip = q == startquery and i < startresult #rendered in an earlier response (but still counts for the custom slices)
+            if debug and not skip: log("[Processing result from query]")
+            if not skip and resultcount and not bookkeeper.stop and bookkeeper.exhausted(resultcount):
+                bookkeeper.stop = True
+                bookkeeper.resume = (q, i)
 
             if customslicesize and i % customslicesize == 0 or postponecustomslice: #custom slices of this result set, for pagination of search results
                 if isinstance(element,fql.SpanSet):
@@ -155,49 +530,73 @@ def parseresults(results, doc, **kwargs):
                     response['customslices'].append(id)
                     postponecustomslice = False
 
-            if not bookkeeper.stop:
+            if not bookkeeper.stop and not skip:
+                rendered = [] #rendered element(s) for this result
                 if isinstance(element,fql.SpanSet):
                     for e in element:
                         structure = {}
                         if isinstance(e, (folia.AbstractStructureElement, folia.Correction)):
-                            html, _ = getstructure(e, structure, bookkeeper, debug=debug,log=log)
+                            html, _ = getstructure(e, structure, bookkeeper, debug=debug,log=log, docinfo=docinfo)
                         else:
                             html = None
-                        response['elements'].append({
+                        rendered.append({
                             'elementid': e.id if e.id else None,
                             'html': html,
                             'structure': structure,
-                            'annotations': getannotations(e.doc,structure,debug=debug,log=log),
+                            'annotations': getannotations(e.doc,structure,debug=debug,log=log, docinfo=docinfo),
                         })
                 else:
-                    structure = {}
-                    if isinstance(element, (folia.AbstractStructureElement, folia.Correction)):
-                        html, _ = getstructure(element, structure, bookkeeper, debug=debug,log=log)
-                    else:
-                        html = None
-                    response['elements'].append({
-                        'elementid': element.id if element.id else None,
-                        'html': html,
-                        'structure': structure,
-                        'annotations': getannotations(element.doc,structure,debug=debug,log=log),
-                    })
+                    cacheable = rendercache is not None and element.id and isinstance(element, (folia.AbstractStructureElement, folia.Correction))
+                    cached = rendercache.get(element, bookkeeper) if cacheable else None
+                    if cached is None:
+                        count = bookkeeper.elementcount
+                        structure = {}
+                        if isinstance(element, (folia.AbstractStructureElement, folia.Correction)):
+                            html, _ = getstructure(element, structure, bookkeeper, debug=debug,log=log, docinfo=docinfo)
+                        else:
+                            html = None
+                        cached = {
+                            'elementid': element.id if element.id else None,
+                            'html': html,
+                            'structure': structure,
+                            'annotations': getannotations(element.doc,structure,debug=debug,log=log, docinfo=docinfo),
+                        }
+                        if cacheable and not bookkeeper.stop:
+                            rendercache.put(element, cached, bookkeeper.elementcount - count)
+                    rendered.append(cached)
+                if bookkeeper.stop and bookkeeper.resume is None:
+                    #the element limit was reached whilst rendering this result
+                    if resultcount and kwargs.get('cursor'):
+                        rendered = [] #left out, it is rendered (completely) when continuing
+                        bookkeeper.resume = (q, i)
+                    elif i + 1 < len(queryresults) or any(results[q+1:]):
+                        bookkeeper.resume = (q, i + 1) #the only result in this response, it can never be rendered completely
+                for e in rendered:
+                    yield (b',' if elementcount else b'') + jsondumps(e)
+                    elementcount += 1
+                resultcount += 1
             if bookkeeper.stop:
                 break
         if bookkeeper.elementcount > ELEMENTMEMORYLIMIT:
             raise Exception("Memory limit reached, aborting")
 
+    if results:
+        yield b']'
     response['aborted'] = bookkeeper.stop
+    if kwargs.get('cursor') and bookkeeper.resume is not None:
+        response['cursor'] = kwargs['cursor']
     if 'lastaccess' in kwargs:
         response['sessions'] =  len([s for s in kwargs['lastaccess'] if s != 'NOSID' ])
+    if kwargs.get('extra'):
+        response.update(kwargs['extra'])
 
-    return json.dumps(response).encode('utf-8')
+    yield b',' + jsondumps(response)[1:]
 
 def gethtmltext(element, textclass="current"):
     """Get the text of an element, but maintain markup elements and convert them to HTML"""
 
     checkstrings = folia.AnnotationType.STRING in element.doc.annotationdefaults
 
-    s = ""
     if isinstance(element, folia.Linebreak):
         return "<br/>"
     elif isinstance(element, folia.AbstractTextMarkup): #markup
@@ -248,27 +647,28 @@ def gethtmltext(element, textclass="current"):
             else:
                 cls = element.cls
 
+        parts = []
         if tag:
-            s += "<" + tag
+            parts.append("<" + tag)
             if cls:
-                s += " class=\"" + cls + "\""
+                parts.append(" class=\"" + cls + "\"")
             try:
                 if element.idref:
-                    s += " id=\"strref_" + element.idref + "\""
+                    parts.append(" id=\"strref_" + element.idref + "\"")
             except AttributeError:
                 pass
             if attribs:
-                s += attribs
-            s += ">"
-        s += textcontent2html(element)
+                parts.append(attribs)
+            parts.append(">")
+        parts.append(textcontent2html(element))
         if tag:
-            s += "</" + tag + ">"
-        return s
+            parts.append("</" + tag + ">")
+        return "".join(parts)
     elif isinstance(element, folia.TextContent):
         if checkstrings and element.ancestor(folia.AbstractStructureElement).hasannotation(folia.String) and not any( isinstance(x,folia.TextMarkupString) for x in element):
             linkstrings(element.ancestor(folia.AbstractStructureElement), element.cls)
 
-        s += textcontent2html(element)
+        s = textcontent2html(element)
         #hyperlink
         if element.href:
             return "<a href=\"" + element.href + "\">" + s + "</a>"
@@ -278,72 +678,91 @@ def gethtmltext(element, textclass="current"):
         return gethtmltext(element.textcontent(textclass, hidden=True)) #only explicit text! include hidden text
 
 def textcontent2html(element):
-    s = ""
+    parts = [] #output is joined at the end
+    nonempty = False #has anything non-empty been output yet?
     pendingspace = False
+    preservespace = element.preservespace
     for e in element:
         if folia.isstring(e):
             if pendingspace: #flush the pendingspace buffer
-                s += "\1" #\1 is a temporary marker that translates to &nbsp; later
+                parts.append("\1") #\1 is a temporary marker that translates to &nbsp; later
+                nonempty = True
                 pendingspace = False
             #This implements https://github.com/proycon/folia/issues/88
             #FoLiA >= v2.5 behaviour (introduced earlier in v2.4.1 but modified thereafter)
-            l = len(s)
+            itemoutput = False #has anything been output for this string yet?
             for j, line in enumerate(e.split("\n")):
-                if element.preservespace:
+                if preservespace:
                     s2 = unicodedata.normalize('NFC', line.strip("\r")) #strip only artefacts of DOS-style line endings, leave all intact
                 else:
-                    s2 = unicodedata.normalize('NFC', folia.norm_spaces(line.strip(" \r"))) #strips leading and trailing whitespace per line (proycon/folia#88)
+                    s2 = unicodedata.normalize('NFC', norm_spaces(line.strip(" \r"))) #strips leading and trailing whitespace per line (proycon/folia#88)
                                                         #norm_spaces strips multi-spaces in the middle
                                                         #also strips artefacts of DOS-style line-endings
-                if j > 0 and s2 and len(s) != l:
+                if not s2:
+                    continue
+                if j > 0 and itemoutput:
                     #insert spaces between lines that used to be newline separated
-                    s += " "
-                elif s2 and line and (line[0] != "\n" and folia.is_space(line[0])) and not element.preservespace:
+                    parts.append(" ")
+                elif folia.is_space(line[0]) and not preservespace:
                     #we have leading indentation we may need to collapse or ignore entirely
                     #we can't be sure yet what to do so we add a temporary placeholder \0
                     #this will later be handled in postprocess_spaces() (converts to a space only if no space preceeds it)
-                    s += "\0"
-                s += s2.replace("  ", "\1\1").replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
+                    parts.append("\0")
+                parts.append(s2.replace("  ", "\1\1").replace("&","&amp;").replace("<","&lt;").replace(">","&gt;"))
+                itemoutput = nonempty = True
 
-            if e and folia.is_space(e[-1]) and s and not element.preservespace:
+            if e and folia.is_space(e[-1]) and nonempty and not preservespace:
                 #this item has trailing spaces but we stripped them
                 #this may be premature so
                 #we reserve to output them later in case there is a next item
                 pendingspace = True
         elif e.PRINTABLE:
             if pendingspace:
-                s += "\1" #\1 is a temporary marker that translates to &nbsp; later
+                parts.append("\1") #\1 is a temporary marker that translates to &nbsp; later
+                nonempty = True
                 pendingspace = False
-            if s:
-                s += e.gettextdelimiter().replace("\n","<br/>") #for AbstractMarkup, will usually be "" (but we need it still for <br/>)
-            s += gethtmltext(e)
+            if nonempty:
+                parts.append(e.gettextdelimiter().replace("\n","<br/>")) #for AbstractMarkup, will usually be "" (but we need it still for <br/>)
+            html = gethtmltext(e)
+            if html:
+                parts.append(html)
+                nonempty = True
 
-    if element.preservespace:
-        return s.replace("\1","&nbsp;")
+    if preservespace:
+        return "".join(parts).replace("\1","&nbsp;")
     else:
-        return postprocess_spaces(s)
+        return postprocess_spaces("".join(parts))
+
+def norm_spaces(s):
+    """Equivalent to folia.norm_spaces(), but only checks for control characters (to remove) if the string has unprintable characters at all"""
+    if not s.isprintable():
+        s = "".join(c for c in s if unicodedata.category(c)[0]!="C" or c in ('\n','\t'))
+    return " ".join(s.split())
+
+SPACES = " \n\r\t\u00a0\u1680\u2000\u2001\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000" #as in folia.is_space()
+NULLSPACE = re.compile("(?<=[^" + re.escape(SPACES + "\1") + "])\0") #\0 placeholders that translate to a space (not preceeded by whitespace)
 
 def postprocess_spaces(s):
-    r"""Postprocessing for spaces, translates temporary \0 bytes to spaces if they are are not preceeded by whitespace.
-    This is a HTML-targetted copy of the equivalent function in foliapy"""
-    s2 = ""
-    for i, c in enumerate(s):
-        if c == "\0":
-            if i > 0 and not folia.is_space(s[i-1]) and s[i-1] != "\1" and s[i-1:i+4] != "<br/>" and s[i-1:i+5] != "&nbsp;":
-                s2 += " "
-            #null byte is dropped otherwise
-        elif c == "\1":
-            s2 += "&nbsp;"
-        else:
-            s2 += c
-    return s2
+    r"""Postprocessing for spaces, translates temporary \0 bytes to spaces if they are are not preceeded by whitespace (other \0 bytes are dropped),
+    and \1 bytes to &nbsp;. This is a HTML-targetted copy of the equivalent function in foliapy"""
+    if "\0" in s:
+        s = NULLSPACE.sub(" ", s).replace("\0", "")
+    return s.replace("\1", "&nbsp;")
 
 
 class Bookkeeper:
-    def __init__(self):
+    def __init__(self, deadline=None, limit=0):
         self.elementcount = 0
         self.stop = False
         self.stopat = None
+        self.deadline = deadline #time (as per time.time()) after which no further results are rendered
+        self.limit = limit #maximum number of results to render (0 = unlimited)
+        self.resume = None #position (query index, result index) to continue from when stopped
+        self.interrupted = False #set to stop rendering further results (e.g. because the document changed)
+
+    def exhausted(self, resultcount):
+        """Has the budget for rendering results been used up?"""
+        return bool(self.interrupted or (self.limit and resultcount >= self.limit) or (self.deadline and time.time() > self.deadline))
 
     def reset(self):
         self.stop = False
@@ -357,11 +776,12 @@ def generate_id(element):
     element.doc.index[element.id] = element
     return element.id
 
-def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,log=lambda s: print(s,file=sys.stderr)):
+def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,log=lambda s: print(s,file=sys.stderr), docinfo=None):
     """Converts the element to html skeleton and structure datamodel
 
     HTML is returned, structure is appended to dictionary
     """
+    if docinfo is None: docinfo = DocumentInfo(element.doc)
     if bookkeeper:
         bookkeeper.elementcount += 1
         if bookkeeper.elementcount > ELEMENTLIMIT:
@@ -384,7 +804,7 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
                 try:
                     for child in element.new():
                         if isinstance(child, folia.AbstractStructureElement) or isinstance(child, folia.Correction):
-                            subhtml, _ = getstructure(child, structure, bookkeeper, incorrection=element.id, debug=debug,log=log)
+                            subhtml, _ = getstructure(child, structure, bookkeeper, incorrection=element.id, debug=debug,log=log, docinfo=docinfo)
                             html += subhtml
                 except folia.NoSuchAnnotation:
                     pass
@@ -392,7 +812,7 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
                 try:
                     for child in element.current():
                         if isinstance(child, folia.AbstractStructureElement) or isinstance(child, folia.Correction):
-                            subhtml, _ = getstructure(child, structure, bookkeeper, incorrection=element.id, debug=debug,log=log)
+                            subhtml, _ = getstructure(child, structure, bookkeeper, incorrection=element.id, debug=debug,log=log, docinfo=docinfo)
                             html += subhtml
                 except folia.NoSuchAnnotation:
                     pass
@@ -401,7 +821,7 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
                 try:
                     for child in element.original():
                         if isinstance(child, folia.AbstractStructureElement) or isinstance(child, folia.Correction):
-                            getstructure(child, structure, None, incorrection=element.id, debug=debug,log=log)
+                            getstructure(child, structure, None, incorrection=element.id, debug=debug,log=log, docinfo=docinfo)
                 except folia.NoSuchAnnotation:
                     pass
 
@@ -410,7 +830,7 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
                     try:
                         for child in suggestion:
                             if isinstance(child, folia.AbstractStructureElement) or isinstance(child, folia.Correction):
-                                getstructure(child, structure, None, incorrection=element.id, debug=debug,log=log)
+                                getstructure(child, structure, None, incorrection=element.id, debug=debug,log=log, docinfo=docinfo)
                     except folia.NoSuchAnnotation:
                         pass
 
@@ -422,13 +842,13 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
             for child in element:
                 if isinstance(child, (folia.AbstractStructureElement, folia.Correction)):
                     if bookkeeper and not bookkeeper.stop:
-                        subhtml, newsubids  = getstructure(child, structure, bookkeeper, debug=debug,log=log)
+                        subhtml, newsubids  = getstructure(child, structure, bookkeeper, debug=debug,log=log, docinfo=docinfo)
                         if subhtml: html += subhtml
                         subids += newsubids
                 elif isinstance(child, folia.MorphologyLayer) or isinstance(child, folia.PhonologyLayer):
                     for subchild in child:
                         if bookkeeper and not bookkeeper.stop:
-                            _, newsubids  = getstructure(subchild, structure, bookkeeper, debug=debug,log=log)
+                            _, newsubids  = getstructure(subchild, structure, bookkeeper, debug=debug,log=log, docinfo=docinfo)
                             #ignoring html
                             subids += newsubids
 
@@ -494,12 +914,12 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
             if incorrection:
                 structure[element.id]['incorrection'] = incorrection
             if isinstance(element, (folia.Word, folia.Hiddenword)):
-                prevword = element.previous((folia.Word, folia.Hiddenword),None)
+                prevword = docinfo.neighbours.previous(element, (folia.Word, folia.Hiddenword))
                 if prevword:
                     structure[element.id]['previousword'] =  prevword.id
                 else:
                     structure[element.id]['previousword'] = None
-                nextword = element.next((folia.Word, folia.Hiddenword),None )
+                nextword = docinfo.neighbours.next(element, (folia.Word, folia.Hiddenword))
                 if nextword:
                     structure[element.id]['nextword'] =  nextword.id
                 else:
@@ -514,30 +934,51 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
     raise Exception("Structure element expected, got " + str(type(element)))
 
 
-def getannotations(doc, structure, annotations = None,debug=False,log=lambda s: print(s,file=sys.stderr)):
+def getannotations(doc, structure, annotations = None,debug=False,log=lambda s: print(s,file=sys.stderr), docinfo=None):
     if not annotations: annotations = {}
+    if docinfo is None: docinfo = DocumentInfo(doc)
     processed = set() #processed elements
+    suggestionindex = {} #shared by all structure elements in this render, see getsuggestionindex()
     for id in structure:
         e = doc[id]
         processed.add(id)
-        getannotations_in(e, structure, annotations, debug=debug,log=log)
+        getannotations_in(e, structure, annotations, debug=debug,log=log, suggestionindex=suggestionindex, docinfo=docinfo)
         if isinstance(e, (folia.Word, folia.Hiddenword)) and e.parent:
             p = e.parent
             while p is not None:
                 if isinstance(p, folia.AbstractStructureElement) and p.id and p.id not in structure and p.id not in processed:
                     processed.add(p.id)
                     #do we have span annotations?
-                    if p.hasannotationlayer():
+                    if docinfo.spans.hasannotationlayer(p):
                         #yes, process them
-                        getannotations_in(p, structure, annotations, debug=debug,log=log, spanonly=True)
+                        getannotations_in(p, structure, annotations, debug=debug,log=log, spanonly=True, suggestionindex=suggestionindex, docinfo=docinfo)
                 p = p.parent
 
     return annotations
 
-def getannotations_in(parentelement, structure, annotations, incorrection=None, inalternative=None,auth=True, debug=False,log=lambda s: print(s,file=sys.stderr),idprefix=None, spanonly=False):
+def getsuggestionindex(structureelement, suggestionindex):
+    """Returns an index of the corrections (in document order) in the structure element that have suggestions, by the class and set of the
+    annotations in those suggestions. It is built in a single pass and memoized in suggestionindex (a dict) for the duration of a render"""
+    key = id(structureelement)
+    if key not in suggestionindex:
+        index = {} #(annotation class, set) => [corrections]
+        for c in structureelement.select(folia.Correction):
+            if c.hassuggestions():
+                covered = set()
+                for suggestion in c.suggestions():
+                    for sa in suggestion:
+                        if isinstance(sa, folia.AbstractElement) and (sa.__class__, sa.set) not in covered:
+                            covered.add((sa.__class__, sa.set))
+                            index.setdefault((sa.__class__, sa.set), []).append(c)
+        suggestionindex[key] = (structureelement, index) #holding on to the element keeps its id() unique
+    return suggestionindex[key][1]
+
+def getannotations_in(parentelement, structure, annotations, incorrection=None, inalternative=None,auth=True, debug=False,log=lambda s: print(s,file=sys.stderr),idprefix=None, spanonly=False, suggestionindex=None, docinfo=None):
     """Get annotations in the specified parentelement and add them to the annotations dictionary (passed as argument).
     Structure dictionary is also passed and references for all found annotations are made."""
 
+    if suggestionindex is None: suggestionindex = {}
+    if docinfo is None: docinfo = DocumentInfo(parentelement.doc)
     idlist = []
     checkstrings = folia.AnnotationType.STRING in parentelement.doc.annotationdefaults
     if isinstance(parentelement, (folia.AbstractStructureElement, folia.String)):
@@ -599,7 +1040,7 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
         processed = False
         if isinstance(element, folia.Correction):
             processed = True
-            getannotations_correction(element,structure,annotations, auth=auth, log=log,debug=debug)
+            getannotations_correction(element,structure,annotations, auth=auth, log=log,debug=debug, suggestionindex=suggestionindex, docinfo=docinfo)
             if auth and structureelement.id in structure:
                 structure[structureelement.id]['annotations'].append(extid) #link structure to annotations
         elif isinstance(element, folia.Alternative):
@@ -608,7 +1049,7 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
             annotations[extid]['targets'] = [ structureelement.id ]
             annotations[extid]['scope'] = [ structureelement.id ]
             annotations[extid]['children'] = {} #reset, prevent duplication, annotations are gather under 'annotations' instead by the next line:
-            subids = getannotations_in(element,structure,annotations, inalternative=element.id, auth=False,debug=debug,log=log,idprefix=element.id)
+            subids = getannotations_in(element,structure,annotations, inalternative=element.id, auth=False,debug=debug,log=log,idprefix=element.id, suggestionindex=suggestionindex, docinfo=docinfo)
             annotations[extid]['annotations'] = subids
             if auth and structureelement.id in structure:
                 structure[structureelement.id]['annotations'].append(extid) #link structure to annotations
@@ -626,19 +1067,9 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
                 if any( isinstance(x,(folia.AbstractTextMarkup, folia.Linebreak)) for x in element) or checkstrings:
                     annotations[extid]['htmltext'] = gethtmltext(element,element.cls)
             #See if there is a correction element with only suggestions pertaining to this annotation, link to it using 'hassuggestions':
-            for c in structureelement.select(folia.Correction):
-                if c.hassuggestions():
-                    #Do the suggestions describe this annotation type?
-                    hassuggestions = False
-                    for suggestion in c.suggestions():
-                        for sa in suggestion:
-                            if sa.__class__ is element.__class__ and sa.set == element.set:
-                                hassuggestions = True
-                                break #one is enough
-                        if hassuggestions: break #one is enough
-                    if hassuggestions:
-                        if not 'hassuggestions' in annotations[extid]: annotations[extid]['hassuggestions'] = []
-                        annotations[extid]['hassuggestions'].append(c.id)
+            for c in getsuggestionindex(structureelement, suggestionindex).get((element.__class__, element.set), ()):
+                if not 'hassuggestions' in annotations[extid]: annotations[extid]['hassuggestions'] = []
+                annotations[extid]['hassuggestions'].append(c.id)
         elif isinstance(element, folia.AbstractSpanAnnotation) and not isinstance(element, folia.AbstractSpanRole):
             processed = True
             if not element.id and ((element.REQUIRED_ATTRIBS and folia.Attrib.ID in element.REQUIRED_ATTRIBS) or (element.OPTIONAL_ATTRIBS and folia.Attrib.ID in element.OPTIONAL_ATTRIBS)):
@@ -657,8 +1088,8 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
             annotations[extid] = element.json(ignorelist=folia.wrefables) #don't descend into words (do descend for nested span annotations)
             if 'set' not in annotations[extid]: annotations[extid]['set'] = None #translates to null
             annotations[extid]['span'] = True
-            annotations[extid]['targets'] = [ x.id for x in element.wrefs(recurse=False) ]
-            scope =  list(element.wrefs(recurse=True))
+            targets, scope = docinfo.spans.wrefs(element)
+            annotations[extid]['targets'] = [ x.id for x in targets ]
             annotations[extid]['scope'] = [ x.id for x in scope ]
             if auth:
                 for x in scope:
@@ -674,14 +1105,12 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
                             assert role.XMLTAG == child['type']
                             #set targets
                             child['isspanrole'] = True
-                            child['targets'] = [x.id for x in role.wrefs(recurse=False)]
-                            child['scope'] = [x.id for x in role.wrefs(recurse=True)]
-            layerparent = element.ancestor(folia.AbstractAnnotationLayer).ancestor(folia.AbstractStructureElement).id
-            try:
-                parentspan = element.ancestor(folia.AbstractSpanAnnotation)
-                annotations[extid]['parentspan'] = parentspan.id
-            except folia.NoSuchAnnotation:
-                annotations[extid]['parentspan'] = None
+                            roletargets, rolescope = docinfo.spans.wrefs(role)
+                            child['targets'] = [x.id for x in roletargets]
+                            child['scope'] = [x.id for x in rolescope]
+            layerparent, parentspan = docinfo.spans.ancestors(element)
+            layerparent = layerparent.id
+            annotations[extid]['parentspan'] = parentspan.id if parentspan is not None else None
             annotations[extid]['layerparent'] = layerparent
             if auth:
                 if layerparent in structure:
@@ -701,7 +1130,7 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
 
         if isinstance(element, ( folia.AbstractAnnotationLayer, folia.AbstractSpanAnnotation, folia.Suggestion, folia.String)):
             #descend into nested annotations
-            subidlist = getannotations_in(element,structure, annotations,debug=debug,log=log)
+            subidlist = getannotations_in(element,structure, annotations,debug=debug,log=log, suggestionindex=suggestionindex, docinfo=docinfo)
 
             if processed:
                 annotations[extid]['annotations'] = subidlist
@@ -713,7 +1142,8 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
 
     return idlist
 
-def getannotations_correction(element, structure, annotations, debug=False,log=lambda s: print(s,file=sys.stderr), auth=True):
+def getannotations_correction(element, structure, annotations, debug=False,log=lambda s: print(s,file=sys.stderr), auth=True, suggestionindex=None, docinfo=None):
+    if docinfo is None: docinfo = DocumentInfo(element.doc)
     correction_new = []
     correction_current = []
     correction_original = []
@@ -744,7 +1174,7 @@ def getannotations_correction(element, structure, annotations, debug=False,log=l
             pass
 
     if element.hasnew():
-        subids = getannotations_in(element.new(),structure,annotations, incorrection=element.id,auth=auth,debug=debug,log=log,idprefix=element.id + '/new')
+        subids = getannotations_in(element.new(),structure,annotations, incorrection=element.id,auth=auth,debug=debug,log=log,idprefix=element.id + '/new', suggestionindex=suggestionindex, docinfo=docinfo)
         if correction_structure:
             for child in element.new():
                 if isinstance(child,folia.AbstractStructureElement):
@@ -756,7 +1186,7 @@ def getannotations_correction(element, structure, annotations, debug=False,log=l
         #empty new, this is deletion
         correction_special_type = 'deletion'
     if element.hascurrent():
-        subids = getannotations_in(element.current(),structure,annotations, incorrection=element.id,auth=auth,debug=debug,log=log,idprefix=element.id + '/current')
+        subids = getannotations_in(element.current(),structure,annotations, incorrection=element.id,auth=auth,debug=debug,log=log,idprefix=element.id + '/current', suggestionindex=suggestionindex, docinfo=docinfo)
         try:
             if correction_structure:
                 for child in element.current():
@@ -768,7 +1198,7 @@ def getannotations_correction(element, structure, annotations, debug=False,log=l
         except folia.NoSuchAnnotation:
             pass
     if element.hasoriginal():
-        subids = getannotations_in(element.original(),structure,annotations, incorrection=element.id, auth=False,debug=debug,log=log,idprefix=element.id + '/original')
+        subids = getannotations_in(element.original(),structure,annotations, incorrection=element.id, auth=False,debug=debug,log=log,idprefix=element.id + '/original', suggestionindex=suggestionindex, docinfo=docinfo)
         if correction_structure:
             for child in element.original():
                 if isinstance(child,folia.AbstractStructureElement):
@@ -792,7 +1222,7 @@ def getannotations_correction(element, structure, annotations, debug=False,log=l
             if suggestion.split:
                 correction_split = suggestion.split.split(' ')
 
-            subids = getannotations_in(suggestion,structure,annotations, incorrection=element.id, auth=False,debug=debug,log=log,idprefix=element.id+'/suggestion.' + str(i+1))
+            subids = getannotations_in(suggestion,structure,annotations, incorrection=element.id, auth=False,debug=debug,log=log,idprefix=element.id+'/suggestion.' + str(i+1), suggestionindex=suggestionindex, docinfo=docinfo)
             if correction_structure:
                 subids = []
                 for child in suggestion:
@@ -824,14 +1254,14 @@ def getannotations_correction(element, structure, annotations, debug=False,log=l
 
     annotations[element.id]['previous'] = None
     try:
-        previous = element.previous(None,None)
+        previous = docinfo.neighbours.previous(element)
         if isinstance(previous, folia.Correction): previous = next(previous.select(folia.AbstractStructureElement))
         if previous: annotations[element.id]['previous'] =  previous.id
     except StopIteration:
         pass
     annotations[element.id]['next'] = None
     try:
-        successor = element.next(None,None )
+        successor = docinfo.neighbours.next(element)
         if isinstance(successor, folia.Correction): successor = next(successor.select(folia.AbstractStructureElement))
         if successor: annotations[element.id]['next'] =  successor.id
     except StopIteration:
@@ -32,14 +32,28 @@ import datetime
 import shutil
 import queue
 import re
-from collections import defaultdict
+import io
+import pickle
+import zlib
+import hashlib
+import functools
+import itertools
+import bisect
+import secrets
+import fcntl
+import signal
+import urllib.request
+import urllib.error
+import urllib.parse
+from collections import defaultdict, deque, OrderedDict
 from socket import getfqdn
+from lxml import etree
 import cherrypy
 from jinja2 import Environment, FileSystemLoader
 from folia import fql
 import folia.main as folia
 from pynlpl.formats import cql
-from foliadocserve.flat import parseresults, getflatargs
+from foliadocserve.flat import parseresults, iterresults, getflatargs, RenderCache, DocumentInfo, Bookkeeper
 from foliadocserve.test import test
 from foliatools.foliatextcontent import cleanredundancy
 from foliatools.foliaupgrade import upgrade
@@ -53,10 +67,20 @@ def fake_wait_for_occupied_port(host, port): return
 class NoSuchDocument(Exception):
     pass
 
+class LockTimeout(cherrypy.HTTPError):
+    """Raised when a document lock can not be acquired within the lock timeout, reaches the client as HTTP 423 (Locked)"""
+    def __init__(self, key, timeout):
+        self.key = key
+        super().__init__(423, "Document " + "/".join(key) + " is locked by another request, unable to acquire lock within " + str(timeout) + "s")
+
 
 VERSION = "0.7.8"
 PROCESSOR_FOLIADOCSERVE = "PROCESSOR name \"foliadocserve\" version \"" + VERSION + "\" host \"" +getfqdn() + "\" folia_version \"" + folia.FOLIAVERSION + "\" src \"https://github.com/proycon/foliadocserve\""
 
+#Matches comments, CDATA, processing instructions/doctype (no groups) and tags (closing slash, tag name, attributes, self-closing slash) in raw XML
+XMLTAG = re.compile(rb'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<[?!][^>]*>|<(/?)([^\s/>]+)((?:[^>"\']|"[^"]*"|\'[^\']*\')*?)(/?)>', re.DOTALL)
+XMLID = re.compile(rb'xml:id\s*=\s*(["\'])(.*?)\1')
+
 logfile = None
 def log(msg):
     if logfile:
@@ -64,28 +88,71 @@ def log(msg):
         logfile.flush()
 
 
-def parsegitlog(data):
-    commit = None
-    date = None
-    msg = None
-    for line in data.split("\n"):
-        line = line.strip()
-        if line[0:6] == 'commit':
-            #yield previous
-            if commit and date and msg:
-                yield commit, date, msg
-            commit = line[7:]
-            msg = None
-            date = None
-        elif line[0:7] == 'Author:':
-            pass
-        elif line[0:5] == 'Date:':
-            date = line[6:].strip()
-        elif line:
-            msg = line
-    if commit and date and msg:
-        yield commit, date, msg
+compressmin = 1024 #responses of at least this size (bytes) are compressed if the client accepts it, -1 = never
+CODINGS = {'gzip': 31, 'deflate': 15} #supported content codings => zlib wbits
+STREAMSIZE = 1024 * 1024 #assumed size (bytes) of responses that are rendered while they are sent, for choosing the compression level
+STREAMBATCH = 256 * 1024 #such responses are rendered in batches of about this size (bytes), the document is only locked whilst rendering a batch
+
+def acceptencoding():
+    """Returns the content coding to compress the response with, as negotiated through the Accept-Encoding request header, or None"""
+    if compressmin < 0:
+        return None
+    for element in cherrypy.request.headers.elements('Accept-Encoding'): #sorted by preference
+        if element.qvalue <= 0:
+            continue
+        if element.value in CODINGS:
+            return element.value
+        elif element.value == '*':
+            return 'gzip'
+        elif element.value == 'identity':
+            return None
+    return None
+
+def compresslevel(size):
+    """Returns the compression level for a response of the given size, large responses favour speed over ratio"""
+    if size < 1024 * 1024:
+        return 6
+    elif size < 16 * 1024 * 1024:
+        return 3
+    else:
+        return 1
+
+def compress(data, coding):
+    compressor = zlib.compressobj(compresslevel(len(data)), zlib.DEFLATED, CODINGS[coding])
+    return compressor.compress(data) + compressor.flush()
+
+def compressstream(chunks, coding, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, CODINGS[coding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def compressresponse(body, size=None):
+    """Compresses the response body (a string, bytes, or a generator of bytes with the given total size) if the client accepts a supported content coding, sets the response headers accordingly"""
+    cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+    if 'Content-Encoding' in cherrypy.response.headers: #already compressed
+        return body
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if isinstance(body, bytes):
+        size = len(body)
+    coding = acceptencoding()
+    if coding is None or size is None or size < compressmin:
+        return body
+    cherrypy.response.headers['Content-Encoding'] = coding
+    if isinstance(body, bytes):
+        return compress(body, coding)
+    else:
+        return compressstream(body, coding, compresslevel(size))
 
+def compressible(handler):
+    """Decorator for request handlers whose responses may be compressed"""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        return compressresponse(handler(*args, **kwargs))
+    return wrapper
 
 
 def cleantextredundancy(element):
@@ -148,7 +215,7 @@ class BackgroundTaskQueue(cherrypy.process.plugins.SimplePlugin):
         self.q.put((func, args, kwargs))
 
 class AutoUnloader(cherrypy.process.plugins.SimplePlugin):
-    """Calls docstore.autounload() every tick"""
+    """Calls docstore.autounload() every tick, ticks faster when the document store is under memory pressure"""
 
     thread = None
     def __init__(self, bus, docstore, interval=60):
@@ -175,15 +242,646 @@ class AutoUnloader(cherrypy.process.plugins.SimplePlugin):
     def run(self):
         while self.running:
             self.docstore.autounload()
+            pressure = self.docstore.memorypressure()
+            if pressure >= 0.9:
+                interval = max(1, self.interval // 4)
+            elif pressure >= 0.75:
+                interval = max(1, self.interval // 2)
+            else:
+                interval = self.interval
             i = 0
-            while self.running and i < self.interval:
+            while self.running and i < interval:
                 time.sleep(1)
                 i+=1
 
 
+class SaveScheduler(cherrypy.process.plugins.SimplePlugin):
+    """Dispatches pending (write-behind) saves of the document store to the background task queue once they are due"""
+
+    thread = None
+    def __init__(self, bus, docstore, bgtask, interval=0.25):
+        self.docstore = docstore
+        self.bgtask = bgtask
+        self.interval = interval
+        cherrypy.process.plugins.SimplePlugin.__init__(self, bus)
+
+    def start(self):
+        self.running = True
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.start()
+
+    def stop(self):
+        self.bus.log("Stopping SaveScheduler")
+        self.running = False
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        for key in list(self.docstore.pendingsaves):
+            self.docstore.flushsave(key)
+
+    def run(self):
+        while self.running:
+            for key, message in self.docstore.duesaves():
+                self.bgtask.put(self.docstore.save, key, message)
+            time.sleep(self.interval)
+
+
+class ReplicaFeed(cherrypy.process.plugins.SimplePlugin):
+    """Follows the change feed of the primary and applies the changes to the documents loaded in the document store (replica mode)"""
+
+    thread = None
+    def __init__(self, bus, docstore, primary, polltimeout=30):
+        self.docstore = docstore
+        self.primary = primary
+        self.polltimeout = polltimeout
+        self.seq = None #sequence number of the last change applied
+        self.primaryseq = 0 #latest sequence number reported by the primary
+        self.syncedat = 0 #time at which the replica was last known to be up to date
+        self.listening = False #is a request in flight that was issued whilst up to date? (the primary answers it as soon as something changes)
+        self.latency = 0 #time between the last change on the primary and its application on the replica (seconds)
+        self.condition = threading.Condition()
+        cherrypy.process.plugins.SimplePlugin.__init__(self, bus)
+
+    def start(self):
+        self.running = True
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, daemon=True) #may be blocked in a request to the primary
+            self.thread.start()
+
+    def stop(self):
+        self.bus.log("Stopping ReplicaFeed")
+        self.running = False
+        self.thread = None
+
+    def staleness(self):
+        """Upper bound on how far (in seconds) the replica lags behind the primary"""
+        with self.condition:
+            if self.listening:
+                return 0
+            return time.time() - self.syncedat
+
+    def waitsync(self, maxlag, timeout):
+        """Waits until the replica lags no more than maxlag seconds behind the primary, returns a boolean"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.listening or time.time() - self.syncedat <= maxlag, timeout)
+
+    def stats(self):
+        return {
+            'role': 'replica',
+            'primary': self.primary,
+            'seq': self.seq,
+            'primaryseq': self.primaryseq,
+            'behind': self.primaryseq - (self.seq or 0),
+            'staleness': round(self.staleness(),3),
+            'latency': round(self.latency,3),
+        }
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                self.listening = self.seq is not None and self.seq >= self.primaryseq
+                self.condition.notify_all()
+            try:
+                since = self.seq if self.seq is not None else -1
+                with urllib.request.urlopen(self.primary + "/changes?since=" + str(since) + "&timeout=" + str(self.polltimeout), timeout=self.polltimeout + 30) as f:
+                    response = json.loads(f.read())
+            except urllib.error.HTTPError as e:
+                if e.code == 501:
+                    #the primary runs with --workers, it has no single change feed; we would serve stale documents forever
+                    log("ERROR: The primary " + self.primary + " does not offer a change feed (it runs with --workers), replicating it is not supported. Stopping")
+                    self.running = False
+                    os.kill(os.getpid(), signal.SIGTERM)
+                    return
+                log("ERROR: Unable to obtain changes from primary " + self.primary + ": [" + e.__class__.__name__ + "] " + str(e))
+                with self.condition:
+                    self.listening = False
+                time.sleep(1)
+                continue
+            except Exception as e: #pylint: disable=broad-except
+                log("ERROR: Unable to obtain changes from primary " + self.primary + ": [" + e.__class__.__name__ + "] " + str(e))
+                with self.condition:
+                    self.listening = False
+                time.sleep(1)
+                continue
+            entries = response.get('entries')
+            with self.condition:
+                if self.listening and entries:
+                    self.syncedat = entries[0]['t'] #we were up to date until the first of these changes was made
+                self.listening = False
+            if entries is None:
+                #(re)start: documents loaded may be out of date
+                if self.seq is not None:
+                    log("Replica fell behind the change feed of the primary, unloading all documents")
+                for key in list(self.docstore.data.keys()):
+                    self.docstore.unload(key, save=False)
+                self.seq = response['seq']
+            else:
+                for entry in entries:
+                    try:
+                        self.docstore.applychange(entry)
+                    except Exception as e: #pylint: disable=broad-except
+                        log("ERROR: Unable to apply change " + str(entry['seq']) + " on " + "/".join(entry['key']) + ", unloading document: [" + e.__class__.__name__ + "] " + str(e))
+                        self.docstore.unload(tuple(entry['key']), save=False)
+                    self.seq = entry['seq']
+                    self.latency = time.time() - entry['t']
+            with self.condition:
+                self.primaryseq = max(self.primaryseq, response['seq'])
+                if self.seq >= self.primaryseq:
+                    self.syncedat = time.time()
+                self.condition.notify_all()
+
+
+class GitWorker:
+    """Performs all git operations on a single repository in a dedicated thread, so they do not block saves.
+    Commits of documents that arrive within a short time window are batched into a single commit."""
+
+    def __init__(self, repodir, init=False, share=None, window=2.0):
+        self.repodir = repodir
+        self.share = share
+        self.window = window #time window (seconds) in which changes are grouped into one commit
+        self.q = queue.Queue()
+        self.lock = threading.Lock() #held during git operations
+        self.hashes = {} #filename => sha1 of the last committed contents, to skip commits that change nothing
+        self.history = {} #filename => [ {'commit': commithash, 'date': date, 'msg': message} ], oldest first; built lazily
+        self.historypos = {} #filename => { commithash: index in history }
+        self.initialised = not init
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def git(self, *args):
+        """Runs a git command in the repository, returns a (returncode, output) tuple"""
+        proc = subprocess.run(("git",) + args, cwd=self.repodir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False)
+        return proc.returncode, proc.stdout.decode('utf-8', errors='replace')
+
+    def commit(self, filename, message="", remove=False):
+        """Queues a commit of the given file"""
+        self.q.put( (filename, message, remove) )
+
+    def flush(self):
+        """Blocks until all queued commits have been performed"""
+        self.q.join()
+
+    def stop(self):
+        self.q.put(None)
+        self.thread.join()
+
+    def run(self):
+        running = True
+        while running:
+            item = self.q.get()
+            if item is None:
+                self.q.task_done()
+                break
+            batch = [item]
+            deadline = time.time() + self.window
+            while True:
+                try:
+                    item = self.q.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    self.q.task_done()
+                    break
+                batch.append(item)
+            try:
+                self.commitbatch(batch)
+            except Exception as e: #pylint: disable=broad-except
+                log("ERROR during git commit in " + self.repodir + ": [" + e.__class__.__name__ + "] " + str(e))
+            finally:
+                for _ in batch:
+                    self.q.task_done()
+
+    def repolock(self):
+        """Returns an open lock file for the repository, locked exclusively, so that other processes (see --workers) do not commit at the same time. Closing it releases the lock."""
+        f = open(os.path.join(self.repodir, '.git', 'foliadocserve.lock'), 'w')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def contenthash(self, filename):
+        with open(filename,'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def commitbatch(self, batch):
+        with self.lock:
+            if not self.initialised:
+                log("Initialising git repository in  " + self.repodir)
+                r, out = self.git("init", "--shared=" + self.share) if self.share else self.git("init")
+                if r != 0:
+                    log("ERROR during git init of " + self.repodir + ": " + out)
+                    return
+                self.initialised = True
+            with self.repolock():
+                self.commitchanges(batch)
+
+    def commitchanges(self, batch):
+        """Commits the batch, should be called whilst holding both locks"""
+        #group the batch per file, the last action on a file determines what is committed
+        changes = OrderedDict() #filename => (remove, [message])
+        for filename, message, remove in batch:
+            lines = changes[filename][1] if filename in changes else []
+            for line in message.split("\n"):
+                if line and line not in lines:
+                    lines.append(line)
+            changes[filename] = (remove, lines)
+        messages = OrderedDict() #filename => [message] for all files that are committed
+        for filename, (remove, lines) in changes.items():
+            if remove:
+                r, out = self.git("rm", "-q", "--cached", "--ignore-unmatch", filename)
+                self.hashes.pop(filename, None)
+                self.history.pop(filename, None)
+                self.historypos.pop(filename, None)
+            elif not os.path.exists(filename):
+                continue #removed again in the meantime
+            else:
+                contenthash = self.contenthash(filename)
+                if self.hashes.get(filename) == contenthash:
+                    continue #contents did not change since the last commit
+                r, out = self.git("add", filename)
+                if r == 0:
+                    self.hashes[filename] = contenthash
+            if r != 0:
+                log("ERROR during git " + ("rm" if remove else "add") + " of " + filename + " in " + self.repodir + ": " + out)
+                continue
+            messages[filename] = lines
+        if not messages:
+            return
+        if self.git("diff", "--cached", "--quiet")[0] == 0:
+            log("Nothing to commit in " + self.repodir)
+            return
+        if len(messages) == 1:
+            message = "\n".join(next(iter(messages.values())))
+        else:
+            message = "Changes to " + str(len(messages)) + " documents\n\n" + "\n".join( os.path.basename(filename) + ": " + " -- ".join(lines) for filename, lines in messages.items() )
+        log("Doing git commit in " + self.repodir + " for " + ", ".join(messages) + " -- " + message.replace("\n", " -- "))
+        r, out = self.git("commit", "-q", "-m", message or "Updated document")
+        if r != 0:
+            log("ERROR during git commit in " + self.repodir + ": " + out)
+        else:
+            self.indexcommit(messages)
+
+    def revert(self, filename, commithash):
+        """Reverts the file to the state of the specified commit and commits the result, returns a boolean"""
+        self.flush()
+        with self.lock, self.repolock():
+            r, out = self.git("checkout", commithash, "--", filename)
+            if r == 0:
+                r, out = self.git("commit", "-q", "-m", "Reverting to commit " + commithash)
+            if r != 0:
+                log("Error during git revert of " + filename + ": " + out)
+                return False
+            self.hashes[filename] = self.contenthash(filename)
+            self.indexcommit([filename])
+            return True
+
+    @staticmethod
+    def summary(message, filename):
+        """Returns the part of a commit message that describes the specified file"""
+        prefix = os.path.basename(filename) + ": "
+        lines = [ line.strip() for line in message.split("\n") if line.strip() ]
+        for line in lines:
+            if line.startswith(prefix): #batched commit
+                return line[len(prefix):]
+        return lines[-1] if lines else ""
+
+    def addtohistory(self, filename, commit, date, message):
+        self.historypos[filename][commit] = len(self.history[filename])
+        self.history[filename].append({'commit': commit, 'date': date, 'msg': self.summary(message, filename)})
+
+    def buildhistory(self, filename):
+        """Builds the history index for the specified file from git log, should be called whilst holding the lock"""
+        self.history[filename] = []
+        self.historypos[filename] = {}
+        r, out = self.git("log", "--format=%H%x1f%ad%x1f%B%x1e", "--", filename)
+        if r != 0:
+            log("git log errors? " + out)
+            return
+        for record in reversed(out.split("\x1e")):
+            if record.strip():
+                commit, date, message = record.strip("\n").split("\x1f", 2)
+                self.addtohistory(filename, commit, date, message)
+
+    def indexcommit(self, filenames):
+        """Adds the latest commit to the history indices of the specified files (only if they are already indexed), should be called whilst holding the lock"""
+        r, out = self.git("log", "-1", "--format=%H%x1f%ad%x1f%B")
+        if r != 0:
+            return
+        commit, date, message = out.strip("\n").split("\x1f", 2)
+        for filename in filenames:
+            if filename in self.history:
+                self.addtohistory(filename, commit, date, message)
+
+    def gethistory(self, filename, offset=0, limit=0, since=None):
+        """Returns a (total, entries) tuple with the history of the specified file, newest first.
+        If since is set to a commit hash, only newer commits are considered"""
+        self.flush()
+        with self.lock:
+            if filename not in self.history:
+                self.buildhistory(filename)
+            history = self.history[filename]
+            first = 0
+            if since:
+                if since not in self.historypos[filename]:
+                    raise KeyError(since)
+                first = self.historypos[filename][since] + 1
+            end = len(history) - offset
+            begin = max(first, end - limit) if limit else first
+            return len(history) - first, [ history[i] for i in range(end - 1, begin - 1, -1) ]
+
+
+class DocumentLock:
+    """Shared/exclusive lock for a single document.
+
+    Waiting threads are granted the lock in FIFO order; consecutive shared waiters are granted together, but a
+    shared request never overtakes an earlier exclusive one (so writers do not starve). The lock is reentrant
+    for threads that already hold it, in whatever mode they hold it; a thread holding it shared can not upgrade to exclusive."""
+
+    def __init__(self, mutex):
+        self.condition = threading.Condition(mutex)
+        self.holders = {} #thread ident => recursion depth
+        self.exclusive = False #mode of the current holders
+        self.waiting = deque() #(thread ident, shared) of waiters, in order of arrival
+        self.acquiredat = {} #thread ident => time
+
+        #telemetry
+        self.acquisitions = 0
+        self.sharedacquisitions = 0
+        self.contended = 0 #number of acquisitions that had to wait
+        self.timeouts = 0
+        self.waittime = 0.0
+        self.maxwaittime = 0.0
+        self.holdtime = 0.0
+        self.maxholdtime = 0.0
+
+    def grantable(self, ident, shared):
+        """Can the waiter with the specified thread ident be granted the lock now?"""
+        if self.holders and (self.exclusive or not shared):
+            return False
+        for waiter, waitershared in self.waiting:
+            if waiter == ident:
+                break
+            if not (shared and waitershared):
+                return False #somebody ahead of us in the queue needs to go first
+        return True
+
+    def stats(self):
+        return {
+            'locked': "exclusive" if self.holders and self.exclusive else "shared" if self.holders else False,
+            'holders': len(self.holders),
+            'waiting': len(self.waiting),
+            'acquisitions': self.acquisitions,
+            'sharedacquisitions': self.sharedacquisitions,
+            'contended': self.contended,
+            'timeouts': self.timeouts,
+            'waittime': round(self.waittime,6),
+            'maxwaittime': round(self.maxwaittime,6),
+            'holdtime': round(self.holdtime,6),
+            'maxholdtime': round(self.maxholdtime,6),
+        }
+
+
+class LockManager:
+    """Per-document locks for the document store; loading, saving, unloading and querying a document are blocking operations"""
+
+    def __init__(self, timeout=60, debug=0):
+        self.mutex = threading.Lock() #protects the lock table and all lock states
+        self.locks = {} # (namespace,docid) => DocumentLock
+        self.timeout = timeout #default timeout in seconds, 0 or None waits indefinitely
+        self.debug = debug
+
+    def acquire(self, key, timeout=None, shared=False):
+        """Acquire the lock for the given document, raises LockTimeout if it can not be obtained in time.
+        Shared locks are for read-only access and may be held by multiple threads at once."""
+        if timeout is None:
+            timeout = self.timeout
+        me = threading.get_ident()
+        with self.mutex:
+            lock = self.locks.get(key)
+            if lock is None:
+                lock = self.locks[key] = DocumentLock(self.mutex)
+            if me in lock.holders:
+                if not shared and not lock.exclusive:
+                    #upgrading would race with the other readers (and deadlock with another thread upgrading), so fail loudly
+                    raise RuntimeError("Exclusive lock on " + "/".join(key) + " requested by a thread that holds it shared")
+                #reentrant, an exclusive holder keeps its exclusive lock
+                lock.holders[me] += 1
+                return
+            begin = time.time()
+            lock.waiting.append((me, shared))
+            try:
+                if not lock.grantable(me, shared):
+                    if self.debug >= 2: log("[waiting for " + ("shared" if shared else "exclusive") + " lock " + "/".join(key)+"]")
+                    lock.contended += 1
+                    deadline = begin + timeout if timeout else None
+                    while not lock.grantable(me, shared):
+                        remaining = deadline - time.time() if deadline else None
+                        if remaining is not None and remaining <= 0:
+                            lock.timeouts += 1
+                            log("Timeout waiting for lock on " + "/".join(key) + " after " + str(timeout) + "s")
+                            raise LockTimeout(key, timeout)
+                        lock.condition.wait(remaining)
+            finally:
+                lock.waiting.remove((me, shared))
+                lock.condition.notify_all() #the head of the queue changed
+            lock.holders[me] = 1
+            lock.exclusive = not shared
+            lock.acquiredat[me] = time.time()
+            waited = lock.acquiredat[me] - begin
+            lock.acquisitions += 1
+            if shared: lock.sharedacquisitions += 1
+            lock.waittime += waited
+            lock.maxwaittime = max(lock.maxwaittime, waited)
+        if self.debug >= 2: log("[acquired " + ("shared" if shared else "exclusive") + " lock " + "/".join(key)+"]")
+
+    def release(self, key):
+        me = threading.get_ident()
+        with self.mutex:
+            lock = self.locks.get(key)
+            if lock is None or me not in lock.holders:
+                raise RuntimeError("Releasing lock on " + "/".join(key) + " that is not held by this thread")
+            lock.holders[me] -= 1
+            if lock.holders[me] == 0:
+                held = time.time() - lock.acquiredat.pop(me)
+                del lock.holders[me]
+                lock.holdtime += held
+                lock.maxholdtime = max(lock.maxholdtime, held)
+                if not lock.holders:
+                    lock.exclusive = False
+                    lock.condition.notify_all()
+        if self.debug >= 2: log("[releasing lock " + "/".join(key)+"]")
+
+    def holds(self, key):
+        """Does the current thread hold the lock for the given document (in any mode)?"""
+        with self.mutex:
+            return key in self.locks and threading.get_ident() in self.locks[key].holders
+
+    def islocked(self, key):
+        with self.mutex:
+            return key in self.locks and bool(self.locks[key].holders)
+
+    def stats(self):
+        with self.mutex:
+            return { "/".join(key): lock.stats() for key, lock in self.locks.items() }
+
+
+class SnapshotCache:
+    """Tiered cache of parsed documents that have been unloaded, so they need not be parsed from XML again when reloaded.
+
+    Tier one holds compressed pickles in memory, up to a memory limit; the least recently stored snapshots spill over
+    to tier two, a snapshot directory on disk. Snapshots are keyed on the path, modification time, size and inode
+    of the FoLiA XML file, so they are invalidated as soon as the file changes (e.g. by a revert or another process)."""
+
+    def __init__(self, setdefinitions, memorylimit=256*1024*1024, directory=None, compresslevel=1):
+        self.setdefinitions = setdefinitions #shared between all documents, never included in a snapshot
+        self.memorylimit = memorylimit
+        self.directory = directory
+        self.compresslevel = compresslevel
+        self.memory = OrderedDict() #filename => (signature, data), least recently stored first
+        self.memoryused = 0
+        self.lock = threading.Lock()
+        if self.directory and not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        #telemetry
+        self.memoryhits = 0
+        self.diskhits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.stored = 0
+
+    @staticmethod
+    def signature(filename):
+        st = os.stat(filename)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def diskpath(self, filename, signature=None):
+        """Returns the directory holding the disk snapshots for the given file, or the path of the snapshot with the specified signature"""
+        dirname = os.path.join(self.directory, hashlib.sha1(filename.encode('utf-8')).hexdigest())
+        if signature is None:
+            return dirname
+        #the library versions are part of the name as pickles are not portable between them
+        return os.path.join(dirname, "%d-%d-%d-%s-%s.snapshot" % (signature + (VERSION, folia.LIBVERSION)))
+
+    def dump(self, doc):
+        setdefinitions = self.setdefinitions
+        class SnapshotPickler(pickle.Pickler):
+            def persistent_id(self, obj): #pylint: disable=no-self-use
+                return "setdefinitions" if obj is setdefinitions else None
+        buffer = io.BytesIO()
+        SnapshotPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(doc)
+        return zlib.compress(buffer.getvalue(), self.compresslevel)
+
+    def restore(self, data):
+        setdefinitions = self.setdefinitions
+        class SnapshotUnpickler(pickle.Unpickler):
+            def persistent_load(self, pid): #pylint: disable=no-self-use
+                if pid == "setdefinitions":
+                    return setdefinitions
+                raise pickle.UnpicklingError("Unknown persistent id in snapshot: " + str(pid))
+        return SnapshotUnpickler(io.BytesIO(zlib.decompress(data))).load()
+
+    def store(self, filename, doc):
+        """Hibernate a (saved, unchanged) document"""
+        try:
+            signature = self.signature(filename)
+        except FileNotFoundError:
+            return False
+        data = self.dump(doc)
+        with self.lock:
+            self.removefrommemory(filename)
+            self.stored += 1
+            if self.memorylimit and len(data) <= self.memorylimit:
+                self.memory[filename] = (signature, data)
+                self.memoryused += len(data)
+                while self.memoryused > self.memorylimit:
+                    spillfilename, (spillsignature, spilldata) = self.memory.popitem(last=False)
+                    self.memoryused -= len(spilldata)
+                    self.writetodisk(spillfilename, spillsignature, spilldata)
+            else:
+                self.writetodisk(filename, signature, data)
+        return True
+
+    def writetodisk(self, filename, signature, data):
+        if not self.directory:
+            return
+        dirname = self.diskpath(filename)
+        path = self.diskpath(filename, signature)
+        if os.path.exists(dirname):
+            for oldsnapshot in os.listdir(dirname): #only one snapshot per file is kept
+                if os.path.join(dirname, oldsnapshot) != path:
+                    os.unlink(os.path.join(dirname, oldsnapshot))
+        else:
+            os.makedirs(dirname)
+        if not os.path.exists(path):
+            with open(path + ".tmp",'wb') as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+
+    def removefrommemory(self, filename):
+        if filename in self.memory:
+            _, data = self.memory.pop(filename)
+            self.memoryused -= len(data)
+
+    def get(self, filename):
+        """Returns the document restored from a snapshot, or None if there is no valid snapshot for the current file"""
+        try:
+            signature = self.signature(filename)
+        except FileNotFoundError:
+            return None
+        data = None
+        with self.lock:
+            if filename in self.memory:
+                snapshotsignature, snapshotdata = self.memory[filename]
+                self.removefrommemory(filename) #the document will be live in memory again
+                if snapshotsignature == signature:
+                    self.memoryhits += 1
+                    data = snapshotdata
+                else:
+                    self.invalidated += 1
+            if data is None and self.directory:
+                path = self.diskpath(filename, signature)
+                if os.path.exists(path):
+                    with open(path,'rb') as f:
+                        data = f.read()
+                    self.diskhits += 1
+            if data is None:
+                self.misses += 1
+                return None
+        try:
+            return self.restore(data)
+        except Exception as e: #pylint: disable=broad-except
+            log("ERROR: Unable to restore snapshot of " + filename + ", ignoring it: [" + e.__class__.__name__ + "] " + str(e))
+            self.discard(filename)
+            return None
+
+    def discard(self, filename):
+        with self.lock:
+            self.removefrommemory(filename)
+            if self.directory and os.path.exists(self.diskpath(filename)):
+                shutil.rmtree(self.diskpath(filename), ignore_errors=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'memory': len(self.memory),
+                'memoryused': self.memoryused,
+                'memoryhits': self.memoryhits,
+                'diskhits': self.diskhits,
+                'misses': self.misses,
+                'invalidated': self.invalidated,
+                'stored': self.stored,
+            }
+
+
+#Estimated memory footprint of a loaded document, relative to the size of its XML file
+DOCUMENT_MEMORY_FACTOR = 10
+#Estimated memory footprint of a loaded document per indexed element, used when there is no file yet
+ELEMENT_MEMORY_ESTIMATE = 1000
 
 class DocStore:
-    def __init__(self, workdir, expiretime, git=False, gitmode="user", gitshare="group", ignorefail=False, debug=False):
+    def __init__(self, workdir, expiretime, git=False, gitmode="user", gitshare="group", ignorefail=False, debug=False, locktimeout=60, snapshotmemory=0, snapshotdir=None, memorybudget=0, maxdocuments=0):
         log("Initialising document store in " + workdir)
         self.workdir = workdir
         self.expiretime = expiretime
@@ -196,12 +894,61 @@ class DocStore:
         self.ignorefail = ignorefail
         self.fail = False
 
-        self.lock = set() #will contain (namespace,docid) of temporarily locked documents, loading/unloading/saving are blocking operations
+        self.lock = LockManager(locktimeout, debug) #per-document locks, loading/unloading/saving/querying are blocking operations
         self.setdefinitions = {}
         self.git = git
         self.gitmode = gitmode
         self.gitshare = gitshare
         self.debug = debug
+        if snapshotmemory or snapshotdir:
+            self.snapshots = SnapshotCache(self.setdefinitions, snapshotmemory, snapshotdir)
+        else:
+            self.snapshots = None
+        self.memorybudget = memorybudget #in bytes, 0 = unlimited
+        self.maxdocuments = maxdocuments #0 = unlimited
+        self.footprint = {} # (namespace,docid) => estimated memory footprint in bytes
+        self.lru = OrderedDict() # (namespace,docid) => None, least recently used first
+        self.lrulock = threading.Lock()
+        self.evicting = set() #(namespace,docid) of documents scheduled for eviction
+        self.bgtask = None #BackgroundTaskQueue for evictions, set when the server starts
+        self.loader = None #BackgroundTaskQueue for prefetching documents, set when the server starts
+        self.pinned = set() #(namespace,docid) of documents that are never unloaded automatically (modified under lrulock)
+        self.prefetching = set() #(namespace,docid) of documents queued for prefetching (modified under lrulock)
+        self.revision = defaultdict(int) # (namespace,docid) => number of changes made to the document (monotonic during the lifetime of the server)
+        self.savedrevision = defaultdict(int) # (namespace,docid) => latest revision that was saved to disk
+        self.savecondition = threading.Condition() #notified whenever a document is saved
+        self.writebehind = False #schedule saves rather than performing them immediately
+        self.savedelay = 5 #debounce window for write-behind saves (seconds)
+        self.maxstaleness = 60 #maximum delay for write-behind saves of a document with pending changes (seconds)
+        self.pendingsaves = {} # (namespace,docid) => {'first': time, 'last': time, 'messages': []}
+        self.journaling = False #append changes to a journal rather than saving the full document
+        self.journalidle = 300 #compact the journal (i.e. save the document) once a document has been unchanged for this long (seconds)
+        self.journalsize = 16 * 1024 * 1024 #compact the journal once it exceeds this size (bytes)
+        self.lastchange = {} # (namespace,docid) => time of the last change
+        self.gitworkers = {} #repository directory => GitWorker
+        self.changes = deque(maxlen=10000) #change feed for replicas: {'seq': seq, 'key': (namespace,docid), 't': time, 'query': rawquery | 'meta': dict | 'reload': True}
+        self.changeseq = 0 #sequence number of the last change
+        self.changecondition = threading.Condition()
+        self.updatelock = threading.Lock()
+        self.updateconditions = {} # (namespace,docid) => [condition notified when updates are queued for sessions on the document, number of waiting sessions]
+        self.maxpollers = 32 #maximum number of polls waiting for updates at once (each occupies a request thread), further polls return immediately
+        self.pollers = 0 #number of polls currently waiting for updates
+        self.pollersrefused = 0 #number of polls that did not wait because the maximum was reached
+        self.primary = None #base URL of the primary in replica mode, the document store is read-only then
+        self.docseq = {} # (namespace,docid) => sequence number of the last change of the primary that is included in the document (replica mode)
+        self.lazyload = 0 #documents of at least this size (bytes) are loaded partially for queries on a single element, 0 = disabled
+        self.lazyindex = {} # (namespace,docid) => index of the divisions of the document, see buildlazyindex()
+        self.partials = OrderedDict() # (namespace,docid,division) => (signature, partially loaded document, estimated footprint), least recently used first
+        self.partiallock = threading.Lock()
+        self.maxpartials = 16
+        self.elementindices = {} #(namespace, docid) => byte-offset element index
+        self.rendercaches = {} #(namespace, docid) => RenderCache
+        self.rendercachesize = 10000 #maximum number of rendered elements to cache per document for FLAT, 0 = disabled
+        self.docinfos = {} #(namespace, docid) => DocumentInfo (table of contents, slices, declarations, etc for FLAT)
+        self.cursors = CursorStore() #query results of responses that were cut short, to continue from
+        self.xmlcache = {} #(namespace, docid) => (document, revision, {content coding (None for uncompressed): serialized xml as bytes})
+        self.gitlock = threading.Lock()
+        self.gitwindow = 2.0 #time window (seconds) in which commits to the same repository are batched
         super().__init__()
 
     def getfilename(self, key):
@@ -224,95 +971,692 @@ class DocStore:
 
 
 
-    def use(self, key):
-        while key in self.lock:
-            if self.debug >= 2: log("[waiting for lock " + "/".join(key)+"]")
-            time.sleep(0.1)
-        self.lock.add(key)
-        if self.debug >= 2: log("[acquired lock " + "/".join(key)+"]")
+    def use(self, key, timeout=None, shared=False):
+        """Acquire the lock for the given document, blocks until it is available or raises LockTimeout.
+
+        A shared lock only permits reading the document and may be held by multiple threads at once. The document
+        is loaded (under an exclusive lock) prior to handing out a shared lock, so a document is never parsed twice."""
+        if shared and key[0] == "testflat":
+            shared = False #test documents are discarded after each request anyway
+        while True:
+            if shared and key not in self:
+                self.load(key)
+            self.lock.acquire(key, timeout, shared)
+            if not shared or key in self:
+                return
+            self.lock.release(key) #document was unloaded before we got the lock, try again
 
     def done(self, key):
-        if self.debug >= 2: log("[releasing lock " + "/".join(key)+"]")
-        self.lock.remove(key)
+        """Release the lock for the given document"""
+        self.lock.release(key)
 
 
     def load(self,key, forcereload=False):
-        if key[0] == "testflat": key = ("testflat", "testflat")
+        key = self.resolve(key)
+        if key in self and not forcereload and self.lock.holds(key):
+            #loaded already, and it can not be unloaded whilst we hold the lock (possibly shared, which can not be upgraded)
+            self.touch(key)
+            return self.data[key]
         self.use(key)
+        try:
+            filename = self.getfilename(key)
+            if time.time() - self.lastunloadcheck > 900: #no unload check for 15 mins? background thread seems to have crashed?
+                self.fail = True #trigger lockdown
+                self.forceunload() #force unload of everything
+                raise NoSuchDocument("Document Server is in lockdown due to loss of contact with autoupdater thread, refusing to process new documents...")
+            if key not in self or forcereload:
+                if not os.path.exists(filename):
+                    log("File not found: " + filename)
+                    raise NoSuchDocument
+                if self.fail and not self.ignorefail:
+                    raise NoSuchDocument("Document Server is in lockdown due to earlier failure during XML serialisation, refusing to process new documents...")
+                log("Loading " + filename)
+                begintime = time.time()
+                doc = None
+                if self.snapshots and key[0] != "testflat" and not self.primary:
+                    if forcereload:
+                        self.snapshots.discard(filename)
+                    else:
+                        doc = self.snapshots.get(filename)
+                if self.primary and key[0] != "testflat":
+                    doc = self.loadreplica(key)
+                elif doc is not None:
+                    log("Restored " + filename + " from snapshot in " + str(round(time.time() - begintime,3)) + "s")
+                else:
+                    doc = self.parse(filename)
+                    log("Parsed " + filename + " in " + str(round(time.time() - begintime,3)) + "s")
+                replayed = 0
+                if key[0] != "testflat" and not self.primary:
+                    doc, replayed = self.replayjournal(key, doc)
+                self.data[key] = doc #only published once it is complete
+                if replayed:
+                    log("Replayed " + str(replayed) + " journaled changes on " + filename)
+                    self.markchanged(key)
+                    self.changelog[key].append("Recovered " + str(replayed) + " journaled changes")
+                    self.setsaved(key, self.revision.get(key, 0))
+                self.lastaccess[key]['NOSID'] = time.time()
+                self.footprint[key] = self.estimatefootprint(key)
+                self.touch(key)
+                self.enforcebudget(exclude=key)
+                if key[0] != "testflat" and self.bgtask:
+                    self.bgtask.put(self.precompute, key)
+            else:
+                self.touch(key)
+            return self.data[key]
+        finally:
+            self.done(key)
+
+    def parse(self, filename, string=None):
+        """Parses a FoLiA document from file (or from string, in which case filename is only informative)"""
+        mainprocessor = folia.Processor.create(name="foliadocserve", version=VERSION, host=getfqdn(), folia_version=folia.FOLIAVERSION, src="https://github.com/proycon/foliadocserve")
+        try:
+            if string is not None:
+                doc = folia.Document(string=string, setdefinitions=self.setdefinitions, loadsetdefinitions=True,autodeclare=True,allowadhocsets=True,processor=mainprocessor,fixunassignedprocessor=True,fixinvalidreferences=True)
+            else:
+                doc = folia.Document(file=filename, setdefinitions=self.setdefinitions, loadsetdefinitions=True,autodeclare=True,allowadhocsets=True,processor=mainprocessor,fixunassignedprocessor=True,fixinvalidreferences=True)
+            if folia.checkversion(doc.version, "2.0.0") < 0:
+                log("Upgrading " + filename)
+                upgrader = folia.Processor("foliaupgrade", version=FOLIATOOLSVERSION, src="https://github.com/proycon/foliatools")
+                mainprocessor.append(upgrader)
+                upgrade(doc,upgrader)
+            doc.changed = False #we do not count the above upgrade as a change yet (meaning it won't be saved unless an annotation is also added/edited)
+        except Exception as e:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
+            log("ERROR reading file " + filename + ": " + str(e))
+            if logfile: traceback.print_tb(exc_traceback, limit=50, file=logfile)
+            raise
+        return doc
+
+    def loadreplica(self, key):
+        """Loads a document in replica mode: obtains the state of the document from the primary, which is either on disk or (if it has unsaved changes) sent along"""
         filename = self.getfilename(key)
-        if time.time() - self.lastunloadcheck > 900: #no unload check for 15 mins? background thread seems to have crashed?
-            self.fail = True #trigger lockdown
-            self.forceunload() #force unload of everything
-            raise NoSuchDocument("Document Server is in lockdown due to loss of contact with autoupdater thread, refusing to process new documents...")
-        if key not in self or forcereload:
-            if not os.path.exists(filename):
-                log("File not found: " + filename)
-                self.done(key)
-                raise NoSuchDocument
-            if self.fail and not self.ignorefail:
-                raise NoSuchDocument("Document Server is in lockdown due to earlier failure during XML serialisation, refusing to process new documents...")
-            log("Loading " + filename)
-            mainprocessor = folia.Processor.create(name="foliadocserve", version=VERSION, host=getfqdn(), folia_version=folia.FOLIAVERSION, src="https://github.com/proycon/foliadocserve")
+        for _ in range(3):
             try:
-                self.data[key] = folia.Document(file=filename, setdefinitions=self.setdefinitions, loadsetdefinitions=True,autodeclare=True,allowadhocsets=True,processor=mainprocessor,fixunassignedprocessor=True,fixinvalidreferences=True)
-                if folia.checkversion(self.data[key].version, "2.0.0") < 0:
-                    log("Upgrading " + self.data[key].filename)
-                    upgrader = folia.Processor("foliaupgrade", version=FOLIATOOLSVERSION, src="https://github.com/proycon/foliatools")
-                    mainprocessor.append(upgrader)
-                    upgrade(self.data[key],upgrader)
-                self.data[key].changed = False #we do not count the above upgrade as a change yet (meaning it won't be saved unless an annotation is also added/edited)
-            except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
-                log("ERROR reading file " + filename + ": " + str(e))
-                if logfile: traceback.print_tb(exc_traceback, limit=50, file=logfile)
-                self.done(key)
+                with urllib.request.urlopen(self.primary + "/replicate/" + urllib.parse.quote(key[0]) + "/" + urllib.parse.quote(key[1]), timeout=600) as f:
+                    state = json.loads(f.read())
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    raise NoSuchDocument
                 raise
-            self.lastaccess[key]['NOSID'] = time.time()
-        self.done(key)
-        return self.data[key]
+            if 'xml' in state:
+                doc = self.parse(filename, state['xml'])
+                doc.changed = True #differs from the document on disk (prevents snapshotting)
+                log("Replicated " + "/".join(key) + " from primary at change " + str(state['seq']))
+            else:
+                doc = self.parse(filename)
+                if list(SnapshotCache.signature(filename)) != state['signature']:
+                    log("Document " + "/".join(key) + " changed on disk whilst replicating, retrying")
+                    continue
+                log("Replicated " + "/".join(key) + " from disk at change " + str(state['seq']))
+            self.docseq[key] = state['seq']
+            return doc
+        raise NoSuchDocument("Unable to obtain a consistent copy of " + "/".join(key) + " from the primary")
+
+    def publish(self, key, **entry):
+        """Publishes a change (query=rawquery, meta=dict, or reload=True if the document was replaced on disk) to the change feed read by replicas"""
+        with self.changecondition:
+            self.changeseq += 1
+            entry['seq'] = self.changeseq
+            entry['key'] = key
+            entry['t'] = time.time()
+            self.changes.append(entry)
+            self.changecondition.notify_all()
+
+    def getchanges(self, since, timeout=0):
+        """Returns a (seq, entries) tuple with all changes after the specified sequence number, waiting at most timeout seconds for changes to arrive.
+        Entries is None if the changes are no longer available (the replica has to start over)"""
+        with self.changecondition:
+            self.changecondition.wait_for(lambda: self.changeseq > since, timeout)
+            if since > self.changeseq or (self.changes and self.changes[0]['seq'] > since + 1):
+                return self.changeseq, None
+            return self.changeseq, [ entry for entry in self.changes if entry['seq'] > since ]
+
+    def notifyupdates(self, key):
+        """Wakes the sessions that are waiting for updates on the document (see waitupdates()), call after queueing updates in updateq"""
+        with self.updatelock:
+            if key in self.updateconditions:
+                self.updateconditions[key][0].notify_all()
+
+    def waitupdates(self, key, sid, timeout):
+        """Waits at most timeout seconds until updates are queued for the session on the document (or the session or document is gone),
+        returns True if there are any. Does not wait at all if the maximum number of waiting polls has been reached"""
+        with self.updatelock:
+            if self.pollers >= self.maxpollers:
+                #the request threads are needed for other requests, the client simply polls again
+                self.pollersrefused += 1
+                return False
+            if key not in self.updateconditions:
+                self.updateconditions[key] = [threading.Condition(self.updatelock), 0]
+            entry = self.updateconditions[key]
+            entry[1] += 1
+            self.pollers += 1
+            try:
+                #updateq is a defaultdict, so we don't use indexing that would create entries
+                return entry[0].wait_for(lambda: sid not in self.updateq.get(key, {}) or bool(self.updateq[key][sid]), timeout) and sid in self.updateq.get(key, {})
+            finally:
+                entry[1] -= 1
+                self.pollers -= 1
+                if not entry[1]:
+                    del self.updateconditions[key]
+
+    def logchange(self, key, **entry):
+        """Records a change (query=rawquery or meta=dict) in the journal and the change feed.
+        Should be called whilst holding the (exclusive) lock on the document."""
+        self.journal(key, **entry)
+        self.publish(key, **entry)
+
+    def applychange(self, entry):
+        """Applies a change from the change feed of the primary (replica mode), returns the IDs of all affected elements"""
+        key = tuple(entry['key'])
+        if key not in self:
+            return [] #it will be replicated in full when it is loaded
+        self.use(key)
+        try:
+            if key not in self or entry['seq'] <= self.docseq.get(key, 0):
+                return [] #unloaded in the meantime, or the change is already part of the replicated document
+            if entry.get('reload'):
+                self.unload(key, save=False)
+                return []
+            doc = self.data[key]
+            ids = []
+            if 'meta' in entry:
+                for metakey, value in entry['meta'].items():
+                    if value == 'NONE':
+                        try:
+                            del doc.metadata[metakey]
+                        except KeyError:
+                            pass
+                    else:
+                        doc.metadata[metakey] = value
+                self.docinfo(key).invalidate()
+            else:
+                query = fql.Query(entry['query'])
+                query.format = "python"
+                results = query(doc, False)
+                for result in results:
+                    if isinstance(result, folia.AbstractElement) and result.id:
+                        ids.append(result.id)
+                if self.rendercache(key):
+                    self.rendercache(key).invalidate(results, query)
+                self.docinfo(key).invalidate(results, query)
+            doc.changed = True
+            self.revision[key] += 1
+            self.docseq[key] = entry['seq']
+            #notify the sessions on this replica
+            for sid in self.updateq[key]:
+                self.updateq[key][sid].update(ids)
+            if ids:
+                self.notifyupdates(key)
+            return ids
+        finally:
+            self.done(key)
 
-    def gitcommit(self, key, message="", remove=False):
-        if self.git:
-            doinit = False
-            if os.path.exists(self.workdir + '/.git'):
-                # entire workdir is one git repo (old style)
-                targetdir = self.workdir
-            elif self.gitmode == "monolithic":
-                doinit = True
-                targetdir = self.workdir
+    def buildlazyindex(self, key, signature):
+        """Streams through the document (without building it) and indexes which top-level division (i.e. child of the text/speech body) holds which element IDs"""
+        filename = self.getfilename(key)
+        begintime = time.time()
+        index = {'signature': signature, 'ids': {}, 'metadata': None, 'unresolvable': set()}
+        division = 0
+        depth = 0
+        inbody = False
+        for event, elem in etree.iterparse(filename, events=('start','end'), huge_tree=True):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    index['root'] = (elem.tag, dict(elem.attrib), elem.nsmap)
+                elif depth == 2:
+                    inbody = etree.QName(elem).localname in ('text','speech')
+                    if inbody:
+                        index['body'] = (elem.tag, dict(elem.attrib))
+                elif inbody:
+                    elemid = elem.get('{http://www.w3.org/XML/1998/namespace}id')
+                    if elemid:
+                        index['ids'][elemid] = division
             else:
-                targetdir = self.getpath(key, useronly=(self.gitmode == 'user'))
-                if not os.path.exists(targetdir + '/.git'):
-                    doinit = True
-            os.chdir(targetdir)
-            if doinit:
-                log("Initialising git repository in  " + targetdir)
-                if self.gitshare:
-                    r = os.system("git init --shared=\"" + self.gitshare + "\"")
+                depth -= 1
+                if depth == 1 and etree.QName(elem).localname == 'metadata':
+                    index['metadata'] = etree.tostring(elem)
+                elif depth == 2 and inbody:
+                    division += 1
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+        if 'body' not in index or index['metadata'] is None:
+            return None
+        log("Indexed " + str(division) + " divisions of " + filename + " in " + str(round(time.time() - begintime,3)) + "s")
+        return index
+
+    def loaddivision(self, key, index, division):
+        """Loads a single top-level division of the document as a document of its own (with the same metadata and declarations)"""
+        filename = self.getfilename(key)
+        begintime = time.time()
+        depth = 0
+        count = 0
+        inbody = False
+        for event, elem in etree.iterparse(filename, events=('start','end'), huge_tree=True):
+            if event == 'start':
+                depth += 1
+                if depth == 2:
+                    inbody = etree.QName(elem).localname in ('text','speech')
+            else:
+                depth -= 1
+                if depth == 2 and inbody:
+                    if count == division:
+                        unresolvable = DocStore.unresolvablereferences(elem)
+                        if unresolvable:
+                            #parsing would silently drop the references (fixinvalidreferences), the full document is needed
+                            log("Division " + str(division) + " of " + filename + " refers to " + str(len(unresolvable)) + " element(s) outside of it (e.g. " + unresolvable[0] + "), not loading it partially")
+                            with self.partiallock:
+                                index['unresolvable'].add(division)
+                            return None
+                        roottag, rootattrib, nsmap = index['root']
+                        root = etree.Element(roottag, rootattrib, nsmap=nsmap)
+                        root.append(etree.fromstring(index['metadata']))
+                        body = etree.SubElement(root, index['body'][0], index['body'][1])
+                        body.append(elem)
+                        doc = self.parse(filename, etree.tostring(root, encoding='unicode'))
+                        log("Loaded division " + str(division) + " of " + filename + " in " + str(round(time.time() - begintime,3)) + "s")
+                        return doc
+                    count += 1
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+        return None
+
+    @staticmethod
+    def unresolvablereferences(elem):
+        """Returns the IDs that references (wref, xref) in the element refer to but that are not defined within it"""
+        ids = set(elem.xpath('descendant-or-self::*/@xml:id'))
+        return [ refid for refid in elem.xpath('descendant::*[not(@xml:id)]/@id') if refid not in ids ]
+
+    def partial(self, key, elemid):
+        """Returns a partially loaded document holding (at least) the division with the specified element, or None if the full document has to be used instead"""
+        if not self.lazyload or key[0] == "testflat" or key in self or self.primary:
+            return None
+        filename = self.getfilename(key)
+        if not os.path.exists(filename) or os.path.getsize(filename) < self.lazyload or os.path.exists(self.journalfilename(key)):
+            return None
+        signature = SnapshotCache.signature(filename)
+        with self.partiallock:
+            index = self.lazyindex.get(key)
+        if index is None or index['signature'] != signature:
+            index = self.buildlazyindex(key, signature)
+            if index is None:
+                return None
+            with self.partiallock:
+                self.lazyindex[key] = index
+        division = index['ids'].get(elemid)
+        if division is None or division in index['unresolvable']:
+            return None
+        with self.partiallock:
+            if (key[0],key[1],division) in self.partials:
+                partialsignature, doc, _ = self.partials[(key[0],key[1],division)]
+                if partialsignature == signature:
+                    self.partials.move_to_end((key[0],key[1],division))
+                    return doc
+        doc = self.loaddivision(key, index, division)
+        if doc is not None:
+            with self.partiallock:
+                self.partials[(key[0],key[1],division)] = (signature, doc, len(doc.index) * ELEMENT_MEMORY_ESTIMATE)
+                while len(self.partials) > self.maxpartials:
+                    self.partials.popitem(last=False)
+        return doc
+
+    def indexfilename(self, key):
+        return self.getfilename(key) + '.index'
+
+    def buildelementindex(self, key):
+        """Scans the raw bytes of the document and stores a sidecar index mapping each element ID to the byte range of its element (and the ID of its parent element), returns the index"""
+        filename = self.getfilename(key)
+        begintime = time.time()
+        signature = SnapshotCache.signature(filename)
+        with open(filename,'rb') as f:
+            data = f.read()
+        elements = {}
+        stack = [] #(id, start) for each open element
+        for match in XMLTAG.finditer(data):
+            closing, tag, attribs, selfclosing = match.groups()
+            if tag is None: #comment, cdata or processing instruction
+                continue
+            if closing:
+                elemid, start = stack.pop()
+                if elemid is not None:
+                    elements[elemid] = [start, match.end(), stack[-1][0] if stack else None]
+            else:
+                m = XMLID.search(attribs)
+                elemid = m.group(2).decode('utf-8') if m else None
+                if selfclosing:
+                    if elemid is not None:
+                        elements[elemid] = [match.start(), match.end(), stack[-1][0] if stack else None]
                 else:
-                    r = os.system("git init")
-                if r != 0:
-                    log("ERROR during git init of " + targetdir)
-                    self.done(key)
-                    return
+                    stack.append( (elemid, match.start()) )
+        index = {'signature': signature, 'version': VERSION, 'elements': elements}
+        with open(self.indexfilename(key) + '.tmp','w',encoding='utf-8') as f:
+            json.dump(index, f)
+        os.rename(self.indexfilename(key) + '.tmp', self.indexfilename(key))
+        index['signature'] = tuple(signature)
+        with self.partiallock:
+            self.elementindices[key] = index
+        log("Built element index for " + filename + " (" + str(len(elements)) + " elements) in " + str(round(time.time() - begintime,3)) + "s")
+        return index
+
+    def elementindex(self, key):
+        """Returns the element index of the document, reading it from the sidecar file or (re)building it if it is missing or stale"""
+        filename = self.getfilename(key)
+        if not os.path.exists(filename):
+            raise NoSuchDocument
+        signature = SnapshotCache.signature(filename)
+        with self.partiallock:
+            index = self.elementindices.get(key)
+        if index is not None and index['signature'] == signature:
+            return index
+        try:
+            with open(self.indexfilename(key),'r',encoding='utf-8') as f:
+                index = json.load(f)
+            index['signature'] = tuple(index['signature'])
+        except (IOError, ValueError, KeyError):
+            index = None
+        if index is None or index['signature'] != signature:
+            return self.buildelementindex(key)
+        with self.partiallock:
+            self.elementindices[key] = index
+        return index
+
+    def getelementxml(self, key, elemid, lastid=None):
+        """Returns the XML of the element with the specified ID, or of it and all its following siblings up to and including lastid.
+        Documents that are not loaded (and have no journaled changes) are not parsed at all; the XML is sliced from the file using the element index"""
+        if key in self or self.primary or os.path.exists(self.journalfilename(key)):
+            #the file on disk does not (necessarily) reflect the latest state of the document
+            self.use(key, shared=True)
+            try:
+                doc = self[key]
+                try:
+                    element = doc[elemid]
+                except KeyError:
+                    raise KeyError(elemid)
+                xml = element.xmlstring()
+                if lastid and lastid != elemid:
+                    if lastid not in doc or doc[lastid].parent is not element.parent:
+                        raise KeyError(lastid)
+                    siblings = element.parent.data
+                    if siblings.index(doc[lastid]) < siblings.index(element):
+                        raise KeyError(lastid)
+                    for sibling in siblings[siblings.index(element)+1:]:
+                        if isinstance(sibling, folia.AbstractElement):
+                            xml += "\n" + sibling.xmlstring()
+                            if sibling is doc[lastid]:
+                                break
+                return xml
+            finally:
+                self.done(key)
+        index = self.elementindex(key)
+        elements = index['elements']
+        if elemid not in elements:
+            raise KeyError(elemid)
+        start, end, parent = elements[elemid]
+        if lastid and lastid != elemid:
+            if lastid not in elements or elements[lastid][2] != parent or elements[lastid][0] < start:
+                raise KeyError(lastid)
+            end = elements[lastid][1]
+        with open(self.getfilename(key),'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        #serialize the slice the way a loaded document would: with namespace declarations, without the whitespace and comments of the file
+        parser = etree.XMLParser(remove_blank_text=True, remove_comments=True, remove_pis=True, huge_tree=True)
+        root = etree.fromstring(b'<slice xmlns="' + folia.NSFOLIA.encode('utf-8') + b'" xmlns:xlink="http://www.w3.org/1999/xlink">' + data + b'</slice>', parser)
+        return "\n".join( etree.tostring(element, encoding='unicode') for element in root )
+
+    def gitworker(self, key):
+        """Returns the git worker for the repository holding the specified document"""
+        if os.path.exists(self.workdir + '/.git'):
+            # entire workdir is one git repo (old style)
+            targetdir = self.workdir
+        elif self.gitmode == "monolithic":
+            targetdir = self.workdir
+        else:
+            targetdir = self.getpath(key, useronly=(self.gitmode == 'user'))
+        with self.gitlock:
+            if targetdir not in self.gitworkers:
+                self.gitworkers[targetdir] = GitWorker(targetdir, init=not os.path.exists(targetdir + '/.git'), share=self.gitshare, window=self.gitwindow)
+            return self.gitworkers[targetdir]
+
+    def gitcommit(self, key, message="", remove=False):
+        if self.git:
             message = "\n".join(self.changelog[key]) + "\n" + message
             self.changelog[key] = [] #reset changelog
             message = message.strip("\n")
-            log("Doing git commit for " + self.getfilename(key) + " -- " + message.replace("\n", " -- "))
-            action = "rm" if remove else "add"
-            r = os.system("cd \"" + targetdir + "\" && git " + action + " \"" + self.getfilename(key) + "\" && git commit -m \"" + message.replace('"','') + "\"")
-            if r != 0:
-                log("ERROR during git " + action + "/commit of " + self.getfilename(key) + " in " + targetdir)
+            self.gitworker(key).commit(self.getfilename(key), message, remove)
+
+    def stopgit(self):
+        """Performs all pending commits and stops the git workers"""
+        with self.gitlock:
+            for worker in self.gitworkers.values():
+                worker.stop()
+            self.gitworkers = {}
+
+    @staticmethod
+    def resolve(key):
+        """Returns the key the document is actually stored under (all test documents share one)"""
+        if key[0] == "testflat":
+            return ("testflat","testflat")
+        return key
+
+    def markchanged(self, key):
+        """Marks the document as changed (it needs to be saved), returns the new revision"""
+        self[key].changed = True
+        if self.resolve(key) != key:
+            self.revision[self.resolve(key)] += 1 #the serialization is cached under the key the document is stored under
+        self.revision[key] += 1
+        self.lastchange[key] = time.time()
+        self.xmlcache.pop(self.resolve(key), None)
+        return self.revision.get(key, 0)
+
+    def serialize(self, key, coding=None):
+        """Returns the serialized XML (as bytes) of the loaded document, compressed with the given content coding (gzip/deflate) if specified.
+        Both are cached until the document changes. Should be called whilst holding a lock on the document"""
+        key = self.resolve(key)
+        doc = self.data[key]
+        cached = self.xmlcache.get(key)
+        if cached is None or cached[0] is not doc or cached[1] != self.revision.get(key, 0):
+            cached = (doc, self.revision.get(key, 0), {None: doc.xmlstring().encode('utf-8')})
+            self.xmlcache[key] = cached
+        if coding not in cached[2]:
+            cached[2][coding] = compress(cached[2][None], coding)
+        return cached[2][coding]
+
+    def rendercache(self, key):
+        """Returns the cache of rendered elements (for FLAT) of the loaded document, or None if disabled"""
+        if not self.rendercachesize or key[0] == "testflat":
+            return None
+        doc = self.data[key]
+        cache = self.rendercaches.get(key)
+        if cache is None or cache.doc is not doc:
+            cache = self.rendercaches[key] = RenderCache(doc, self.rendercachesize)
+        return cache
+
+    def docinfo(self, key):
+        """Returns the information derived from the whole loaded document (for FLAT), or None for test documents"""
+        if key[0] == "testflat":
+            return None
+        doc = self.data[key]
+        info = self.docinfos.get(key)
+        if info is None or info.doc is not doc:
+            info = self.docinfos[key] = DocumentInfo(doc)
+        return info
+
+    def precompute(self, key):
+        """Computes the information derived from the whole document after it has been loaded (a background task)"""
+        if key not in self:
+            return #unloaded in the meantime
+        try:
+            self.lock.acquire(key, None, True)
+        except LockTimeout:
+            return
+        try:
+            if key in self:
+                begintime = time.time()
+                self.docinfo(key).precompute()
+                log("Precomputed document information for " + "/".join(key) + " in " + str(round(time.time() - begintime,3)) + "s")
+        except Exception as e: #pylint: disable=broad-except
+            log("ERROR: Unable to precompute document information for " + "/".join(key) + ": [" + e.__class__.__name__ + "] " + str(e))
+        finally:
+            self.lock.release(key)
+
+    def journalfilename(self, key):
+        return self.getfilename(key) + '.journal'
+
+    def journal(self, key, **entry):
+        """Appends a change (query=rawquery or meta=dict) to the journal of the document, the change is durable once this returns.
+        Should be called whilst holding the (exclusive) lock on the document."""
+        if not self.journaling or key[0] == "testflat":
+            return
+        filename = self.journalfilename(key)
+        isnew = not os.path.exists(filename)
+        with open(filename,'a',encoding='utf-8') as f:
+            if isnew:
+                #the header ties the journal to the exact version of the document it applies to
+                f.write(json.dumps({'base': SnapshotCache.signature(self.getfilename(key)), 'version': VERSION}) + "\n")
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        self.setsaved(key, self.revision.get(key, 0))
+        if size > self.journalsize and self.bgtask:
+            log("Journal of " + "/".join(key) + " exceeds size threshold, compacting")
+            self.bgtask.put(self.save, key, "")
+
+    def replayjournal(self, key, doc):
+        """Replays the journal of the document on the given (just loaded) document, returns the document and the number of changes
+        replayed. Stale journals are removed. If a change can not be replayed, the journal is set aside (renamed to .journal.failed)
+        and only the changes preceding it are replayed, on a fresh copy of the document (the failed change may be applied partially);
+        those remain journaled."""
+        filename = self.journalfilename(key)
+        if not os.path.exists(filename):
+            return doc, 0
+        entries = []
+        with open(filename,'r',encoding='utf-8') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                header = {}
+            stale = header.get('base') != list(SnapshotCache.signature(self.getfilename(key)))
+            if not stale:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        log("WARNING: Ignoring incomplete trailing entry in journal " + filename)
+                        break
+        if stale:
+            log("Discarding stale journal " + filename)
+            self.resetjournal(key)
+            return doc, 0
+        for i, entry in enumerate(entries):
+            try:
+                self.replayentry(doc, entry)
+            except Exception as e: #pylint: disable=broad-except
+                log("ERROR: Unable to replay change " + str(i+1) + " of journal " + filename + ": [" + e.__class__.__name__ + "] " + str(e) + ", setting the journal aside as " + filename + ".failed")
+                os.replace(filename, filename + ".failed")
+                with open(filename,'w',encoding='utf-8') as f:
+                    f.write(json.dumps(header) + "\n")
+                    for entry in entries[:i]:
+                        f.write(json.dumps(entry) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                doc = self.parse(self.getfilename(key))
+                for entry in entries[:i]:
+                    self.replayentry(doc, entry)
+                return doc, i
+        return doc, len(entries)
+
+    @staticmethod
+    def replayentry(doc, entry):
+        """Applies a journaled change to the document"""
+        if 'meta' in entry:
+            for metakey, value in entry['meta'].items():
+                if value == 'NONE':
+                    try:
+                        del doc.metadata[metakey]
+                    except KeyError:
+                        pass
+                else:
+                    doc.metadata[metakey] = value
+        else:
+            fql.Query(entry['query'])(doc, False)
+
+    def resetjournal(self, key):
+        filename = self.journalfilename(key)
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+    def compactidle(self):
+        """Schedules saves (i.e. journal compaction) for changed documents that have not been changed for a while"""
+        if not self.journaling or not self.bgtask:
+            return
+        for key, t in list(self.lastchange.items()):
+            if time.time() - t > self.journalidle and key in self and self.data[key].changed:
+                log("Compacting journal of idle document " + "/".join(key))
+                self.lastchange.pop(key, None)
+                self.bgtask.put(self.save, key, "")
+
+    def schedulesave(self, key, message=""):
+        """Schedules a (write-behind) save of the document, repeated requests are coalesced into a single save.
+        Returns a ticket: the document is durable once the saved revision reaches it."""
+        now = time.time()
+        with self.savecondition:
+            if key not in self.pendingsaves:
+                self.pendingsaves[key] = {'first': now, 'messages': []}
+            self.pendingsaves[key]['last'] = now
+            if message and message not in self.pendingsaves[key]['messages']:
+                self.pendingsaves[key]['messages'].append(message)
+            return self.revision.get(key, 0)
+
+    def duesaves(self):
+        """Returns (key, message) pairs for all scheduled saves that are due and removes them from the schedule.
+        A save is due if no further save was requested in the debounce window, or once it has been pending too long"""
+        now = time.time()
+        due = []
+        with self.savecondition:
+            for key, pending in list(self.pendingsaves.items()):
+                if now - pending['last'] >= self.savedelay or now - pending['first'] >= self.maxstaleness:
+                    del self.pendingsaves[key]
+                    if key in self:
+                        due.append( (key, "\n".join(pending['messages'])) )
+        return due
+
+    def flushsave(self, key):
+        """Performs a scheduled save of the document immediately (if any)"""
+        with self.savecondition:
+            pending = self.pendingsaves.pop(key, None)
+        if pending is not None and key in self:
+            self.save(key, "\n".join(pending['messages']))
+
+    def waitsave(self, key, ticket, timeout):
+        """Waits until the document has been saved up to the revision of the given ticket, returns a boolean"""
+        with self.savecondition:
+            return self.savecondition.wait_for(lambda: self.savedrevision.get(key, 0) >= ticket, timeout)
+
+    def setsaved(self, key, revision):
+        with self.savecondition:
+            if revision > self.savedrevision.get(key, 0):
+                self.savedrevision[key] = revision
+            self.savecondition.notify_all()
 
     def save(self, key, message = ""):
+        if self.primary:
+            return None #replicas never write, the primary does
         doc = self[key]
         if key[0] == "testflat":
             #No need to save the document, instead we run our tests:
             log("Running test " + key[1])
             return test(doc, key[1])
-        elif hasattr(doc,'changed') and doc.changed:
-            self.use(key)
+        self.use(key)
+        try:
+            if not (hasattr(doc,'changed') and doc.changed):
+                self.setsaved(key, self.revision.get(key, 0))
+                return None
+            revision = self.revision.get(key, 0)
             log("Saving " + self.getfilename(key) + " - " + message)
             dirname = os.path.dirname(self.getfilename(key))
             if not os.path.exists(dirname):
@@ -333,31 +1677,68 @@ class DocStore:
                 self.fail = True
                 log("ERROR: Unable to complete saving of document " + self.getfilename(key) + ": ["  + e.__class__.__name__ + "] " + str(e) )
                 return False
+            doc.changed = False #in sync with disk again
+            self.resetjournal(key) #all journaled changes are now in the document itself
+            try:
+                self.buildelementindex(key)
+            except Exception as e: #pylint: disable=broad-except
+                log("ERROR: Unable to build element index for " + self.getfilename(key) + ": [" + e.__class__.__name__ + "] " + str(e))
             self.gitcommit(key, message)
-            self.done(key)
+            self.setsaved(key, revision)
             return True
+        finally:
+            self.done(key)
 
 
     def unload(self, key, save=True):
         if key in self:
-            if save:
-                self.save(key)
-            self.use(key) #save set its own lock
-            log("Unloading " + "/".join(key))
-            del self.data[key]
-            del self.lastaccess[key]
-            if key in self.updateq:
-                del self.updateq[key]
-            if key in self.changelog:
-                del self.changelog[key]
-            self.done(key)
+            self.use(key)
+            try:
+                if key not in self: #unloaded by another thread while we were waiting for the lock
+                    return
+                if save:
+                    self.save(key)
+                log("Unloading " + "/".join(key))
+                if save and self.snapshots and key[0] != "testflat" and not self.primary and not self.data[key].changed:
+                    #hibernate the document so a reload need not parse the XML again
+                    try:
+                        self.snapshots.store(self.getfilename(key), self.data[key])
+                    except Exception as e: #pylint: disable=broad-except
+                        log("ERROR: Unable to store snapshot of " + "/".join(key) + ": [" + e.__class__.__name__ + "] " + str(e))
+                del self.data[key]
+                self.xmlcache.pop(key, None)
+                self.rendercaches.pop(key, None)
+                self.docinfos.pop(key, None)
+                self.cursors.discardall(key)
+                self.lastaccess.pop(key, None) #uploaded documents may not have been accessed yet
+                self.footprint.pop(key, None)
+                with self.lrulock:
+                    self.lru.pop(key, None)
+                if key in self.updateq:
+                    del self.updateq[key]
+                    self.notifyupdates(key) #sessions waiting for updates get an empty response
+                if key in self.changelog:
+                    del self.changelog[key]
+                self.lastchange.pop(key, None)
+                with self.savecondition:
+                    self.pendingsaves.pop(key, None)
+            finally:
+                self.done(key)
 
     def delete(self, key):
         self.unload(key,False)
         filename = self.getfilename(key)
+        if self.snapshots:
+            self.snapshots.discard(filename)
+        self.resetjournal(key)
+        with self.partiallock:
+            self.elementindices.pop(key, None)
+        if os.path.exists(self.indexfilename(key)):
+            os.unlink(self.indexfilename(key))
         if os.path.exists(filename):
             log("Removing " + filename)
             os.unlink(self.getfilename(key))
+            self.publish(key, reload=True)
             self.gitcommit(key, message="Removed document", remove=True)
 
 
@@ -399,8 +1780,7 @@ class DocStore:
 
     def __getitem__(self, key):
         assert isinstance(key, tuple) and len(key) == 2
-        if key[0] == "testflat":
-            key = ("testflat","testflat")
+        key = self.resolve(key)
         self.load(key)
         return self.data[key]
 
@@ -409,6 +1789,9 @@ class DocStore:
         assert isinstance(doc, folia.Document)
         doc.filename = self.getfilename(key)
         self.data[key] = doc
+        self.footprint[key] = self.estimatefootprint(key)
+        self.touch(key)
+        self.enforcebudget(exclude=key)
 
     def __contains__(self,key):
         assert isinstance(key, tuple) and len(key) == 2
@@ -430,6 +1813,118 @@ class DocStore:
     def __iter__(self):
         return iter(self.data)
 
+    def estimatefootprint(self, key):
+        """Estimates the memory footprint of a loaded document (in bytes)"""
+        filename = self.getfilename(key)
+        if os.path.exists(filename):
+            return os.path.getsize(filename) * DOCUMENT_MEMORY_FACTOR
+        else:
+            return len(self.data[key].index) * ELEMENT_MEMORY_ESTIMATE
+
+    def memoryusage(self):
+        """Estimated memory usage (in bytes) of all loaded documents, including partially loaded ones"""
+        with self.partiallock:
+            partialusage = sum(footprint for _, _, footprint in self.partials.values())
+        return sum(self.footprint.values()) + partialusage
+
+    def memorypressure(self):
+        """Returns how much of the memory budget (or maximum number of documents) is in use, as a fraction; 0 if there are no limits"""
+        pressure = 0.0
+        if self.memorybudget:
+            pressure = self.memoryusage() / self.memorybudget
+        if self.maxdocuments:
+            pressure = max(pressure, len(self) / self.maxdocuments)
+        return pressure
+
+    def touch(self, key):
+        """Marks the document as most recently used"""
+        with self.lrulock:
+            self.lru[key] = None
+            self.lru.move_to_end(key)
+
+    def overbudget(self, usage, count):
+        return (self.memorybudget and usage > self.memorybudget) or (self.maxdocuments and count > self.maxdocuments)
+
+    def enforcebudget(self, exclude=None):
+        """Evicts the least recently used documents until the loaded documents fit in the memory budget and maximum number of documents.
+        Documents that are in use or have open (FLAT) sessions are skipped, unloading them would lose the updates queued for the sessions.
+        The actual unloading (which may involve saving) is done in the background if possible."""
+        if not self.memorybudget and not self.maxdocuments:
+            return
+        #partially loaded documents are cheap to load again, drop them first
+        while self.memorybudget and self.memoryusage() > self.memorybudget:
+            with self.partiallock:
+                if not self.partials:
+                    break
+                self.partials.popitem(last=False)
+        evict = []
+        with self.lrulock:
+            usage = self.memoryusage() - sum(self.footprint.get(key,0) for key in self.evicting)
+            count = len(self) - len(self.evicting)
+            for key in self.lru:
+                if not self.overbudget(usage, count):
+                    break
+                if key == exclude or key in self.evicting or key in self.pinned or self.lock.islocked(key) or self.hassessions(key):
+                    continue
+                evict.append(key)
+                self.evicting.add(key)
+                usage -= self.footprint.get(key,0)
+                count -= 1
+        for key in evict:
+            log("Evicting " + "/".join(key) + " to stay within memory budget (estimated usage " + str(self.memoryusage() // 1024**2) + "MB, " + str(len(self)) + " documents)")
+            if self.bgtask:
+                self.bgtask.put(self.evict, key)
+            else:
+                self.evict(key)
+
+    def prefetch(self, key):
+        """Schedules the document to be loaded in the background, so the first request for it need not wait for parsing.
+        Requests that arrive while the document is being loaded wait for that load rather than starting another."""
+        if key in self or key in self.prefetching or not self.loader or not os.path.exists(self.getfilename(key)):
+            return False
+        if self.loader.q.full():
+            log("Loader queue is full, not prefetching " + "/".join(key))
+            return False
+        with self.lrulock:
+            if key in self.prefetching:
+                return False
+            self.prefetching.add(key)
+        self.loader.put(self.doprefetch, key)
+        return True
+
+    def doprefetch(self, key):
+        try:
+            if key not in self:
+                log("Prefetching " + "/".join(key))
+                self.load(key)
+        except Exception as e: #pylint: disable=broad-except
+            log("ERROR: Unable to prefetch " + "/".join(key) + ": [" + e.__class__.__name__ + "] " + str(e))
+        finally:
+            with self.lrulock:
+                self.prefetching.discard(key)
+
+    def pin(self, key):
+        """Pins a document, it will be loaded in the background and never unloaded automatically"""
+        log("Pinning " + "/".join(key))
+        with self.lrulock:
+            self.pinned.add(key)
+        self.prefetch(key)
+
+    def hassessions(self, key):
+        """Does the document have sessions (other than NOSID) that have not expired yet?"""
+        return any(sid != 'NOSID' for sid in list(self.lastaccess.get(key, ()))) #lastaccess is a defaultdict, don't index
+
+    def evict(self, key):
+        try:
+            if self.hassessions(key): #a session opened the document after it was scheduled for eviction
+                log("Document " + "/".join(key) + " has open sessions, not evicting")
+                return
+            self.unload(key)
+        except LockTimeout:
+            log("Document " + "/".join(key) + " is still in use, postponing eviction")
+        finally:
+            self.evicting.discard(key)
+
     def autounload(self, save=True):
         log("Documents loaded: " + str(len(self)))
         self.lastunloadcheck = time.time()
@@ -438,7 +1933,7 @@ class DocStore:
         else:
             unload = []
             for d in self.lastaccess:
-                if d not in unload:
+                if d not in unload and d not in self.pinned:
                     dounload = True #falsify: all sessions must be expired before we can actually unload the document
                     expirecheck = time.time()
                     sid = "unknown"
@@ -453,17 +1948,114 @@ class DocStore:
 
             if unload:
                 for key in unload:
-                    self.unload(key, save)
+                    try:
+                        self.unload(key, save)
+                    except LockTimeout:
+                        log("Document " + "/".join(key) + " is still in use, postponing unload")
+            self.enforcebudget()
+            self.compactidle()
+            with self.lrulock:
+                pinned = list(self.pinned)
+            for key in pinned:
+                if key not in self:
+                    self.prefetch(key) #pinned documents may have been flushed
 
     def forceunload(self):
         """Called when the document server stops/reloads (SIGUSR1 will trigger this)"""
         log("Forcibly unloading all " + str(len(self)) + " documents...")
         for key in list(self.data.keys()):
-            self.unload(key)
+            try:
+                self.unload(key)
+            except LockTimeout:
+                log("ERROR: Unable to unload " + "/".join(key) + ", document remains locked")
+
+def streamresults(results, format, chunksize=65536):
+    """Generator yielding the response for the given query results in chunks of (at most) chunksize bytes"""
+    if format == "xml":
+        prefix, separator, suffix = b"<results>", b"\n", b"</results>"
+    elif format == "json":
+        prefix, separator, suffix = b"[", b",", b"]"
+    else:
+        prefix, separator, suffix = b"", b"", b""
+    yield prefix
+    for i, result in enumerate(results):
+        if i > 0:
+            yield separator
+        if isinstance(result, str):
+            result = result.encode('utf-8')
+        for offset in range(0, len(result), chunksize):
+            yield result[offset:offset+chunksize]
+        results[i] = None #release as soon as it has been sent
+    yield suffix
+
+def renderpage(results, format, start=(0,0), deadline=None, limit=0):
+    """Serializes query results (lists of elements, grouped per query) in xml or json format (as FQL does), starting at the given
+    position (query index, result index). Stops once the deadline (as per time.time()) has passed or limit results have been
+    serialized, but always serializes at least one result. Returns the serialized results (a string per query) and the position
+    to continue from (None if all results have been serialized)"""
+    out = []
+    count = 0
+    for q in range(start[0], len(results)):
+        queryresults = results[q] if isinstance(results[q], list) else [] #queries returning nothing return an empty string
+        serialized = []
+        for i in range(start[1] if q == start[0] else 0, len(queryresults)):
+            if count and ((limit and count >= limit) or (deadline and time.time() > deadline)):
+                if serialized:
+                    out.append(("" if format == "xml" else ", ").join(serialized))
+                return out, (q, i)
+            element = queryresults[i]
+            if format == "xml":
+                if isinstance(element, fql.SpanSet):
+                    serialized.append("<result>\n" + "".join(e.xmlstring(True) + "\n" for e in element) + "</result>\n")
+                else:
+                    serialized.append("<result>\n" + element.xmlstring(True) + "</result>\n")
+            elif isinstance(element, fql.SpanSet):
+                serialized.append(json.dumps([ e.json() for e in element ]))
+            else:
+                serialized.append(json.dumps(element.json()))
+            count += 1
+        if serialized:
+            out.append(("" if format == "xml" else ", ").join(serialized))
+    return out, None
 
 def validatenamespace(namespace):
     return namespace.replace('..','').replace('"','').replace(' ','_').replace(';','').replace('&','').strip('/')
 
+def isreadonly(query):
+    """Checks whether a (parsed) query only reads from the document, in which case a shared lock suffices"""
+    if query in ("GET", "PROBE"):
+        return True
+    elif isinstance(query, fql.Query):
+        if query.declarations or query.processor:
+            return False
+        actions = [query.action] if query.action else []
+        while actions:
+            action = actions.pop()
+            if action.action != "SELECT":
+                return False
+            actions += action.subactions
+            if action.nextaction:
+                actions.append(action.nextaction)
+        return True
+    return False
+
+def singletarget(query):
+    """Returns the ID of the single element a simple read-only query (SELECT ... ID x or SELECT ... FOR ID x) is confined to, if any. Such queries can be answered from a partially loaded document"""
+    if not isinstance(query, fql.Query) or not isreadonly(query) or query.format not in ('xml','json'):
+        return None
+    action = query.action
+    if not action or action.subactions or action.nextaction or action.focus.filter or action.focus.nextselector or action.focus.expansion:
+        return None
+    if query.targets:
+        targets = query.targets
+        if len(targets.targets) != 1 or targets.nested or targets.start or targets.end or targets.repeat:
+            return None
+        selector = targets.targets[0]
+        if selector.filter or selector.nextselector or selector.expansion:
+            return None
+        return selector.id
+    return action.focus.id
+
 def getdocumentselector(query):
     if query.startswith("USE "):
         end = query[4:].index(' ') + 4
@@ -486,6 +2078,214 @@ def getdocumentselector(query):
 
 
 
+class QueryCache:
+    """LRU cache of parsed (compiled) FQL and CQL queries, keyed on the query text.
+
+    Queries are prepared first: literal element IDs (after the ID keyword) are replaced by parameters, so queries
+    that only differ in the IDs they address share a single compiled query. Every execution gets its own copy of
+    the compiled query with the IDs bound, as executing a query modifies it."""
+
+    #quoted strings are matched (and skipped) first so no ID keyword is matched inside literals
+    IDPATTERN = re.compile(r'"(?:[^"\\]|\\.)*"|(?<![^ (])ID +("[^"\\]+"(?=[ )]|$)|[^ ()"\\]+(?= |$))')
+    NOWPATTERN = re.compile(r'(?<![^ (])(?:begin|end)?datetime +"?now"?(?=[ )]|$)')
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.queries = OrderedDict() #prepared query text => (compiled query, refreshnow), least recently used first
+        self.lock = threading.Lock()
+        #telemetry
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+    def prepare(self, rawquery):
+        """Replaces literal IDs in the query by parameters, returns the prepared query text and the parameters (dict)"""
+        params = {}
+        if rawquery[:4] == "CQL ":
+            return rawquery.strip(), params
+        def parametrize(match):
+            if match.group(1) is None: #quoted literal, left as is
+                return match.group(0)
+            name = "$FQLID" + str(len(params))
+            params[name] = match.group(1).strip('"')
+            return "ID " + name
+        return self.IDPATTERN.sub(parametrize, rawquery.strip()), params
+
+    @staticmethod
+    def compile(rawquery):
+        """Parses the query (FQL, or CQL if prefixed with CQL)"""
+        if rawquery[:4] == "CQL ":
+            if rawquery.find('FORMAT') != -1:
+                end = rawquery.find('FORMAT')
+                format = rawquery[end+7:]
+            else:
+                end = 9999
+                format = 'xml'
+            try:
+                query = fql.Query(cql.cql2fql(rawquery[4:end]))
+                query.format = format
+            except cql.SyntaxError as e :
+                raise fql.SyntaxError("Error in CQL query: " + str(e))
+        else:
+            query = fql.Query(rawquery)
+        return query
+
+    @staticmethod
+    def instantiate(obj, params, now=None, memo=None):
+        """Returns a copy of the compiled query (or part thereof) with the parameters bound, datetimes are set to now if specified"""
+        if memo is None:
+            memo = {}
+        if isinstance(obj, str):
+            return params.get(obj, obj)
+        elif isinstance(obj, list):
+            return [ QueryCache.instantiate(x, params, now, memo) for x in obj ]
+        elif isinstance(obj, tuple):
+            return tuple( QueryCache.instantiate(x, params, now, memo) for x in obj )
+        elif isinstance(obj, dict):
+            return { k: QueryCache.instantiate(v, params, now, memo) for k, v in obj.items() }
+        elif now is not None and isinstance(obj, datetime.datetime):
+            return now
+        elif type(obj).__module__ == fql.__name__ and not isinstance(obj, fql.UnparsedQuery):
+            if id(obj) not in memo:
+                copy = memo[id(obj)] = object.__new__(type(obj))
+                copy.__dict__ = { k: QueryCache.instantiate(v, params, now, memo) for k, v in obj.__dict__.items() }
+            return memo[id(obj)]
+        else:
+            return obj #classes, functions, etc are shared
+
+    @staticmethod
+    def datetimes(obj, found=None):
+        """Returns the number of distinct datetime values in the compiled query"""
+        if found is None:
+            found = set()
+        if isinstance(obj, (list, tuple)):
+            for x in obj: QueryCache.datetimes(x, found)
+        elif isinstance(obj, dict):
+            for x in obj.values(): QueryCache.datetimes(x, found)
+        elif isinstance(obj, datetime.datetime):
+            found.add(id(obj))
+        elif type(obj).__module__ == fql.__name__ and not isinstance(obj, fql.UnparsedQuery):
+            for x in obj.__dict__.values(): QueryCache.datetimes(x, found)
+        return len(found)
+
+    def get(self, rawquery):
+        """Returns a (fresh) parsed query for the given query text"""
+        if not self.maxsize:
+            return self.compile(rawquery)
+        prepared, params = self.prepare(rawquery)
+        with self.lock:
+            entry = self.queries.get(prepared)
+            if entry is not None:
+                self.queries.move_to_end(prepared)
+                self.hits += 1
+        if entry is None:
+            try:
+                query = self.compile(prepared)
+            except fql.SyntaxError:
+                if not params:
+                    raise
+                #parse the query as it was given, so errors refer to the IDs rather than to their parameters
+                with self.lock:
+                    self.uncacheable += 1
+                return self.compile(rawquery.strip())
+            #'now' is evaluated when the query is parsed, so it has to be re-evaluated for every execution
+            nows = len(self.NOWPATTERN.findall(prepared))
+            if nows and self.datetimes(query) != nows: #mix of 'now' and literal datetimes
+                with self.lock:
+                    self.uncacheable += 1
+                return self.instantiate(query, params)
+            entry = (query, nows > 0)
+            with self.lock:
+                self.misses += 1
+                self.queries[prepared] = entry
+                while len(self.queries) > self.maxsize:
+                    self.queries.popitem(last=False)
+        query, refreshnow = entry
+        return self.instantiate(query, params, datetime.datetime.now() if refreshnow else None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.queries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'uncacheable': self.uncacheable,
+            }
+
+
+class CursorStore:
+    """Query results of responses that were cut short (by the render budget or the element limit), kept server-side so
+    clients can continue from where the response stopped, using an opaque cursor ID. Cursors expire after ttl seconds"""
+
+    def __init__(self, ttl=300, maxsize=256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.cursors = OrderedDict() #cursor ID => cursor (dict), least recently stored first
+        self.lock = threading.Lock()
+        #telemetry
+        self.created = 0
+        self.continued = 0
+        self.expired = 0
+
+    @staticmethod
+    def newid(shard=None):
+        """Returns a new cursor ID, prefixed with the worker that holds the cursor in --workers mode"""
+        return (str(shard) + "-" if shard is not None else "") + secrets.token_hex(16)
+
+    @staticmethod
+    def shard(cursorid):
+        """Returns the worker holding the cursor (--workers mode)"""
+        try:
+            return int(cursorid.split("-",1)[0]) if "-" in cursorid else 0
+        except ValueError:
+            return 0
+
+    def add(self, cursorid, cursor):
+        with self.lock:
+            if 'expires' not in cursor:
+                self.created += 1
+            cursor['expires'] = time.time() + self.ttl
+            self.cursors[cursorid] = cursor
+            self.cursors.move_to_end(cursorid)
+            self.prune()
+
+    def take(self, cursorid):
+        """Removes and returns the cursor (None if it does not exist or has expired), it is added again if results remain"""
+        with self.lock:
+            self.prune()
+            cursor = self.cursors.pop(cursorid, None)
+            if cursor is not None:
+                self.continued += 1
+            return cursor
+
+    def discardall(self, key):
+        """Discards all cursors on the specified document"""
+        with self.lock:
+            for cursorid in [ cursorid for cursorid, cursor in self.cursors.items() if cursor['key'] == key ]:
+                del self.cursors[cursorid]
+
+    def prune(self):
+        """Removes expired cursors and the least recently stored ones beyond maxsize, should be called whilst holding the lock"""
+        now = time.time()
+        while self.cursors:
+            cursorid, cursor = next(iter(self.cursors.items()))
+            if cursor['expires'] > now and len(self.cursors) <= self.maxsize:
+                break
+            del self.cursors[cursorid]
+            self.expired += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.cursors),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'created': self.created,
+                'continued': self.continued,
+                'expired': self.expired,
+            }
+
 class Root:
     def __init__(self,docstore,bgtask,args):
         self.docstore = docstore
@@ -493,6 +2293,42 @@ class Root:
         self.workdir = args.workdir
         self.debug = args.debug
         self.allowtextredundancy = args.allowtextredundancy
+        self.prefetchrecent = args.prefetch
+        #in --workers mode, this process only serves the documents it owns
+        self.shard = args.shard
+        self.ring = ShardRing(args.workers) if args.shard is not None else None
+        self.replicafeed = None #set in replica mode
+        self.querycache = QueryCache(args.querycache)
+        self.renderbudget = args.renderbudget #default wall-clock budget (ms) for rendering query results, 0 = unlimited
+        self.pollwait = args.pollwait #maximum time (s) a poll may wait for changes, 0 = no long-polling
+
+    def checkwritable(self):
+        """Redirects requests that would change documents to the primary (replica mode)"""
+        if self.docstore.primary:
+            url = self.docstore.primary + cherrypy.request.path_info
+            if cherrypy.request.query_string:
+                url += "?" + cherrypy.request.query_string
+            raise cherrypy.HTTPRedirect(url, 307) #307 preserves method and body
+
+    def checkstaleness(self, maxlag):
+        """Ensures the replica does not lag behind the primary more than maxlag seconds (if set), waits a little if needed or redirects to the primary (replica mode)"""
+        if self.replicafeed and maxlag is not None:
+            try:
+                maxlag = float(maxlag)
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Expected numeric maxlag")
+            if not self.replicafeed.waitsync(maxlag, min(maxlag, 5)):
+                log("Replica lags behind too far (" + str(round(self.replicafeed.staleness(),3)) + "s), redirecting to primary")
+                self.checkwritable()
+
+    def owns(self, key):
+        """Is the document served by this process? (always true unless in --workers mode)"""
+        return self.ring is None or self.ring.owner(key) == self.shard
+
+    def checkowner(self, key):
+        """Refuses requests for documents served by another worker (--workers mode), two processes must never hold the same document"""
+        if not self.owns(key):
+            raise cherrypy.HTTPError(409, "Document " + "/".join(key) + " is served by another worker, a request can not address documents of different workers")
 
     def setsession(self,namespace,docid, sid=None, results=None):
         """Create or update a session"""
@@ -508,6 +2344,8 @@ class Root:
                         for result in queryresults:
                             if result.id:
                                 self.docstore.updateq[(namespace,docid)][othersid].add(result.id)
+            if results:
+                self.docstore.notifyupdates((namespace,docid))
 
     def addtochangelog(self, doc, query, docselector):
         if self.docstore.git:
@@ -520,8 +2358,92 @@ class Root:
                         changemsg += " by " + query.action.assignments['annotator']
                     self.docstore.changelog[docselector].append(changemsg)
 
+    def newcursor(self, key, doc, results, format):
+        """Returns a cursor on the given query results"""
+        return {
+            'key': key,
+            'doc': doc,
+            'partial': self.docstore.data.get(self.docstore.resolve(key)) is not doc, #answered from a partially loaded document
+            'revision': self.docstore.revision.get(key, 0),
+            'results': results,
+            'format': format,
+            'position': (0,0), #(query index, result index) to continue from
+        }
+
+    def renderresults(self, cursor, cursorid=None, deadline=None, limit=0, continued=False, stream=False, **flatargs):
+        """Renders the query results of the cursor from its position onwards (FLAT, xml or json format), until the deadline or limit
+        is reached. Returns the response in parts. If results remain, the cursor is stored under the given ID (if any) to continue from.
+
+        With stream set, a FLAT response is returned as a generator that renders it while it is being sent (see streamflat()); the
+        X-Cursor header can then not be set, the cursor is only reported in the response itself"""
+        key = cursor['key']
+        if not cursor['partial']:
+            if continued and key not in self.docstore:
+                raise cherrypy.HTTPError(410, "Cursor expired, the document was unloaded")
+            self.docstore.use(key, shared=True)
+        streaming = False
+        try:
+            if continued and (self.docstore.revision.get(key, 0) != cursor['revision'] or (not cursor['partial'] and self.docstore.data.get(self.docstore.resolve(key)) is not cursor['doc'])):
+                raise cherrypy.HTTPError(410, "Cursor expired, the document has changed")
+            if cursor['format'] == "flat":
+                bookkeeper = Bookkeeper(deadline, limit)
+                if stream:
+                    out = self.streamflat(cursor, cursorid, bookkeeper, **flatargs)
+                    streaming = True #the lock is released by the generator from here on
+                    first = next(out) #renders the first batch (whilst we hold the lock) and releases the lock
+                    return itertools.chain([first], out)
+                #the response is encoded element by element (rather than as one big structure), it is sent once the lock is released
+                out = list(iterresults(cursor['results'], cursor['doc'], rendercache=None if cursor['partial'] else self.docstore.rendercache(key), docinfo=None if cursor['partial'] else self.docstore.docinfo(key), bookkeeper=bookkeeper, start=cursor['position'], cursor=cursorid, **flatargs))
+                resume = bookkeeper.resume
+            else:
+                out, resume = renderpage(cursor['results'], cursor['format'], cursor['position'], deadline, limit)
+        finally:
+            if not cursor['partial'] and not streaming: self.docstore.done(key)
+        if cursorid and resume is not None:
+            cursor['position'] = resume
+            self.docstore.cursors.add(cursorid, cursor)
+            cherrypy.response.headers['X-Cursor'] = cursorid
+        return out
+
+    def streamflat(self, cursor, cursorid, bookkeeper, **flatargs):
+        """Generator rendering the FLAT response for the cursor in batches (of about STREAMBATCH bytes) while it is being sent, so
+        it is never held in memory as a whole. Every batch is rendered whilst holding a shared lock on the document, which is released
+        before the batch is sent (the caller holds it for the first batch). If the document changes in between, rendering stops and
+        the response refers to the cursor, which has then expired"""
+        key = cursor['key']
+        out = iterresults(cursor['results'], cursor['doc'], rendercache=None if cursor['partial'] else self.docstore.rendercache(key), docinfo=None if cursor['partial'] else self.docstore.docinfo(key), bookkeeper=bookkeeper, start=cursor['position'], cursor=cursorid, **flatargs)
+        locked = not cursor['partial']
+        while True:
+            batch = []
+            size = 0
+            finished = False
+            try:
+                if not locked and not cursor['partial']:
+                    self.docstore.use(key, shared=True)
+                    locked = True
+                    if self.docstore.revision.get(key, 0) != cursor['revision'] or self.docstore.data.get(self.docstore.resolve(key)) is not cursor['doc']:
+                        bookkeeper.interrupted = True
+                while size < STREAMBATCH:
+                    part = next(out, None)
+                    if part is None:
+                        finished = True
+                        break
+                    batch.append(part)
+                    size += len(part)
+            finally:
+                if locked:
+                    self.docstore.done(key)
+                    locked = False
+            if finished and cursorid and bookkeeper.resume is not None:
+                cursor['position'] = bookkeeper.resume
+                self.docstore.cursors.add(cursorid, cursor)
+            yield b"".join(batch)
+            if finished:
+                return
+
     @cherrypy.expose
     def createnamespace(self, *namespaceargs):
+        self.checkwritable()
         namespace = validatenamespace('/'.join(namespaceargs))
         if not os.path.exists(self.workdir + '/' + namespace):
             try:
@@ -532,6 +2454,68 @@ class Root:
         return "ok"
 
 
+    @cherrypy.expose
+    def stats(self):
+        """Returns run-time statistics of the document server (JSON)"""
+        cherrypy.response.headers['Content-Type']= 'application/json'
+        with self.docstore.lrulock: #loader threads modify these sets
+            pinned = list(self.docstore.pinned)
+            prefetching = list(self.docstore.prefetching)
+        return json.dumps({
+            'version': VERSION,
+            'loaded': len(self.docstore),
+            'locks': self.docstore.lock.stats(),
+            'memory': {
+                'usage': self.docstore.memoryusage(),
+                'budget': self.docstore.memorybudget,
+                'maxdocuments': self.docstore.maxdocuments,
+                'pressure': round(self.docstore.memorypressure(),3),
+            },
+            'pinned': [ "/".join(key) for key in pinned ],
+            'prefetching': [ "/".join(key) for key in prefetching ],
+            'pendingsaves': [ "/".join(key) for key in list(self.docstore.pendingsaves) ],
+            'snapshots': self.docstore.snapshots.stats() if self.docstore.snapshots else None,
+            'partial': [ "/".join(key[:2]) + "#" + str(key[2]) for key in list(self.docstore.partials) ],
+            'querycache': self.querycache.stats(),
+            'rendercache': { "/".join(key): cache.stats() for key, cache in list(self.docstore.rendercaches.items()) },
+            'cursors': self.docstore.cursors.stats(),
+            'polls': {'waiting': self.docstore.pollers, 'max': self.docstore.maxpollers, 'refused': self.docstore.pollersrefused},
+            'replication': self.replicafeed.stats() if self.replicafeed else {'role': 'primary', 'seq': self.docstore.changeseq},
+        }).encode('utf-8')
+
+    @cherrypy.expose
+    def changes(self, since=0, timeout=0):
+        """Change feed for replicas: returns all changes after the specified sequence number, waiting at most timeout seconds for them (JSON)"""
+        cherrypy.response.headers['Content-Type']= 'application/json'
+        try:
+            since = int(since)
+            timeout = min(float(timeout), 60)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Expected numeric since and timeout")
+        seq, entries = self.docstore.getchanges(since, timeout)
+        return json.dumps({'seq': seq, 'entries': entries}).encode('utf-8')
+
+    @cherrypy.expose
+    def replicate(self, *args):
+        """Returns the state of the document for a replica (JSON): the sequence number of the last change included, and the document itself if it differs from the one on disk"""
+        namespace, docid = self.docselector(*args)
+        key = (namespace, docid)
+        cherrypy.response.headers['Content-Type']= 'application/json'
+        state = {'seq': self.docstore.changeseq}
+        if key in self.docstore:
+            self.docstore.use(key, shared=True)
+            try:
+                if self.docstore.data[key].changed:
+                    state = {'seq': self.docstore.changeseq, 'xml': self.docstore.serialize(key).decode('utf-8')}
+            finally:
+                self.docstore.done(key)
+        if 'xml' not in state:
+            #documents that are not loaded or unchanged are up to date on disk
+            if not os.path.exists(self.docstore.getfilename(key)):
+                raise cherrypy.HTTPError(404, "Document not found: " + namespace + "/" + docid)
+            state['signature'] = SnapshotCache.signature(self.docstore.getfilename(key))
+        return json.dumps(state).encode('utf-8')
+
     @cherrypy.expose
     def flush(self):
         log("Flush called")
@@ -540,6 +2524,7 @@ class Root:
         return "done"
 
     @cherrypy.expose
+    @compressible
     def query(self, **kwargs):
         """Query method, all FQL queries arrive here"""
 
@@ -548,6 +2533,34 @@ class Root:
         else:
             sid = 'NOSID'
 
+        #Results are rendered until the budget (wall-clock time in ms) or limit (number of results) is reached, the remainder is
+        #kept behind a cursor to continue from
+        try:
+            budget = float(kwargs.get('budget', self.renderbudget))
+            limit = max(int(kwargs.get('limit', 0)), 0)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Expected numeric budget and limit")
+        paged = budget > 0 or limit > 0
+
+        #Get parameters for FLAT-specific return format
+        flatargs = getflatargs(cherrypy.request.params)
+        flatargs['debug'] = self.debug
+        flatargs['logfunction'] = log
+        flatargs['version'] = VERSION
+
+        if 'query' not in kwargs and kwargs.get('cursor'):
+            #continue with the results of an earlier query
+            cursor = self.docstore.cursors.take(kwargs['cursor'])
+            if cursor is None:
+                raise cherrypy.HTTPError(410, "Cursor expired or unknown")
+            log("[CONTINUING QUERY ON " + "/".join(cursor['key']) + "] cursor=" + kwargs['cursor'])
+            out = self.renderresults(cursor, kwargs['cursor'], time.time() + budget / 1000 if budget > 0 else None, limit, continued=True, stream=not paged, **flatargs)
+            cherrypy.response.headers['Content-Type']= 'text/xml' if cursor['format'] == "xml" else 'application/json'
+            cherrypy.response.stream = True
+            if not isinstance(out, list):
+                return compressresponse(out, STREAMSIZE)
+            return compressresponse(streamresults(out, cursor['format']), sum(len(chunk) for chunk in out))
+
         if 'query' in kwargs:
             rawqueries = kwargs['query'].split("\n")
         else:
@@ -558,12 +2571,6 @@ class Root:
             for i,rawquery in enumerate(rawqueries):
                 log("[QUERY INCOMING #" + str(i+1) + ", SID=" +sid + "] " + rawquery)
 
-        #Get parameters for FLAT-specific return format
-        flatargs = getflatargs(cherrypy.request.params)
-        flatargs['debug'] = self.debug
-        flatargs['logfunction'] = log
-        flatargs['version'] = VERSION
-
         prevdocsel = None
         sessiondocsel = None
         queries = []
@@ -573,27 +2580,14 @@ class Root:
                 docsel, rawquery = getdocumentselector(rawquery)
                 rawquery = rawquery.replace("$FOLIADOCSERVE_PROCESSOR", PROCESSOR_FOLIADOCSERVE)
                 if not docsel: docsel = prevdocsel
-                self.docstore.use(docsel)
-                if self.debug >= 2: log("[acquired lock " + "/".join(docsel)+"]")
                 if not sessiondocsel: sessiondocsel = docsel
+                if docsel: self.checkowner(docsel)
                 if rawquery == "GET":
                     query = "GET"
                 elif rawquery == "PROBE":
                     query = "PROBE" #gets no content data at all, but allows returning associated metadata used by FLAT, forces FLAT format
                 else:
-                    if rawquery[:4] == "CQL ":
-                        if rawquery.find('FORMAT') != -1:
-                            end = rawquery.find('FORMAT')
-                            format = rawquery[end+7:]
-                        else:
-                            end = 9999
-                            format = 'xml'
-                        try:
-                            query = fql.Query(cql.cql2fql(rawquery[4:end]))
-                            query.format = format
-                        except cql.SyntaxError as e :
-                            raise fql.SyntaxError("Error in CQL query: " + str(e))
-                    elif rawquery[:5] == "META ":
+                    if rawquery[:5] == "META ":
                         try:
                             key, value = rawquery[5:].split('=',maxsplit=1)
                         except ValueError:
@@ -603,7 +2597,7 @@ class Root:
                         metachanges[key] = value
                         query = None
                     else:
-                        query = fql.Query(rawquery)
+                        query = self.querycache.get(rawquery)
                     if query and query.format == "python":
                         query.format = "xml"
                     if query and query.action and not docsel:
@@ -612,40 +2606,54 @@ class Root:
                 log("[QUERY ON " + "/".join(docsel)  + "] " + str(rawquery))
                 log("[QUERY FAILED] FQL Syntax Error: " + str(e))
                 raise cherrypy.HTTPError(404, "FQL syntax error: " + str(e))
-            finally:
-                if self.debug >= 2: log("[releasing lock " + "/".join(docsel))
-                self.docstore.done(docsel)
 
             if query:
-                queries.append( (query, rawquery))
+                queries.append( (query, rawquery, docsel))
             prevdocsel = docsel
 
+        renderformat = None #format of paged xml/json results, which are only serialized once rendered
+        if paged and len(set(docsel for _, _, docsel in queries)) == 1 and docsel and docsel[0] != "testflat":
+            for query, _, _ in queries:
+                if isinstance(query, fql.Query) and query.format in ("xml","json"):
+                    renderformat = query.format
+                    query.format = "python"
+
+        if self.docstore.primary and (metachanges or not all(isreadonly(query) for query, _, _ in queries)):
+            self.checkwritable() #changes are made on the primary
+        self.checkstaleness(kwargs.get('maxlag'))
 
         if metachanges:
+            self.docstore.use(docsel)
             try:
-                doc = self.docstore[docsel]
-            except NoSuchDocument:
-                log("[QUERY FAILED] No such document")
-                raise cherrypy.HTTPError(404, "Document not found: " + docsel[0] + "/" + docsel[1])
-            except Exception as e:
-                _exc_type, _exc_value, exc_traceback = sys.exc_info()
-                traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
-                print("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e), file=sys.stderr)
-                log("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e))
-                if logfile: traceback.print_tb(exc_traceback, limit=50, file=logfile)
-                raise cherrypy.HTTPError(404, "FoLiA error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e) + "\n\nQuery was: " + rawquery)
-
-            if doc.metadatatype == "native":
-                doc.changed = True
-                self.docstore.lastaccess[docsel][sid] = time.time()
-                log("[METADATA EDIT ON " + "/".join(docsel)  + "]")
-                for key, value in metachanges.items():
-                    if value == 'NONE':
-                        del doc.metadata[key]
-                    else:
-                        doc.metadata[key] = value
-            else:
-                raise cherrypy.HTTPError(404, "Unable to edit metadata on document with non-native metadata type (" + "/".join(docsel)+")")
+                try:
+                    doc = self.docstore[docsel]
+                except NoSuchDocument:
+                    log("[QUERY FAILED] No such document")
+                    raise cherrypy.HTTPError(404, "Document not found: " + docsel[0] + "/" + docsel[1])
+                except Exception as e:
+                    _exc_type, _exc_value, exc_traceback = sys.exc_info()
+                    traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
+                    print("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e), file=sys.stderr)
+                    log("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e))
+                    if logfile: traceback.print_tb(exc_traceback, limit=50, file=logfile)
+                    raise cherrypy.HTTPError(404, "FoLiA error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e) + "\n\nQuery was: " + rawquery)
+
+                if doc.metadatatype == "native":
+                    self.docstore.markchanged(docsel)
+                    self.docstore.lastaccess[docsel][sid] = time.time()
+                    log("[METADATA EDIT ON " + "/".join(docsel)  + "]")
+                    for key, value in metachanges.items():
+                        if value == 'NONE':
+                            del doc.metadata[key]
+                        else:
+                            doc.metadata[key] = value
+                    if self.docstore.docinfo(docsel):
+                        self.docstore.docinfo(docsel).invalidate()
+                    self.docstore.logchange(docsel, meta=metachanges)
+                else:
+                    raise cherrypy.HTTPError(404, "Unable to edit metadata on document with non-native metadata type (" + "/".join(docsel)+")")
+            finally:
+                self.docstore.done(docsel)
         else:
             doc = None #initialize document only if not already initialized by metadta changes
 
@@ -655,8 +2663,34 @@ class Root:
         prevdocid = None
         multidoc = False #are the queries over multiple distinct documents?
         format = None
-        for query, rawquery in queries:
+        precompressed = None #content coding of a (cached) compressed GET result
+        for query, rawquery, docsel in queries:
+            locked = False
+            if query == "GET" and kwargs.get('id'):
+                #GET of a single element (or range of siblings), sliced from the file if the document is not loaded
+                log("[QUERY ON " + "/".join(docsel)  + "] GET id=" + kwargs['id'])
+                try:
+                    results.append(self.docstore.getelementxml(docsel, kwargs['id'], kwargs.get('to')))
+                except NoSuchDocument:
+                    raise cherrypy.HTTPError(404, "Document not found: " + docsel[0] + "/" + docsel[1])
+                except KeyError as e:
+                    raise cherrypy.HTTPError(404, "Element not found (or not a sibling): " + str(e.args[0]))
+                format = "single-xml"
+                continue
+            elemid = singletarget(query)
+            doc = self.docstore.partial(docsel, elemid) if elemid and docsel not in self.docstore else None
+            if doc is not None:
+                #answer from the partially loaded document, the full document is not loaded
+                log("[QUERY ON " + "/".join(docsel)  + " (partial)] " + str(rawquery))
+                if prevdocid and doc.id != prevdocid:
+                    multidoc = True
+                results.append(query(doc,False,self.debug >= 2))
+                format = query.format
+                prevdocid = doc.id
+                continue
             try:
+                self.docstore.use(docsel, shared=isreadonly(query))
+                locked = True
                 doc = self.docstore[docsel]
                 self.docstore.lastaccess[docsel][sid] = time.time()
                 log("[QUERY ON " + "/".join(docsel)  + "] " + str(rawquery))
@@ -665,17 +2699,25 @@ class Root:
                         multidoc = True
                     result =  query(doc,False,self.debug >= 2)
                     results.append(result) #False = nowrap
-                    if query.action and query.action.action in ('EDIT','ADD','DELETE', 'SUBSTITUTE','PREPEND','APPEND'):
+                    if query.action and not isreadonly(query):
                         #results of edits should be transferred to other open sessions
                         xresults.append(result)
                     if self.debug:
                         log("[QUERY RESULT] " + repr(result))
                     format = query.format
-                    if query.action and query.action.action != "SELECT":
-                        doc.changed = True
+                    if not isreadonly(query): #also a SELECT with subactions or declarations that change the document
+                        self.docstore.markchanged(docsel)
                         self.addtochangelog(doc, query, docsel)
+                        self.docstore.logchange(docsel, query=rawquery)
+                        if self.docstore.rendercache(docsel):
+                            self.docstore.rendercache(docsel).invalidate(result, query)
+                        if self.docstore.docinfo(docsel):
+                            self.docstore.docinfo(docsel).invalidate(result, query)
                 elif query == "GET":
-                    results.append(doc.xmlstring())
+                    if len(queries) == 1 and docsel[0] != "testflat" and not self.debug:
+                        #the response is streamed as is (see below), so it can be sent as it is cached in compressed form
+                        precompressed = acceptencoding()
+                    results.append(self.docstore.serialize(docsel, precompressed))
                     format = "single-xml"
                 elif query == "PROBE":
                     #no queries to perform
@@ -689,6 +2731,8 @@ class Root:
                 else:
                     log("[QUERY FAILED] No such document")
                     raise cherrypy.HTTPError(404, "Document not found: " + docsel[0] + "/" + docsel[1])
+            except LockTimeout:
+                raise
             except fql.QueryError as e:
                 log("[QUERY FAILED] FQL Query Error: " + str(e))
                 raise cherrypy.HTTPError(404, "FQL query error: " + str(e))
@@ -699,6 +2743,8 @@ class Root:
                 print("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e), file=sys.stderr)
                 if logfile: traceback.print_tb(exc_traceback, limit=50, file=logfile)
                 raise cherrypy.HTTPError(404, "FoLiA error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e) + "\n\nQuery was: " + rawquery)
+            finally:
+                if locked: self.docstore.done(docsel)
             prevdocid = doc.id
 
         if not format:
@@ -706,13 +2752,24 @@ class Root:
                 return "{\"version\":\"" + VERSION + "\"}"
             else:
                 raise cherrypy.HTTPError(404, "No queries given")
+        if format == "python" and renderformat:
+            format = renderformat
+            results = self.renderresults(self.newcursor(docsel, doc, results, format), CursorStore.newid(self.shard), time.time() + budget / 1000 if budget > 0 else None, limit)
         if format.endswith('xml'):
             cherrypy.response.headers['Content-Type']= 'text/xml'
         elif format.endswith('json'):
             cherrypy.response.headers['Content-Type']= 'application/json'
 
 
-        if format == "xml":
+        if format in ("xml", "json", "single-xml") and docsel[0] != "testflat" and not self.debug:
+            #stream the results rather than building (and encoding) one big response
+            if format == "single-xml" and len(results) > 1:
+                raise cherrypy.HTTPError(404, "Multiple results were obtained but format dictates only one can be returned!")
+            cherrypy.response.stream = True
+            if precompressed and format == "single-xml":
+                cherrypy.response.headers['Content-Encoding'] = precompressed
+            return compressresponse(streamresults(results, format), sum(len(result) for result in results))
+        elif format == "xml":
             out = "<results>" + "\n".join(results) + "</results>"
         elif format == "json":
             out = "[" + ",".join(results) + "]"
@@ -723,8 +2780,22 @@ class Root:
             if multidoc:
                 return "{\"version\":\""+ VERSION +"\"} //multidoc response, not producing results"
             elif doc:
+                extra = {}
+                if docsel[0] == "testflat":
+                    testresult = self.docstore.save(docsel) #won't save, will run tests instead
+                    log("Test result: " +str(repr(testresult)))
+                    extra = {'testresult': testresult[0], 'testmessage': testresult[1], 'queries': rawqueries}
                 log("[Parsing results for FLAT]")
-                out =  parseresults(results, doc, **flatargs)
+                cursorid = CursorStore.newid(self.shard) if docsel[0] != "testflat" else None
+                streamed = docsel[0] != "testflat" and not self.debug
+                #paged responses are rendered before they are sent, so the X-Cursor header can be set
+                out = self.renderresults(self.newcursor(docsel, doc, results, format), cursorid, time.time() + budget / 1000 if budget > 0 else None, limit, stream=streamed and not paged, extra=extra, **flatargs)
+                if streamed:
+                    cherrypy.response.stream = True
+                    if not isinstance(out, list):
+                        return compressresponse(out, STREAMSIZE)
+                    return compressresponse(streamresults(out, format), sum(len(chunk) for chunk in out))
+                out = b"".join(out)
         else:
             if len(results) > 1:
                 raise cherrypy.HTTPError(404, "Multiple results were obtained but format dictates only one can be returned!")
@@ -733,22 +2804,17 @@ class Root:
 
 
         if docsel[0] == "testflat":
-            testresult = self.docstore.save(docsel) #won't save, will run tests instead
-            log("Test result: " +str(repr(testresult)))
-
-
-            if format == "flat":
-                out = json.loads(out)
-                out['testresult'] = testresult[0]
-                out['testmessage'] = testresult[1]
-                out['queries'] = rawqueries
-                out = json.dumps(out)
+            if format != "flat": #FLAT responses include the test result already
+                testresult = self.docstore.save(docsel) #won't save, will run tests instead
+                log("Test result: " +str(repr(testresult)))
 
             #unload the document, we want a fresh copy every time
-            del self.docstore.data[('testflat','testflat')]
+            self.docstore.unload(('testflat','testflat'), save=False)
 
         if self.debug:
-            if isinstance(out,bytes):
+            if 'Content-Encoding' in cherrypy.response.headers:
+                log("[FINAL RESULTS] " + str(len(out)) + " bytes, compressed (" + cherrypy.response.headers['Content-Encoding'] + ")")
+            elif isinstance(out,bytes):
                 log("[FINAL RESULTS] " + str(out,'utf-8'))
             else:
                 log("[FINAL RESULTS] " + out)
@@ -766,47 +2832,89 @@ class Root:
 
 
     @cherrypy.expose
-    def getdochistory(self, *args):
+    def getdochistory(self, *args, offset=0, limit=0, since=None):
         namespace, docid = self.docselector(*args)
         log("Returning history for document " + "/".join((namespace,docid)))
         cherrypy.response.headers['Content-Type'] = 'application/json'
         if not os.path.exists(self.docstore.getfilename((namespace,docid))):
             raise cherrypy.HTTPError(404, "Document not found")
+        try:
+            offset = max(int(offset), 0)
+            limit = max(int(limit), 0)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Expected numeric offset and limit")
         if self.docstore.git:
-            log("Invoking git log " + namespace+"/"+docid + ".folia.xml")
-            if os.path.exists(self.workdir + '/.git'):
-                dir = self.workdir
-            else:
-                dir = self.docstore.getpath((namespace,docid))
-            os.chdir(dir)
-            proc = subprocess.Popen("git log " + docid + ".folia.xml", stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True,cwd=dir)
-            outs, errs = proc.communicate()
-            if errs: log("git log errors? " + errs.decode('utf-8'))
-            d = {'history':[], 'version': VERSION}
-            count = 0
-            for commit, date, msg in parsegitlog(outs.decode('utf-8')):
-                count += 1
-                d['history'].append( {'commit': commit, 'date': date, 'msg':msg})
-            if count == 0: log("git log output: " + outs.decode('utf-8'))
-            log(str(count) + " revisions found - " + errs.decode('utf-8'))
-            return json.dumps(d).encode('utf-8')
+            self.docstore.flushsave((namespace,docid)) #history should include pending write-behind saves
+            try:
+                total, history = self.docstore.gitworker((namespace,docid)).gethistory(self.docstore.getfilename((namespace,docid)), offset, limit, since)
+            except KeyError:
+                raise cherrypy.HTTPError(404, "Commit not found in history of document: " + str(since))
+            log(str(len(history)) + " of " + str(total) + " revisions returned")
+            return json.dumps({'history': history, 'total': total, 'version': VERSION}).encode('utf-8')
         else:
-            return json.dumps({'history': [], 'version': VERSION}).encode('utf-8')
+            return json.dumps({'history': [], 'total': 0, 'version': VERSION}).encode('utf-8')
+
+    @cherrypy.expose
+    def getelement(self, *args, id=None, to=None): #pylint: disable=redefined-builtin
+        """Returns the XML of the element with the specified ID (or of a range of sibling elements up to and including the one with ID 'to'), without loading the document if possible"""
+        namespace, docid = self.docselector(*args)
+        if not id:
+            raise cherrypy.HTTPError(400, "Expected an element ID (id=)")
+        try:
+            xml = self.docstore.getelementxml((namespace,docid), id, to)
+        except NoSuchDocument:
+            raise cherrypy.HTTPError(404, "Document not found: " + namespace + "/" + docid)
+        except KeyError as e:
+            raise cherrypy.HTTPError(404, "Element not found (or not a sibling): " + str(e.args[0]))
+        cherrypy.response.headers['Content-Type'] = 'text/xml; charset=utf-8'
+        return xml.encode('utf-8')
 
     @cherrypy.expose
     def save(self, *args, message=""):
+        self.checkwritable()
         cherrypy.response.headers['Content-Type'] = 'application/json'
         namespace, docid = self.docselector(*args)
         if (namespace,docid) in self.docstore:
-            #self.bgtask.put( self.docstore.save, (namespace,docid), message)
-            self.docstore.save( (namespace,docid), message)
-            return b"{\"saved\":1, \"version\": \"" + VERSION.encode('utf-8')+ b"\"}"
+            if self.docstore.journaling:
+                #changes are already durable in the journal, the document is saved in full when the journal is compacted
+                if message: self.docstore.changelog[(namespace,docid)].append(message)
+                ticket = self.docstore.revision.get((namespace,docid), 0)
+            elif self.docstore.writebehind:
+                #coalesce with other saves, the actual save is performed by the SaveScheduler
+                ticket = self.docstore.schedulesave( (namespace,docid), message)
+            else:
+                ticket = self.docstore.revision.get((namespace,docid), 0)
+                self.docstore.save( (namespace,docid), message)
+            return json.dumps({'saved': 1, 'ticket': ticket, 'version': VERSION}).encode('utf-8')
         else:
             return b"{\"saved\":0, \"version\": \"" + VERSION.encode('utf-8')+ b"\"}"
 
+    @cherrypy.expose
+    def savestatus(self, *args, ticket=None, timeout=0):
+        """Reports whether the document has been saved to disk up to the revision of the ticket (as returned by save), optionally waiting for at most timeout seconds"""
+        self.checkwritable()
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        namespace, docid = self.docselector(*args)
+        key = (namespace,docid)
+        try:
+            ticket = int(ticket) if ticket is not None else self.docstore.revision.get(key, 0)
+            timeout = min(float(timeout), 60)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Expected numeric ticket and timeout")
+        saved = self.docstore.waitsave(key, ticket, timeout)
+        return json.dumps({
+            'saved': int(saved),
+            'ticket': ticket,
+            'revision': self.docstore.revision.get(key, 0),
+            'savedrevision': self.docstore.savedrevision.get(key, 0),
+            'pending': int(key in self.docstore.pendingsaves),
+            'version': VERSION
+        }).encode('utf-8')
+
 
     @cherrypy.expose
     def revert(self, *args, commithash=None):
+        self.checkwritable()
         if not commithash:
             raise cherrypy.HTTPError(400, "Expected commithash")
 
@@ -817,16 +2925,14 @@ class Root:
         if self.docstore.git:
             namespace, docid = self.docselector(*args)
             key = (namespace,docid)
-            os.chdir(os.path.join(self.workdir,namespace))
 
             if key in self.docstore:
                 #unload document (will even still save it if not done yet, cause we need a clean workdir)
                 self.docstore.unload(key)
 
             log("Doing git revert for " + self.docstore.getfilename(key) )
-            r = os.system("git checkout " + commithash + " " + self.docstore.getfilename(key) + " && git commit -m \"Reverting to commit " + commithash + "\"")
-            if r != 0:
-                log("Error during git revert of " + self.docstore.getfilename(key))
+            self.docstore.gitworker(key).revert(self.docstore.getfilename(key), commithash)
+            self.docstore.publish(key, reload=True)
             return b"{\"version\": \"" + VERSION.encode('utf-8')+ b"\"}"
         else:
             return b"{\"version\": \"" + VERSION.encode('utf-8')+ b"\"}"
@@ -868,8 +2974,16 @@ class Root:
 
 
     @cherrypy.expose
-    def poll(self, *args):
+    @compressible
+    def poll(self, *args, maxlag=None, timeout=0):
+        """Returns the elements changed by other sessions since the last poll of this session (FLAT format). With a timeout (long-polling),
+        waits at most that many seconds (capped by --pollwait) for changes rather than returning immediately if there are none"""
         namespace, docid = self.docselector(*args)
+        self.checkstaleness(maxlag)
+        try:
+            timeout = min(max(float(timeout), 0), self.pollwait)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Expected numeric timeout")
 
         if 'X-Sessionid' in cherrypy.request.headers:
             sid = cherrypy.request.headers['X-Sessionid']
@@ -885,14 +2999,23 @@ class Root:
 
         self.checkexpireconcurrency()
 
-        if sid in self.docstore.updateq[(namespace,docid)]:
+        if timeout:
+            #long-polling: wait for other sessions to queue changes for this one
+            self.docstore.waitupdates((namespace,docid), sid, timeout)
+            self.docstore.lastaccess[(namespace,docid)][sid] = time.time()
+
+        if sid in self.docstore.updateq.get((namespace,docid), {}): #no indexing, updateq is a defaultdict
             ids = self.docstore.updateq[(namespace,docid)][sid]
             self.docstore.updateq[(namespace,docid)][sid] = set() #reset
             if ids:
                 cherrypy.log("Successful poll from session " + sid + " for " + "/".join((namespace,docid)) + ", returning IDs: " + " ".join(ids))
-                doc = self.docstore[(namespace,docid)]
-                results = [[ doc[id] for id in ids if id in doc ]] #results are grouped by query, but we lose that distinction here and group them all in one, hence the double list
-                return parseresults(results, doc, **{'version': VERSION, 'sid':sid, 'lastaccess': self.docstore.lastaccess[(namespace,docid)]})
+                self.docstore.use((namespace,docid), shared=True)
+                try:
+                    doc = self.docstore[(namespace,docid)]
+                    results = [[ doc[id] for id in ids if id in doc ]] #results are grouped by query, but we lose that distinction here and group them all in one, hence the double list
+                    return parseresults(results, doc, **{'version': VERSION, 'sid':sid, 'lastaccess': self.docstore.lastaccess[(namespace,docid)], 'rendercache': self.docstore.rendercache((namespace,docid)), 'docinfo': self.docstore.docinfo((namespace,docid))})
+                finally:
+                    self.docstore.done((namespace,docid))
             else:
                 return json.dumps({'sessions': len([s for s in self.docstore.lastaccess[(namespace,docid)] if s != 'NOSID' ])}).encode('utf-8')
         else:
@@ -918,21 +3041,39 @@ class Root:
         })
 
     @cherrypy.expose
+    @compressible
     def documents(self, *namespaceargs):
         namespace = validatenamespace('/'.join(namespaceargs))
         try:
             docs = [ x for x in os.listdir(self.docstore.workdir + "/" + namespace) if x[-10:] == ".folia.xml" ]
         except FileNotFoundError:
             raise cherrypy.HTTPError(404, "Namespace not found: " + str(namespace))
+        timestamps = { x:os.path.getmtime(self.docstore.workdir + "/" + namespace + "/"+ x) for x in docs  }
+        if self.prefetchrecent:
+            #the most recently modified documents are the most likely to be opened next, load them in the background
+            for x in sorted(docs, key=lambda x: timestamps[x], reverse=True)[:self.prefetchrecent]:
+                if self.owns((namespace, x[:-10])):
+                    self.docstore.prefetch((namespace, x[:-10]))
         return json.dumps({
             'documents': docs,
-            'timestamp': { x:os.path.getmtime(self.docstore.workdir + "/" + namespace + "/"+ x) for x in docs  },
+            'timestamp': timestamps,
             'filesize': { x:os.path.getsize(self.docstore.workdir + "/" + namespace + "/"+ x) for x in docs  }
         })
 
+    @cherrypy.expose
+    def prefetch(self, *args):
+        """Loads the document in the background"""
+        namespace, docid = self.docselector(*args)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        if not os.path.exists(self.docstore.getfilename((namespace,docid))):
+            raise cherrypy.HTTPError(404, "Document not found: " + namespace + "/" + docid)
+        self.docstore.prefetch((namespace,docid))
+        return json.dumps({'version': VERSION, 'loaded': (namespace,docid) in self.docstore, 'prefetching': (namespace,docid) in self.docstore.prefetching}).encode('utf-8')
+
 
     @cherrypy.expose
     def upload(self, *namespaceargs):
+        self.checkwritable()
         namespace = validatenamespace('/'.join(namespaceargs))
         log("In upload, namespace=" + namespace)
         response = {'version':VERSION}
@@ -952,9 +3093,9 @@ class Root:
             if not self.allowtextredundancy:
                 for e in doc.data:
                     cleantextredundancy(e)
-            doc.changed = True
             response['docid'] = doc.id
             self.docstore[(namespace,doc.id)] = doc
+            self.docstore.markchanged((namespace,doc.id))
         except Exception as e:
             _exc_type, _exc_value, exc_traceback = sys.exc_info()
             formatted_lines = traceback.format_exc().splitlines()
@@ -970,10 +3111,12 @@ class Root:
             filename = self.docstore.getfilename( (namespace, doc.id + "." + str(i)))
             i += 1
         self.docstore.save((namespace,doc.id), "Initial upload")
+        self.docstore.publish((namespace,doc.id), reload=True)
         return json.dumps(response).encode('utf-8')
 
     @cherrypy.expose
     def delete(self, *args):
+        self.checkwritable()
         namespace, docid = self.docselector(*args)
         log("Delete, namespace=" + namespace)
         self.docstore.delete((namespace,docid))
@@ -981,8 +3124,10 @@ class Root:
 
     @cherrypy.expose
     def copy(self, *args,**params):
+        self.checkwritable()
         if 'target' in params:
             key = self.docselector(*args)
+            self.checkowner(key) #the target is only created if it does not exist yet, so no worker can hold it
             newkey = self.docselector(*params['target'].split('/'))
             self.docstore.copy(key,newkey)
             return "{\"version\":\""+VERSION+"\"}"
@@ -991,14 +3136,153 @@ class Root:
 
     @cherrypy.expose
     def move(self, *args,**params):
+        self.checkwritable()
         if 'target' in params:
             key = self.docselector(*args)
+            self.checkowner(key) #the target is only created if it does not exist yet, so no worker can hold it
             newkey = self.docselector(*params['target'].split('/'))
             self.docstore.move(key,newkey)
             return "{\"version\":\""+VERSION+"\"}"
         else:
             raise cherrypy.HTTPError(404, "No target specified")
 
+class ShardRing:
+    """Consistent hash ring mapping documents to worker processes (see --workers)"""
+
+    def __init__(self, workers, replicas=64):
+        self.workers = workers
+        self.ring = sorted( (self.hash(str(worker) + "#" + str(i)), worker) for worker in range(workers) for i in range(replicas) )
+        self.points = [ point for point, _ in self.ring ]
+
+    @staticmethod
+    def hash(s):
+        return int(hashlib.md5(s.encode('utf-8')).hexdigest()[:16], 16)
+
+    def owner(self, key):
+        """Returns the index of the worker that owns the specified (namespace,docid) document"""
+        i = bisect.bisect(self.points, self.hash("/".join(key))) % len(self.points)
+        return self.ring[i][1]
+
+
+class Router:
+    """Front process for --workers mode: forwards each request to the worker process owning the document it concerns"""
+
+    HOPHEADERS = ('connection','keep-alive','transfer-encoding','content-length','host','server','date')
+
+    def __init__(self, workerurls, args):
+        self.workerurls = workerurls
+        self.ring = ShardRing(len(workerurls))
+        self.prefetchrecent = args.prefetch
+
+    docselector = Root.docselector
+
+    def forward(self, worker, path, querystring, body, retries=50):
+        """Forwards the current request to the specified worker, returns a (status, headers, body) tuple"""
+        url = self.workerurls[worker] + path + ("?" + querystring if querystring else "")
+        headers = { k: v for k, v in cherrypy.request.headers.items() if k.lower() not in self.HOPHEADERS }
+        request = urllib.request.Request(url, data=body if cherrypy.request.method == 'POST' else None, headers=headers, method=cherrypy.request.method)
+        for _ in range(retries):
+            try:
+                with urllib.request.urlopen(request, timeout=3600) as response:
+                    return response.status, response.getheaders(), response.read()
+            except urllib.error.HTTPError as e:
+                return e.code, e.headers.items(), e.read()
+            except urllib.error.URLError as e:
+                if not isinstance(e.reason, ConnectionRefusedError):
+                    raise
+                time.sleep(0.2) #worker is (re)starting
+        raise cherrypy.HTTPError(503, "Worker " + str(worker) + " is not available")
+
+    def route(self, args, body):
+        """Returns the worker(s) the request should be forwarded to"""
+        endpoint = args[0] if args else ""
+        if endpoint == "query":
+            if 'query' not in cherrypy.request.params and cherrypy.request.params.get('cursor'):
+                return [CursorStore.shard(cherrypy.request.params['cursor']) % len(self.workerurls)]
+            if 'query' in cherrypy.request.params:
+                rawqueries = cherrypy.request.params['query']
+            elif cherrypy.request.headers.get('Content-Type','').startswith('application/x-www-form-urlencoded'):
+                rawqueries = urllib.parse.parse_qs(body.decode('utf-8')).get('query',[""])[0]
+            else:
+                rawqueries = body.decode('utf-8')
+            owners = set()
+            for rawquery in rawqueries.split("\n"):
+                try:
+                    docsel, _ = getdocumentselector(rawquery.strip())
+                except fql.SyntaxError:
+                    break #the worker will report the error
+                if docsel:
+                    owners.add(self.ring.owner(docsel))
+            if len(owners) > 1:
+                #the workers would load (and save) documents they do not own
+                raise cherrypy.HTTPError(409, "Queries address documents served by different workers, this is not supported with --workers")
+            return list(owners) or [0]
+        elif endpoint == "changes" and len(self.workerurls) > 1:
+            #every worker has its own change feed (with its own sequence numbers), replicas can not follow them as one
+            raise cherrypy.HTTPError(501, "No change feed is available with --workers, replicating a document server with multiple workers is not supported")
+        elif endpoint in ('poll','getdochistory','getelement','save','savestatus','revert','prefetch','delete','copy','move','replicate'):
+            return [self.ring.owner(self.docselector(*args[1:]))]
+        elif endpoint == "upload":
+            #route by the ID of the uploaded document
+            match = re.search(r'<FoLiA[^>]*\sxml:id="([^"]+)"', body[:65536].decode('utf-8',errors='ignore'))
+            if match:
+                return [self.ring.owner((validatenamespace('/'.join(args[1:])), match.group(1)))]
+            return [0]
+        elif endpoint in ('stats','flush') or (endpoint == 'documents' and self.prefetchrecent):
+            return list(range(len(self.workerurls)))
+        else:
+            return [0]
+
+    @cherrypy.expose
+    def default(self, *args, **kwargs): #pylint: disable=unused-argument
+        body = cherrypy.request.rfile.read(int(cherrypy.request.headers.get('Content-Length',0))) if cherrypy.request.method == 'POST' else None
+        workers = self.route(args, body)
+        path = "/" + "/".join(urllib.parse.quote(arg) for arg in args)
+        if len(workers) == 1:
+            status, headers, data = self.forward(workers[0], path, cherrypy.request.query_string, body)
+        else:
+            #broadcast to all workers (in parallel), the response of the first worker is returned unless stats are requested
+            responses = [None] * len(workers)
+            def forwardto(i, worker):
+                responses[i] = self.forward(worker, path, cherrypy.request.query_string, body)
+            threads = [ threading.Thread(target=forwardto, args=(i, worker)) for i, worker in enumerate(workers) ]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+            status, headers, data = responses[0]
+            if args[0] == "stats":
+                data = json.dumps({'version': VERSION, 'workers': [ json.loads(response[2]) for response in responses ] }).encode('utf-8')
+        cherrypy.response.status = status
+        for k, v in headers:
+            if k.lower() not in self.HOPHEADERS:
+                cherrypy.response.headers[k] = v
+        return data
+
+
+def runfront(args):
+    """Runs the front process for --workers mode, spawning the worker processes"""
+    workerurls = []
+    workers = []
+    for i in range(args.workers):
+        port = args.workerport + i
+        workerurls.append("http://127.0.0.1:" + str(port))
+        log("Starting worker " + str(i) + " on port " + str(port))
+        #every poll waiting in a worker also occupies a thread of the front process, so the workers share --maxpollers
+        workers.append(subprocess.Popen([sys.executable, "-m", "foliadocserve.foliadocserve"] + sys.argv[1:] + ["--shard", str(i), "--port", str(port), "--host", "127.0.0.1", "--maxpollers", str(max(args.maxpollers // args.workers, 1))]))
+    def stop():
+        log("Stop signal received, stopping workers")
+        for worker in workers:
+            worker.terminate()
+        for i, worker in enumerate(workers):
+            try:
+                worker.wait(args.locktimeout + 60)
+            except subprocess.TimeoutExpired:
+                log("ERROR: Worker " + str(i) + " did not stop in time, killing it")
+                worker.kill()
+        log("Quitting")
+    cherrypy.engine.subscribe('stop', stop)
+    cherrypy.quickstart(Router(workerurls, args), config={'/': {'request.process_request_body': False}})
+
+
 def needsfoliaupgrade(data):
     if isinstance(data, bytes):
         data = str(data,'utf-8')
@@ -1015,7 +3299,7 @@ def needsfoliaupgrade(data):
 
 
 def main():
-    global logfile #pylint: disable=global-statement
+    global logfile, compressmin #pylint: disable=global-statement
     parser = argparse.ArgumentParser(description="FoLiA Document Server - Allows querying and manipulating FoLiA documents. Do not serve publicly in production use!", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-d','--workdir', type=str,help="Work directory", action='store',required=True)
     parser.add_argument('-p','--port', type=int,help="Port", action='store',default=8080,required=False)
@@ -1027,40 +3311,117 @@ def main():
     parser.add_argument('--gitmode', type=str, help="Set git mode, values are: monolithic (ALL users share a single repository, NOT recommended because of scalability); user (each user/namespace is its own git repository; this is the default); nested (each subdirectory is its own git repository, maximum scalability)", action='store', default='user')
     parser.add_argument('--expirationtime', type=int,help="Expiration time in seconds, documents will be unloaded from memory after this period of inactivity", action='store',default=900,required=False)
     parser.add_argument('--interval', type=int,help="Interval at which the unloader checks documents (in seconds)", action='store',default=60,required=False)
+    parser.add_argument('--locktimeout', type=int,help="Maximum time in seconds to wait for a lock on a document, requests that wait longer fail with HTTP 423 (0 = wait indefinitely)", action='store',default=60,required=False)
+    parser.add_argument('--memorybudget', type=int,help="Memory budget (in MB) for loaded documents, the least recently used documents are unloaded when it is exceeded (0 = unlimited)", action='store',default=0,required=False)
+    parser.add_argument('--maxdocuments', type=int,help="Maximum number of documents to keep loaded, the least recently used documents are unloaded when it is exceeded (0 = unlimited)", action='store',default=0,required=False)
+    parser.add_argument('--pin', type=str,help="Pin a document (namespace/docid): it is loaded in the background at startup and never unloaded automatically. May be specified multiple times", action='append',default=[],required=False)
+    parser.add_argument('--prefetch', type=int,help="Number of most recently modified documents in a namespace to load in the background whenever the documents in that namespace are listed", action='store',default=0,required=False)
+    parser.add_argument('--snapshotmemory', type=int,help="Memory (in MB) to reserve for compressed snapshots of unloaded documents, so reloading them need not parse the XML again, e.g. 256 (0 = disabled)", action='store',default=0,required=False)
+    parser.add_argument('--writebehind', help="Write-behind saving: save requests return immediately and are coalesced, documents are saved in the background once no further changes were saved for --savedelay seconds (or at most --maxstaleness seconds after the first pending save)", action='store_true',default=False,required=False)
+    parser.add_argument('--savedelay', type=float,help="Debounce window for write-behind saving (in seconds)", action='store',default=5,required=False)
+    parser.add_argument('--maxstaleness', type=float,help="Maximum time a write-behind save may remain pending (in seconds)", action='store',default=60,required=False)
+    parser.add_argument('--querycache', type=int,help="Number of parsed queries to cache (queries that only differ in the IDs they address share one cache entry), 0 = disabled", action='store',default=256,required=False)
+    parser.add_argument('--rendercache', type=int,help="Maximum number of rendered elements (for FLAT) to cache per loaded document, entries are invalidated when the elements are affected by changes. 0 = disabled", action='store',default=10000,required=False)
+    parser.add_argument('--renderbudget', type=int,help="Default wall-clock budget (in milliseconds) for rendering query results (FLAT, xml and json format), the remainder is kept server-side and can be obtained with the cursor returned in the X-Cursor header (and in FLAT responses). Clients may set their own budget (and a limit on the number of results) with the budget and limit parameters. 0 = unlimited", action='store',default=0,required=False)
+    parser.add_argument('--cursorttl', type=int,help="Time (in seconds) that the remainder of query results is kept for continuation with a cursor", action='store',default=300,required=False)
+    parser.add_argument('--pollwait', type=float,help="Maximum time (in seconds) a poll may wait for changes by other sessions (long-polling, requested by the client with the timeout parameter). 0 = polls always return immediately", action='store',default=30,required=False)
+    parser.add_argument('--threads', type=int,help="Number of threads handling requests; every waiting (long-polling) client occupies one, at most --maxpollers of them", action='store',default=64,required=False)
+    parser.add_argument('--maxpollers', type=int,help="Maximum number of polls that may wait for changes at once (long-polling), further polls return immediately; must be well below --threads so other requests are not starved of threads", action='store',default=32,required=False)
+    parser.add_argument('--compressmin', type=int,help="Responses (to queries, polls and document listings) of at least this size (in bytes) are compressed if the client accepts it (gzip or deflate), -1 = never compress", action='store',default=1024,required=False)
+    parser.add_argument('--lazyload', type=float,help="Documents of at least this size (in MB) are not loaded in full for simple queries on a single element (SELECT ... ID or SELECT ... FOR ID, in xml or json format); only the top-level division holding the element is loaded then. 0 = disabled", action='store',default=0,required=False)
+    parser.add_argument('--replicaof', type=str,help="Run as a read-only replica of the document server at the specified URL (e.g. http://localhost:8080), which must serve the same document root. Queries that change documents are redirected to the primary", action='store',default=None,required=False)
+    parser.add_argument('--workers', type=int,help="Number of worker processes, to make use of multiple CPU cores. Each document is served by a fixed worker (chosen by consistent hashing), a front process on --port forwards requests to the workers. Memory limits apply per worker", action='store',default=1,required=False)
+    parser.add_argument('--workerport', type=int,help="First port for the worker processes in --workers mode (they listen on localhost only), defaults to the port after --port", action='store',default=None,required=False)
+    parser.add_argument('--shard', type=int,help=argparse.SUPPRESS, action='store',default=None,required=False) #index of the worker process, set by the front process
+    parser.add_argument('--gitwindow', type=float,help="Commits to the same git repository within this time window (in seconds) are grouped into a single commit", action='store',default=2,required=False)
+    parser.add_argument('--journal', help="Journal changes: every change is appended (and synced) to a journal next to the document before it is acknowledged, the document itself is only saved in full (compacting the journal) when it is unloaded, idle (--journalidle) or when the journal grows too large (--journalsize). Journals are replayed when a document is loaded, so no changes are lost if the server crashes", action='store_true',default=False,required=False)
+    parser.add_argument('--journalidle', type=float,help="Compact the journal once a document has not been changed for this many seconds", action='store',default=300,required=False)
+    parser.add_argument('--journalsize', type=int,help="Compact the journal once it exceeds this size (in MB)", action='store',default=16,required=False)
+    parser.add_argument('--snapshotdir', type=str,help="Directory to spill snapshots of unloaded documents to when they do not fit in memory (disabled by default)", action='store',default=None,required=False)
     parser.add_argument('--ignorefail', help="Ignore failures when saving documents. By default, the document server will lock up and refuse to load new documents (requiring manual restart)", action='store_true',default=False,required=False)
     parser.add_argument('--host',type=str,help="Host/IP to listen for (defaults to all interfaces)", action='store',default="0.0.0.0")
     args = parser.parse_args()
+    if args.workerport is None:
+        args.workerport = args.port + 1
     logfile = open(args.logfile,'a',encoding='utf-8')
-    log("foliadocserve " + VERSION)
+    log("foliadocserve " + VERSION + (" [worker " + str(args.shard) + "]" if args.shard is not None else ""))
     try:
         args.workdir = os.path.realpath(args.workdir)
     except:
         log("ERROR: Document root directory " + str(args.workdir) + " does not exist")
         sys.exit(2)
     os.chdir(args.workdir)
+    if args.maxpollers > args.threads // 2:
+        log("WARNING: --maxpollers (" + str(args.maxpollers) + ") must be well below --threads (" + str(args.threads) + "), lowering it to " + str(args.threads // 2))
+        args.maxpollers = args.threads // 2
     cherrypy.config.update({
         'server.socket_host': args.host,
         'server.socket_port': args.port,
         'server.max_request_body_size' : 1024*1024*1024, #max 1GB upload (that is a lot!)
         'server.socket_timeout': 30, #30s instead of default 10s
+        'server.thread_pool': args.threads,
         'request.show_tracebacks':False,
     })
     cherrypy.process.servers.wait_for_occupied_port = fake_wait_for_occupied_port
-    docstore = DocStore(args.workdir, args.expirationtime, args.git, args.gitmode, args.gitshare, args.ignorefail, args.debug)
+    if args.workers > 1 and args.shard is None:
+        runfront(args)
+        return
+    docstore = DocStore(args.workdir, args.expirationtime, args.git, args.gitmode, args.gitshare, args.ignorefail, args.debug, args.locktimeout, args.snapshotmemory * 1024 * 1024, args.snapshotdir, args.memorybudget * 1024 * 1024, args.maxdocuments)
     bgtask = BackgroundTaskQueue(cherrypy.engine)
     bgtask.subscribe()
+    docstore.bgtask = bgtask
+    loader = BackgroundTaskQueue(cherrypy.engine)
+    loader.subscribe()
+    docstore.loader = loader
+    docstore.writebehind = args.writebehind
+    docstore.savedelay = args.savedelay
+    docstore.maxstaleness = args.maxstaleness
+    docstore.journaling = args.journal
+    docstore.gitwindow = args.gitwindow
+    docstore.lazyload = int(args.lazyload * 1024 * 1024)
+    docstore.maxpollers = args.maxpollers
+    docstore.rendercachesize = args.rendercache
+    docstore.cursors.ttl = args.cursorttl
+    compressmin = args.compressmin
+    docstore.journalidle = args.journalidle
+    docstore.journalsize = args.journalsize * 1024 * 1024
+    plugins = [bgtask, loader]
+    if args.writebehind:
+        savescheduler = SaveScheduler(cherrypy.engine, docstore, bgtask)
+        savescheduler.subscribe()
+        plugins.append(savescheduler)
+    for pin in args.pin:
+        try:
+            namespace, docid = pin.rsplit('/',1)
+        except ValueError:
+            log("ERROR: Pinned documents must be specified as namespace/docid, got: " + pin)
+            sys.exit(2)
+        if args.shard is None or ShardRing(args.workers).owner((validatenamespace(namespace), docid)) == args.shard:
+            docstore.pin((validatenamespace(namespace), docid))
+    replicafeed = None
+    if args.replicaof:
+        docstore.primary = args.replicaof.rstrip('/')
+        replicafeed = ReplicaFeed(cherrypy.engine, docstore, docstore.primary)
+        replicafeed.subscribe()
+        plugins.append(replicafeed)
     autounloader = AutoUnloader(cherrypy.engine, docstore, args.interval)
     autounloader.subscribe()
+    plugins.append(autounloader)
     def stop():
         log("Stop signal received")
+        #stop the background threads ourselves (last started first), or they would keep the process alive
+        for plugin in reversed(plugins):
+            plugin.stop()
+            plugin.unsubscribe()
         docstore.forceunload()
-        bgtask.unsubscribe()
-        autounloader.unsubscribe()
+        docstore.stopgit()
         log("Quitting")
         sys.exit(0)
     cherrypy.engine.subscribe('stop',  stop)
     cherrypy.engine.subscribe('graceful',  docstore.forceunload)
-    cherrypy.quickstart(Root(docstore,bgtask,args))
+    root = Root(docstore,bgtask,args)
+    root.replicafeed = replicafeed
+    cherrypy.quickstart(root)
 
 if __name__ == '__main__':
     print("foliadocserve " + VERSION,file=sys.stderr)
@@ -47,5 +47,6 @@ setup(
         ]
     },
     package_data = {'foliadocserve':['templates/index.html','testflat.folia.xml'] },
-    install_requires=['lxml >= 2.2','folia >= 2.5.4','pynlpl','FoLiA-tools >= 2.5.2','cherrypy','Jinja2']
+    install_requires=['lxml >= 2.2','folia >= 2.5.4','pynlpl','FoLiA-tools >= 2.5.2','cherrypy','Jinja2'],
+    extras_require={'fast': ['orjson']}
 )
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+#---------------------------------------------------------------
+# FoLiA Document Server - Benchmark for the FLAT module
+#   https://github.com/proycon/foliadocserve
+#
+#   Licensed under GPLv3
+#
+# Times the rendering of HTML text for FLAT (gethtmltext()), on the FLAT
+# test document and on random text content, optionally comparing with
+# another implementation of the FLAT module (--reference <flat.py>).
+#
+#---------------------------------------------------------------
+
+import sys
+import os
+import time
+import argparse
+import importlib.util
+import folia.main as folia
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from foliadocserve import flat #pylint: disable=wrong-import-position
+from test_flat import TESTDOC, fuzzcases, fuzzdocument #pylint: disable=wrong-import-position
+
+def benchmark(module, elements, repeat):
+    """Returns the best time (in seconds) of rendering the HTML text of all elements"""
+    best = None
+    for _ in range(repeat):
+        begintime = time.perf_counter()
+        for element in elements:
+            module.gethtmltext(element)
+        duration = time.perf_counter() - begintime
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark for the FLAT module", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--reference', type=str, help="Path to another implementation of the FLAT module (flat.py) to compare with", action='store', required=False)
+    parser.add_argument('--repeat', type=int, help="Number of runs, the best time is reported", action='store', default=5)
+    parser.add_argument('--fuzz', type=int, help="Number of paragraphs of random text content", action='store', default=5000)
+    args = parser.parse_args()
+
+    modules = [("current", flat)]
+    if args.reference:
+        spec = importlib.util.spec_from_file_location("referenceflat", args.reference)
+        referenceflat = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(referenceflat)
+        modules.append(("reference", referenceflat))
+
+    for name, doc in (("testflat", folia.Document(file=TESTDOC, loadsetdefinitions=False)), ("fuzz", fuzzdocument(fuzzcases(args.fuzz)))):
+        elements = [ element for element in doc.data[0].select(folia.AbstractStructureElement) if element.hastext() ]
+        for modulename, module in modules:
+            duration = benchmark(module, elements, args.repeat)
+            print(name + "\t" + modulename + "\t" + str(len(elements)) + " elements\t" + str(round(duration * 1000, 2)) + "ms\t" + str(round(duration / len(elements) * 1000000, 2)) + "us/element")
+
+if __name__ == "__main__":
+    main()
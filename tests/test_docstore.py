@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+#---------------------------------------------------------------
+# FoLiA Document Server - Tests for the document store
+#   https://github.com/proycon/foliadocserve
+#
+#   Licensed under GPLv3
+#
+# Tests the document locks, the journal, saving (and committing to git),
+# eviction, the change feed and the waiting for updates of the document
+# store, and the assignment of documents to workers, without the HTTP
+# interface.
+#
+#---------------------------------------------------------------
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import subprocess
+import folia.main as folia
+from folia import fql
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from foliadocserve.foliadocserve import LockManager, LockTimeout, DocStore, ShardRing #pylint: disable=wrong-import-position
+from test_server import makedocument #pylint: disable=wrong-import-position
+
+EDITS = [
+    'EDIT t WITH text "changed" FOR ID "doc.p.1.s.1.w.1"',
+    'EDIT pos WITH class "V" FOR ID "doc.p.2.s.1.w.3"',
+    'DELETE w ID "doc.p.3.s.1.w.5"',
+]
+
+def wait(condition, timeout=10):
+    """Waits until the condition (function) holds, returns whether it does"""
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class LockManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.locks = LockManager(timeout=10)
+        self.key = ("test","doc")
+        self.granted = [] #names of the threads in the order in which they obtained the lock
+        self.release = {} #name => event to release the lock of the thread
+        self.threads = []
+
+    def tearDown(self):
+        for event in self.release.values():
+            event.set()
+        for thread in self.threads:
+            thread.join(10)
+
+    def hold(self, name, shared):
+        """Starts a thread that obtains the lock and holds it until released, returns once the thread is queued for the lock"""
+        self.release[name] = threading.Event()
+        def run():
+            self.locks.acquire(self.key, shared=shared)
+            self.granted.append(name)
+            self.release[name].wait(10)
+            self.locks.release(self.key)
+        queued = len(self.locks.locks[self.key].waiting) if self.key in self.locks.locks else 0
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        self.assertTrue(wait(lambda: name in self.granted or (self.key in self.locks.locks and len(self.locks.locks[self.key].waiting) > queued)))
+
+    def test_shared(self):
+        """Shared locks are held at once"""
+        self.hold("reader1", True)
+        self.hold("reader2", True)
+        self.assertEqual(self.granted, ["reader1","reader2"])
+
+    def test_exclusive(self):
+        """An exclusive lock waits for shared locks to be released, and the other way around"""
+        self.hold("reader", True)
+        self.hold("writer", False)
+        self.hold("reader2", True)
+        self.assertEqual(self.granted, ["reader"])
+        self.release["reader"].set()
+        self.assertTrue(wait(lambda: len(self.granted) == 2))
+        self.assertEqual(self.granted, ["reader","writer"])
+        self.release["writer"].set()
+        self.assertTrue(wait(lambda: len(self.granted) == 3))
+
+    def test_fifo(self):
+        """Locks are granted in the order in which they were requested, a waiting writer is not overtaken by later readers"""
+        self.hold("writer1", False)
+        for name, shared in (("reader1", True), ("reader2", True), ("writer2", False), ("reader3", True)):
+            self.hold(name, shared)
+        self.assertEqual(self.granted, ["writer1"])
+        self.release["writer1"].set()
+        self.assertTrue(wait(lambda: len(self.granted) == 3))
+        self.assertEqual(self.granted, ["writer1","reader1","reader2"])
+        self.release["reader1"].set()
+        self.release["reader2"].set()
+        self.assertTrue(wait(lambda: len(self.granted) == 4))
+        self.assertEqual(self.granted[-1], "writer2")
+        self.release["writer2"].set()
+        self.assertTrue(wait(lambda: len(self.granted) == 5))
+
+    def test_reentrant(self):
+        self.locks.acquire(self.key)
+        self.locks.acquire(self.key, shared=True)
+        self.locks.release(self.key)
+        self.assertTrue(self.locks.holds(self.key))
+        self.locks.release(self.key)
+        self.assertFalse(self.locks.holds(self.key))
+
+    def test_upgrade(self):
+        """Requesting an exclusive lock whilst holding it shared fails"""
+        self.locks.acquire(self.key, shared=True)
+        try:
+            self.assertRaises(RuntimeError, self.locks.acquire, self.key)
+        finally:
+            self.locks.release(self.key)
+
+    def test_timeout(self):
+        self.hold("writer", False)
+        self.assertRaises(LockTimeout, self.locks.acquire, self.key, 0.1, True)
+
+
+class DocStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.workdir, "test"))
+        for docid in ("doc", "doc2", "doc3"):
+            with open(os.path.join(self.workdir, "test", docid + ".folia.xml"), 'w', encoding='utf-8') as f:
+                f.write(makedocument(docid))
+        self.key = ("test","doc")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def docstore(self, **kwargs):
+        return DocStore(self.workdir, 900, **kwargs)
+
+    @staticmethod
+    def edit(docstore, key, query):
+        """Applies a change the way the server does"""
+        docstore.use(key)
+        try:
+            fql.Query(query)(docstore[key], False)
+            docstore.markchanged(key)
+            docstore.logchange(key, query=query)
+        finally:
+            docstore.done(key)
+
+    def fromdisk(self, key):
+        return folia.Document(file=os.path.join(self.workdir, key[0], key[1] + ".folia.xml"), loadsetdefinitions=False)
+
+    def test_journal(self):
+        """The journal, replayed after a crash, gives the same document as was saved"""
+        docstore = self.docstore()
+        docstore.journaling = True
+        for query in EDITS:
+            self.edit(docstore, self.key, query)
+        expected = docstore[self.key].data[0].xmlstring() #the text body; every load adds a processor (with a new ID) to the provenance
+        self.assertTrue(os.path.exists(docstore.journalfilename(self.key)))
+        self.assertEqual(docstore.savedrevision[self.key], len(EDITS)) #durable once journaled
+        #crash: the document store is gone without saving
+        docstore = self.docstore()
+        docstore.journaling = True
+        self.assertEqual(docstore[self.key].data[0].xmlstring(), expected)
+        docstore.save(self.key)
+        self.assertFalse(os.path.exists(docstore.journalfilename(self.key)))
+        self.assertEqual(self.fromdisk(self.key).data[0].xmlstring(), expected)
+
+    def test_journal_stale(self):
+        """A journal is discarded if the document was replaced since"""
+        docstore = self.docstore()
+        docstore.journaling = True
+        self.edit(docstore, self.key, EDITS[0])
+        time.sleep(0.01)
+        with open(docstore.getfilename(self.key), 'w', encoding='utf-8') as f:
+            f.write(makedocument("doc", paragraphs=2))
+        docstore = self.docstore()
+        docstore.journaling = True
+        self.assertEqual(len(list(docstore[self.key].paragraphs())), 2)
+        self.assertEqual(docstore[self.key]["doc.p.1.s.1.w.1"].text(), "word1")
+        self.assertFalse(os.path.exists(docstore.journalfilename(self.key)))
+
+    def test_savetickets(self):
+        """A scheduled (write-behind) save completes the ticket it returned"""
+        docstore = self.docstore()
+        docstore.writebehind = True
+        self.edit(docstore, self.key, EDITS[0])
+        ticket = docstore.schedulesave(self.key, "edit")
+        self.assertEqual(ticket, 1)
+        self.assertFalse(docstore.waitsave(self.key, ticket, 0))
+        saved = []
+        waiter = threading.Thread(target=lambda: saved.append(docstore.waitsave(self.key, ticket, 10)))
+        waiter.start()
+        docstore.flushsave(self.key)
+        waiter.join(10)
+        self.assertEqual(saved, [True])
+        self.assertEqual(self.fromdisk(self.key)["doc.p.1.s.1.w.1"].text(), "changed")
+
+    def test_evict(self):
+        """Evicted documents are saved, and reloaded with their changes; pinned documents are not evicted"""
+        docstore = self.docstore(maxdocuments=1)
+        self.edit(docstore, self.key, EDITS[0])
+        docstore[("test","doc2")] #pylint: disable=pointless-statement
+        self.assertNotIn(self.key, docstore)
+        self.assertIn(("test","doc2"), docstore)
+        self.assertEqual(self.fromdisk(self.key)["doc.p.1.s.1.w.1"].text(), "changed")
+        self.assertEqual(docstore[self.key]["doc.p.1.s.1.w.1"].text(), "changed")
+        with docstore.lrulock:
+            docstore.pinned.add(self.key)
+        docstore[("test","doc3")] #pylint: disable=pointless-statement
+        self.assertIn(self.key, docstore)
+        self.assertNotIn(("test","doc2"), docstore)
+
+    def test_waitupdates(self):
+        """Waiting polls wake up when updates are queued for their session, and are limited in number"""
+        docstore = self.docstore()
+        docstore.maxpollers = 1
+        docstore.updateq[self.key]["session1"] #pylint: disable=pointless-statement
+        docstore.updateq[self.key]["session2"] #pylint: disable=pointless-statement
+        woken = []
+        begintime = time.time()
+        poller = threading.Thread(target=lambda: woken.append(docstore.waitupdates(self.key, "session1", 30)))
+        poller.start()
+        self.assertTrue(wait(lambda: docstore.pollers == 1))
+        #the maximum number of polls is waiting, a further poll returns immediately
+        self.assertFalse(docstore.waitupdates(self.key, "session2", 30))
+        self.assertEqual(docstore.pollersrefused, 1)
+        docstore.updateq[self.key]["session1"].add("doc.p.1.s.1.w.1")
+        docstore.notifyupdates(self.key)
+        poller.join(10)
+        self.assertEqual(woken, [True])
+        self.assertLess(time.time() - begintime, 10)
+        self.assertEqual(docstore.pollers, 0)
+
+    @unittest.skipIf(shutil.which("git") is None, "git is not installed")
+    def test_git(self):
+        """Saves within the time window are committed at once, saves that change nothing are not committed"""
+        for variable in ("GIT_AUTHOR_NAME", "GIT_COMMITTER_NAME"):
+            os.environ.setdefault(variable, "test")
+        for variable in ("GIT_AUTHOR_EMAIL", "GIT_COMMITTER_EMAIL"):
+            os.environ.setdefault(variable, "test@example.org")
+        docstore = self.docstore(git=True, gitmode="monolithic")
+        docstore.gitwindow = 1
+        try:
+            for key in (self.key, ("test","doc2")):
+                self.edit(docstore, key, EDITS[0].replace("doc.", key[1] + "."))
+                docstore.save(key, "edit")
+            worker = docstore.gitworker(self.key)
+            worker.flush()
+            worker.commit(docstore.getfilename(self.key), "unchanged")
+            worker.flush()
+            log = subprocess.run(["git", "log", "--format=%s"], cwd=self.workdir, stdout=subprocess.PIPE, check=True).stdout.decode('utf-8').splitlines()
+            self.assertEqual(log, ["Changes to 2 documents"])
+        finally:
+            docstore.stopgit()
+
+    def test_changefeed(self):
+        """Changes applied from the change feed of the primary give the same document on a replica"""
+        primary = self.docstore()
+        replica = self.docstore()
+        replica[self.key] #pylint: disable=pointless-statement
+        for query in EDITS:
+            self.edit(primary, self.key, query)
+        seq, changes = primary.getchanges(0)
+        self.assertEqual(seq, len(EDITS))
+        self.assertEqual([ change['query'] for change in changes ], EDITS)
+        for change in changes + changes: #changes that were applied already are ignored
+            replica.applychange(change)
+        self.assertEqual(replica[self.key].data[0].xmlstring(), primary[self.key].data[0].xmlstring())
+        self.assertEqual(replica.revision[self.key], len(EDITS))
+
+
+class ShardRingTest(unittest.TestCase):
+
+    def test_owner(self):
+        """Documents are spread over all workers, and adding a worker only moves documents to the new worker"""
+        keys = [ ("ns" + str(i % 7), "doc" + str(i)) for i in range(1000) ]
+        ring = ShardRing(3)
+        owners = [ ring.owner(key) for key in keys ]
+        self.assertEqual(owners, [ ShardRing(3).owner(key) for key in keys ])
+        self.assertEqual(set(owners), {0, 1, 2})
+        for worker in range(3):
+            self.assertGreater(owners.count(worker), 200)
+        ring = ShardRing(4)
+        moved = [ ring.owner(key) for key, owner in zip(keys, owners) if ring.owner(key) != owner ]
+        self.assertEqual(set(moved), {3})
+        self.assertLess(len(moved), 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#---------------------------------------------------------------
+# FoLiA Document Server - Tests for the FLAT module
+#   https://github.com/proycon/foliadocserve
+#
+#   Licensed under GPLv3
+#
+# Checks that the HTML text rendered for FLAT (gethtmltext() and the
+# space handling it relies on) is the same as that of the original
+# string-concatenating implementation. The reference outputs in
+# flat_reference.json were produced by that implementation, run this
+# script with --reference <flat.py> to produce them again with another
+# implementation. It also checks that the rendering caches kept with a
+# document (RenderCache, DocumentInfo) give the same output as a fresh
+# rendering after edits.
+#
+#---------------------------------------------------------------
+
+import sys
+import os
+import json
+import random
+import argparse
+import unittest
+import importlib.util
+import folia.main as folia
+from folia import fql
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from foliadocserve import flat #pylint: disable=wrong-import-position
+
+TESTDOC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "foliadocserve", "testflat.folia.xml")
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flat_reference.json")
+
+#building blocks for the fuzzed text content
+FUZZTEXT = ["word", "more", "a&b", "x<y>z", "\u00eb", "e\u0308", " ", "  ", "   ", "\t", "\n", "\n  ", "  \n", "\r\n", "\u00a0", "\u2003", "\u200b", "\x85"]
+
+def escape(s):
+    return s.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;").replace("\r","&#13;")
+
+def fuzzcontent(rnd, depth=0):
+    """Returns random XML content for a text content element (possibly with markup)"""
+    parts = []
+    for _ in range(rnd.randint(1,8)):
+        r = rnd.random()
+        if r < 0.1 and depth < 2:
+            parts.append("<t-style class=\"" + rnd.choice(["b","i","strong","x"]) + "\">" + fuzzcontent(rnd, depth+1) + "</t-style>")
+        elif r < 0.15:
+            parts.append("<br/>")
+        else:
+            parts.append(escape("".join(rnd.choice(FUZZTEXT) for _ in range(rnd.randint(1,6)))))
+    return "".join(parts)
+
+def fuzzcases(n=500, seed=1234):
+    """Returns n random text content elements (as XML)"""
+    rnd = random.Random(seed)
+    cases = []
+    for _ in range(n):
+        preserve = " xml:space=\"preserve\"" if rnd.random() < 0.2 else ""
+        cases.append("<t" + preserve + ">" + fuzzcontent(rnd) + "</t>")
+    return cases
+
+def fuzzdocument(cases):
+    """Returns a FoLiA document with a paragraph for every text content element"""
+    xml = ["<?xml version=\"1.0\" encoding=\"utf-8\"?>\n<FoLiA xmlns=\"http://ilk.uvt.nl/folia\" xml:id=\"fuzz\" version=\"2.5.0\"><metadata><annotations/></metadata><text xml:id=\"fuzz.text\">"]
+    for i, case in enumerate(cases):
+        xml.append("<p xml:id=\"fuzz.p." + str(i+1) + "\">" + case + "</p>")
+    xml.append("</text></FoLiA>")
+    return folia.Document(string="".join(xml), autodeclare=True, loadsetdefinitions=False)
+
+def render(module, doc):
+    """Renders the HTML text of all elements with text using the given implementation of the FLAT module, returns a dictionary of ID to HTML"""
+    out = {}
+    for element in doc.data[0].select(folia.AbstractStructureElement):
+        if element.id and element.hastext():
+            out[element.id] = module.gethtmltext(element)
+    return out
+
+def makereference(module):
+    return {
+        'testflat': render(module, folia.Document(file=TESTDOC, loadsetdefinitions=False)),
+        'fuzz': render(module, fuzzdocument(fuzzcases())),
+    }
+
+CORRECTIONSET = "http://raw.github.com/proycon/folia/master/setdefinitions/spellingcorrection.foliaset.xml"
+
+#edits as FLAT makes them, applied to the FLAT test document one after another
+EDITS = [
+    'EDIT t WITH text "mijn" FOR ID "untitleddoc.p.3.s.1.w.2" FORMAT flat RETURN ancestor-focus',
+    'EDIT pos WITH class "N" FOR ID "untitleddoc.p.3.s.6.w.2" FORMAT flat RETURN ancestor-focus',
+    'EDIT chunk ID "untitleddoc.p.3.s.1.chunking.1.chunk.2" WITH class "X" FORMAT flat RETURN ancestor-focus',
+    'ADD entity OF "http://ilk.uvt.nl/folia/sets/frog-ner-nl" WITH class "per" RESPAN ID "untitleddoc.p.3.s.1.w.3" & ID "untitleddoc.p.3.s.1.w.4" FORMAT flat RETURN ancestor-focus',
+    'APPEND w WITH text "extra" FOR ID "untitleddoc.p.3.s.1.w.5" FORMAT flat RETURN ancestor-target',
+    'DELETE w ID "untitleddoc.p.3.s.1.w.12b" FORMAT flat',
+    'SUBSTITUTE w WITH text "wegreden" FOR SPAN ID "untitleddoc.p.3.s.6.w.14" & ID "untitleddoc.p.3.s.6.w.15" FORMAT flat',
+    'EDIT t WITH text "het" (AS CORRECTION OF "' + CORRECTIONSET + '" WITH class "nonworderror") FOR ID "untitleddoc.p.3.s.6.w.8" FORMAT flat RETURN ancestor-focus',
+    'SUBSTITUTE w WITH text "de" (AS CORRECTION OF "' + CORRECTIONSET + '" WITH class "nonworderror") FOR SPAN ID "untitleddoc.p.3.s.12.w.14" FORMAT flat RETURN ancestor-focus',
+    'DELETE entity ID "untitleddoc.p.3.s.9.entity.1" FORMAT flat RETURN ancestor-focus',
+]
+
+def assignids(doc):
+    """Gives all elements that FLAT would assign a random ID to a fixed one, so renderings can be compared"""
+    for i, element in enumerate(list(doc.data[0].select((folia.AbstractStructureElement, folia.Correction, folia.Alternative, folia.Suggestion), ignore=False))):
+        if not element.id:
+            element.id = doc.id + ".fixed." + str(i) + "." + element.XMLTAG
+            doc.index[element.id] = element
+
+def renderflat(doc, rendercache=None, docinfo=None):
+    """Renders the FLAT response for all sentences and for the words of the first sentence (cached as separate elements), returns it decoded.
+    Other words are left out: after a SUBSTITUTE of words in their sentence, their spans refer to words that no longer exist"""
+    results = [fql.Query("SELECT s FORMAT flat")(doc, False), fql.Query('SELECT w FOR ID "untitleddoc.p.3.s.1" FORMAT flat')(doc, False)]
+    return json.loads(flat.parseresults(results, doc, version="test", declarations=True, toc=True, slices=[("s",3)], rendercache=rendercache, docinfo=docinfo))
+
+def postprocess_spaces_reference(s):
+    """The original character-by-character implementation of postprocess_spaces()"""
+    s2 = ""
+    for i, c in enumerate(s):
+        if c == "\0":
+            if i > 0 and not folia.is_space(s[i-1]) and s[i-1] != "\1" and s[i-1:i+4] != "<br/>" and s[i-1:i+5] != "&nbsp;":
+                s2 += " "
+        elif c == "\1":
+            s2 += "&nbsp;"
+        else:
+            s2 += c
+    return s2
+
+
+class FlatTextTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(REFERENCE, 'r', encoding='utf-8') as f:
+            cls.reference = json.load(f)
+
+    def test_testflat(self):
+        """HTML text of all elements of the FLAT test document"""
+        out = render(flat, folia.Document(file=TESTDOC, loadsetdefinitions=False))
+        self.assertEqual(out, self.reference['testflat'])
+
+    def test_fuzz(self):
+        """HTML text of random text content (whitespace, newlines, markup, xml:space="preserve")"""
+        out = render(flat, fuzzdocument(fuzzcases()))
+        self.assertEqual(len(out), len(self.reference['fuzz']))
+        for key, html in self.reference['fuzz'].items():
+            self.assertEqual(out[key], html, key)
+
+    def test_postprocess_spaces(self):
+        """Placeholder handling on random strings"""
+        rnd = random.Random(42)
+        alphabet = ["a", "b", " ", "\t", "\n", "\u00a0", "\u3000", "\0", "\0", "\1", "\1", "<br/>", "&nbsp;", "&"]
+        for _ in range(20000):
+            s = "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0,12)))
+            self.assertEqual(flat.postprocess_spaces(s), postprocess_spaces_reference(s), repr(s))
+
+    def test_norm_spaces(self):
+        """Equivalence with folia.norm_spaces() for every code point and random strings"""
+        for c in range(sys.maxunicode + 1):
+            if 0xd800 <= c <= 0xdfff:
+                continue #surrogates
+            s = "a" + chr(c) + " " + chr(c) + chr(c) + "b"
+            self.assertEqual(flat.norm_spaces(s), folia.norm_spaces(s), hex(c))
+        rnd = random.Random(42)
+        alphabet = ["a", "b", " ", "  ", "\t", "\r", "\n", "\x0b", "\x0c", "\x1c", "\x85", "\u00a0", "\u2028", "\u200b", "\x07", "\x00", "\ufeff"]
+        for _ in range(20000):
+            s = "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0,12)))
+            self.assertEqual(flat.norm_spaces(s), folia.norm_spaces(s), repr(s))
+
+
+class FlatCacheTest(unittest.TestCase):
+
+    def test_edits(self):
+        """Rendering with the caches kept with the document is the same as a fresh rendering after every edit"""
+        doc = folia.Document(file=TESTDOC, loadsetdefinitions=False)
+        rendercache = flat.RenderCache(doc)
+        docinfo = flat.DocumentInfo(doc)
+        assignids(doc)
+        self.assertEqual(renderflat(doc, rendercache, docinfo), renderflat(doc))
+        for edit in EDITS:
+            query = fql.Query(edit)
+            result = query(doc, False)
+            rendercache.invalidate(result, query)
+            docinfo.invalidate(result, query)
+            assignids(doc)
+            self.assertEqual(renderflat(doc, rendercache, docinfo), renderflat(doc), edit)
+        self.assertGreater(rendercache.stats()['hits'], 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tests for the FLAT module", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--reference', type=str, help="Write the reference outputs of the FLAT module (flat.py) at the given path, rather than running the tests", action='store', required=False)
+    args, rest = parser.parse_known_args()
+    if args.reference:
+        spec = importlib.util.spec_from_file_location("referenceflat", args.reference)
+        referenceflat = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(referenceflat)
+        reference = makereference(referenceflat)
+        with open(REFERENCE, 'w', encoding='utf-8') as f:
+            json.dump(reference, f, indent=1, ensure_ascii=False)
+            f.write("\n")
+        print("Reference outputs written to " + REFERENCE)
+    else:
+        unittest.main(argv=sys.argv[:1] + rest)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#---------------------------------------------------------------
+# FoLiA Document Server - Tests for the HTTP interface
+#   https://github.com/proycon/foliadocserve
+#
+#   Licensed under GPLv3
+#
+# Starts the document server on a temporary document root and sends
+# requests to it over HTTP.
+#
+#---------------------------------------------------------------
+
+import sys
+import os
+import time
+import gzip
+import json
+import socket
+import shutil
+import tempfile
+import subprocess
+import unittest
+import urllib.request
+import urllib.error
+import urllib.parse
+
+ROOTDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def makedocument(docid, paragraphs=3, words=5):
+    """Returns a FoLiA document (as XML) without external set definitions, so no network access is needed to load it"""
+    xml = ["<?xml version=\"1.0\" encoding=\"utf-8\"?>\n<FoLiA xmlns=\"http://ilk.uvt.nl/folia\" xml:id=\"" + docid + "\" version=\"2.5.0\"><metadata><annotations>",
+           "<text-annotation set=\"text\"/><paragraph-annotation/><sentence-annotation/><token-annotation/><pos-annotation set=\"pos\"/>",
+           "</annotations></metadata><text xml:id=\"" + docid + ".text\">"]
+    for i in range(1, paragraphs+1):
+        pid = docid + ".p." + str(i)
+        xml.append("<p xml:id=\"" + pid + "\"><s xml:id=\"" + pid + ".s.1\">")
+        for j in range(1, words+1):
+            xml.append("<w xml:id=\"" + pid + ".s.1.w." + str(j) + "\"><t>word" + str(j) + "</t><pos set=\"pos\" class=\"N\"/></w>")
+        xml.append("</s></p>")
+    xml.append("</text></FoLiA>")
+    return "".join(xml)
+
+def freeport():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs a document server (with the extra arguments in ARGS) for all tests of the class, serving the document test/doc"""
+
+    ARGS = []
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(cls.workdir, "test"))
+        with open(os.path.join(cls.workdir, "test", "doc.folia.xml"), 'w', encoding='utf-8') as f:
+            f.write(makedocument("doc"))
+        cls.port = freeport()
+        cls.process = subprocess.Popen([sys.executable, "-m", "foliadocserve.foliadocserve", "-d", cls.workdir, "-p", str(cls.port), "--host", "127.0.0.1", "-l", os.path.join(cls.workdir, "log.txt")] + cls.ARGS,
+                                       cwd=ROOTDIR, stdout=subprocess.DEVNULL, stderr=open(os.path.join(cls.workdir, "stderr.txt"), 'w', encoding='utf-8'))
+        for _ in range(300):
+            #the server does not stop on SIGTERM while the engine is still starting, so wait until it has started completely
+            with open(os.path.join(cls.workdir, "stderr.txt"), 'r', encoding='utf-8') as f:
+                if "Bus STARTED" in f.read():
+                    break
+            time.sleep(0.1)
+        else:
+            raise RuntimeError("Document server did not start")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+        try:
+            cls.process.wait(30)
+        except subprocess.TimeoutExpired:
+            cls.process.kill()
+        shutil.rmtree(cls.workdir)
+
+    @classmethod
+    def request(cls, path, data=None, headers=None):
+        """Sends a request, returns the status, the response headers and the (undecoded) body"""
+        request = urllib.request.Request("http://127.0.0.1:" + str(cls.port) + "/" + path, data=data.encode('utf-8') if isinstance(data, str) else data, headers=headers or {})
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    @classmethod
+    def query(cls, query, headers=None, **params):
+        params['query'] = query
+        return cls.request("query/", urllib.parse.urlencode(params), headers)
+
+
+class CompressedGetTest(ServerTestCase):
+
+    def test_get_gzip(self):
+        """A GET accepting gzip is compressed exactly once"""
+        status, headers, body = self.query("USE test/doc GET", {'Accept-Encoding': 'gzip'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers.get('Content-Encoding'), 'gzip')
+        self.assertIn(b"<FoLiA", gzip.decompress(body))
+
+    def test_get_plain(self):
+        status, headers, body = self.query("USE test/doc GET")
+        self.assertEqual(status, 200)
+        self.assertIsNone(headers.get('Content-Encoding'))
+        self.assertIn(b"<FoLiA", body)
+
+    def test_select_gzip(self):
+        status, headers, body = self.query("USE test/doc SELECT w FORMAT json", {'Accept-Encoding': 'gzip'})
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(gzip.decompress(body) if headers.get('Content-Encoding') == 'gzip' else body)), 15)
+
+
+class CompressedGetDebugTest(CompressedGetTest):
+    """The same, with the debug log (which logs the full response) enabled"""
+
+    ARGS = ["-D", "1"]
+
+
+class ChangeTest(ServerTestCase):
+
+    def revision(self):
+        status, _, body = self.request("savestatus/test/doc")
+        self.assertEqual(status, 200)
+        return json.loads(body)['revision']
+
+    def test_select_subaction(self):
+        """A SELECT with a subaction that edits the document is a change"""
+        self.assertEqual(self.query("USE test/doc GET")[0], 200) #caches the serialization
+        revision = self.revision()
+        status, _, _ = self.query('USE test/doc SELECT w ID "doc.p.1.s.1.w.1" (EDIT pos WITH class "V") FORMAT xml')
+        self.assertEqual(status, 200)
+        self.assertEqual(self.revision(), revision + 1)
+        status, _, body = self.query("USE test/doc GET")
+        self.assertEqual(status, 200)
+        self.assertIn(b'class="V"', body)
+
+
+if __name__ == "__main__":
+    unittest.main()